@@ -1,4 +1,4 @@
-import vtk, qt, ctk, slicer, PythonQt
+import qt, slicer
 
 
 # ICON_DIR = os.path.dirname(os.path.realpath(__file__)) + '/Resources/Icons/'
@@ -1 +1,16 @@
-from utility import *
\ No newline at end of file
+from utility import *
+from topology import *
+from surface import *
+from cache import *
+from meshstore import *
+from labelmap import *
+from topologymatrix import *
+from export import *
+from synthetic import *
+from profiling import *
+from discovery import *
+from validation import *
+from scheduler import *
+from cohortmesh import *
+from journal import *
+from subjecttable import *
@@ -0,0 +1,226 @@
+'''
+Headless cohort import and topology quality control.
+
+Run it through Slicer without the main window, for example:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/batch.py \
+    --csv cohort.csv --report report.csv
+
+or, to find the cases from the directory layout of the tool that produced them:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/batch.py \
+    --directory /data/study --layout FreeSurfer --report report.csv
+
+Each imported case is written to the report as soon as its topology is known,
+followed by one summary row per label with the cohort consistency, the most
+common topology and the cases that differ from it.
+With --validate, the headers and labels of all the files are checked first
+and nothing is imported if a file is invalid.
+The exit code is 0 for a consistent cohort, 1 for an inconsistent one and
+2 when the cohort could not be imported or is invalid.
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+from CommonUtilities import CaseDiscoveryUtility, CohortValidationUtility, TopologyUtility
+
+EXIT_CONSISTENT = 0
+EXIT_INCONSISTENT = 1
+EXIT_IMPORT_FAILED = 2
+
+REPORT_FIELDS = ['record', 'case', 'label', 'topology', 'euler', 'genus', 'boundaryLoops',
+                 'nonManifoldEdges', 'components', 'consistency', 'outliers']
+
+
+#
+# TopologyReportWriter
+#
+'''
+Writes the report one row at a time, as CSV or as JSON lines depending on the
+extension of the file.
+'''
+
+
+class TopologyReportWriter(object):
+    def __init__(self, report_path):
+        self.report_file = open(report_path, 'w')
+        self.csv_writer = None
+        if os.path.splitext(report_path)[1].lower() == '.csv':
+            self.csv_writer = csv.DictWriter(self.report_file, REPORT_FIELDS)
+            self.csv_writer.writeheader()
+
+    def writeRow(self, row):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(dict((field, row.get(field, '')) for field in REPORT_FIELDS))
+        else:
+            self.report_file.write(json.dumps(row) + '\n')
+
+    def writeCase(self, case_name, topology_details, component_counts=None):
+        # component_counts are the statistics of the voxel components of each label, if they were filtered
+        component_counts = component_counts if component_counts is not None else {}
+        for label in sorted(topology_details.keys()):
+            topology = topology_details[label]
+            row = {
+                'record': 'case',
+                'case': case_name,
+                'label': label,
+                'topology': TopologyUtility.getTopologyName(topology['euler']),
+            }
+            for key in ['euler', 'genus', 'boundaryLoops', 'nonManifoldEdges']:
+                row[key] = topology[key]
+            if label in component_counts:
+                row['components'] = component_counts[label]['components']
+            self.writeRow(row)
+        self.report_file.flush()
+
+    def writeLabel(self, label, topology_matrix):
+        # The topology and Euler characteristic of a label row are the most common ones in the cohort
+        majority_euler = topology_matrix.getMajorityEuler(label)
+        row = {
+            'record': 'label',
+            'label': label,
+            'topology': TopologyUtility.getTopologyName(majority_euler) if majority_euler is not None else '',
+            'euler': majority_euler,
+            'consistency': topology_matrix.getConsistency(label),
+            'outliers': topology_matrix.getOutlierCases(label),
+        }
+        if self.csv_writer is not None:
+            row['outliers'] = ';'.join(row['outliers'])
+        self.writeRow(row)
+
+    def writeCohort(self, consistency):
+        self.writeRow({'record': 'cohort', 'consistency': consistency})
+        self.report_file.flush()
+
+    def close(self):
+        self.report_file.close()
+
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(description='Import a cohort of labelmaps and check the consistency of '
+                                                 'the topology of each label.')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--csv', help='CSV manifest: a header and one file path per row')
+    inputs.add_argument('--directory', help='Study directory where the labelmaps are found from --layout')
+    parser.add_argument('--layout', choices=sorted(CaseDiscoveryUtility.LAYOUTS.keys()), default='General VTK',
+                        help='Directory layout of the tool that produced the labelmaps')
+    parser.add_argument('--file-name', default='', help='File name pattern of the labelmaps, replaces the one '
+                                                       'of the layout, e.g. aparc+aseg.mgz')
+    parser.add_argument('--report', required=True, help='Report file, CSV if it ends with .csv, JSON lines otherwise')
+    parser.add_argument('--validate', action='store_true',
+                        help='Check the headers and labels of all the files before importing them')
+    parser.add_argument('--strict-geometry', action='store_true',
+                        help='With --validate, reject the cohort if the size, spacing, orientation or pixel type '
+                             'of a file differs from the others')
+    parser.add_argument('--validation-report', default='', help='JSON file where the validation report is written, '
+                                                                'implies --validate')
+    addProcessingArguments(parser)
+    parser.add_argument('--journal', default='', help='Directory of the import journal. A run interrupted with '
+                                                      'the same journal resumes after its finished cases')
+    parser.add_argument('--export', default='', help='Directory where the surfaces are written, one directory '
+                                                     'per label with a manifest.json of the files')
+    parser.add_argument('--cohort-mesh', default='', help='File where the surfaces of all the cases are packed, '
+                                                          'to be memory-mapped by downstream tools')
+    parser.add_argument('--trace', default='', help='JSON file where the timings of each stage of each case are '
+                                                    'written, in the Chrome trace event format')
+    parser.add_argument('--export-format', choices=['vtp', 'vtk'], default='vtp',
+                        help='Compressed VTK XML (vtp) or binary legacy VTK (vtk) surface files')
+    return parser
+
+
+def addProcessingArguments(parser):
+    # Options read by configureLogic
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of cases imported in parallel with --multi-label, and of topology and export '
+                             'threads')
+    parser.add_argument('--multi-label', action='store_true',
+                        help='Extract the surfaces of all labels in a single pass over each labelmap')
+    parser.add_argument('--raw-surfaces', action='store_true',
+                        help='Keep the surfaces as generated instead of the cleaned largest component')
+    parser.add_argument('--largest-component', action='store_true',
+                        help='Keep the largest connected component of each label in the voxels before extracting '
+                             'its surface')
+    parser.add_argument('--fill-holes', type=int, default=0, metavar='VOXELS',
+                        help='With --largest-component, fill the cavities of at most this many background voxels')
+    parser.add_argument('--cache', default='', help='Directory of the surface and topology cache')
+    parser.add_argument('--release-voxels', action='store_true',
+                        help='Free the labelmap and segmentation of each case once its surfaces and topology are '
+                             'known')
+
+
+def configureLogic(logic, args):
+    logic.SetSaveCleanData(not args.raw_surfaces)
+    logic.SetNumberOfWorkers(args.workers)
+    logic.SetSurfaceExtractionMode('MultiLabel' if args.multi_label else 'Segmentation')
+    logic.SetComponentFiltering(args.largest_component, args.fill_holes > 0, args.fill_holes)
+    logic.SetReleaseVoxelData(args.release_voxels)
+    if args.cache:
+        logic.SetSurfaceCache(args.cache)
+
+
+def runBatch(args):
+    # Imported here as the DataImporter module itself imports this package
+    from DataImporter import DataImporterLogic
+
+    logic = DataImporterLogic()
+    configureLogic(logic, args)
+    logic.SetImportJournal(args.journal)
+    # The stages are only recorded when their trace is written
+    logic.SetProfiling(bool(args.trace))
+
+    if args.directory:
+        case_names, file_paths = logic.discoverFiles(args.directory, args.layout, args.file_name)
+    else:
+        case_names, file_paths = None, DataImporterLogic.readCSVManifest(args.csv)
+    writer = TopologyReportWriter(args.report)
+    try:
+        if args.validate or args.validation_report:
+            report = logic.validateFiles(file_paths, case_names, args.strict_geometry)
+            if args.validation_report:
+                CohortValidationUtility.writeReport(args.validation_report, report)
+            if not report['valid']:
+                writer.writeCohort('Invalid')
+                return EXIT_IMPORT_FAILED
+
+        # The topology of each case is computed as soon as it is imported, so that its voxels can be
+        # released before the next cases are added
+        for case_event in logic.iterImportFiles(file_paths, case_names):
+            if case_event['status'] == 'mismatch':
+                writer.writeCohort('ImportFailed')
+                return EXIT_IMPORT_FAILED
+            if case_event['status'] == 'imported':
+                case_name = case_event['name']
+                logic.processCaseTopology(case_name)
+                writer.writeCase(case_name, logic.topologyDetailsDict[case_name], logic.getComponentCounts(case_name))
+        if len(logic.caseNames) == 0:
+            writer.writeCohort('ImportFailed')
+            return EXIT_IMPORT_FAILED
+        logic.finishTopologyDictionary()
+        if args.trace:
+            logic.writeProfileTrace(args.trace)
+        if args.export:
+            logic.exportSurfaces(args.export, args.export_format == 'vtp')
+        if args.cohort_mesh:
+            logic.exportCohortMesh(args.cohort_mesh)
+
+        for label in sorted(logic.topologyMatrix.getLabels()):
+            writer.writeLabel(label, logic.topologyMatrix)
+        if logic.isCohortTopologyConsistent():
+            writer.writeCohort('Consistent')
+            return EXIT_CONSISTENT
+        writer.writeCohort('InConsistent')
+        return EXIT_INCONSISTENT
+    finally:
+        writer.close()
+        logic.cleanup()
+
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv)
+    return runBatch(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,154 @@
+'''
+Benchmark of the DataImporter pipeline on a synthetic cohort.
+
+Run it through Slicer, for example:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/benchmark.py \
+    --output benchmark.json --cases 20 --size 128 --labels 8
+
+The labelmaps are generated with structures of known topology, so the topology
+computed for each case and label is checked as well. The timings of each stage,
+the resident memory at the start and at the sampled peak of each run, and the
+topology errors are written to the output JSON file. With --serial-baseline and more
+than one worker, the cohort is also imported with a single worker and the speedup of
+the parallel import is reported. The cases are only imported in parallel with
+--multi-label, see DataImporterLogic.iterLoadCases.
+The exit code is 0 when the topology of all structures is correct, 1 otherwise.
+'''
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from CommonUtilities import PipelineProfiler, SyntheticCohortUtility
+from CommonUtilities.batch import addProcessingArguments, configureLogic
+
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(description='Time the import and topology computation of a synthetic cohort.')
+    parser.add_argument('--output', required=True, help='JSON file where the results are written')
+    parser.add_argument('--cases', type=int, default=10, help='Number of cases of the cohort')
+    parser.add_argument('--size', type=int, default=96, help='Number of voxels along each axis of the volumes')
+    parser.add_argument('--labels', type=int, default=8, help='Number of labels of each volume')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs, the fastest one is reported too')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the variations between cases')
+    parser.add_argument('--data-dir', default='', help='Directory of the generated cohort, kept after the benchmark')
+    parser.add_argument('--serial-baseline', action='store_true',
+                        help='Also import the cohort with a single worker and report the speedup of --workers')
+    addProcessingArguments(parser)
+    return parser
+
+
+def timeStage(timings, stage, function, *args):
+    start_time = time.time()
+    result = function(*args)
+    timings[stage] = time.time() - start_time
+    return result
+
+
+def timeDisplaySegment(timings, logic):
+    # Mean time to show a structure, displaying needs the 3D view of the main window
+    import slicer
+    if slicer.app.layoutManager() is None:
+        return
+    labels = logic.getLabelsInCohort()
+    start_time = time.time()
+    for case_name in logic.caseNames:
+        for label in labels:
+            logic.displaySegment(case_name, str(label))
+    timings['displaySegment'] = (time.time() - start_time) / max(1, len(logic.caseNames) * len(labels))
+
+
+def runImport(logic_class, args, file_paths, number_of_workers):
+    # Imports the cohort with a new logic. Returns the record of the run and the topology errors.
+    logic = logic_class()
+    configureLogic(logic, args)
+    logic.SetNumberOfWorkers(number_of_workers)
+    # The stages sample the resident memory, unlike the peak of the process this is not carried over
+    # from the previous runs
+    logic.SetProfiling(True)
+    start_memory = PipelineProfiler.getResidentMemory()
+    timings = {}
+    topology_errors = []
+    try:
+        imported = timeStage(timings, 'importFiles', logic.importFiles, file_paths)
+        if imported:
+            timeStage(timings, 'populateTopologyDictionary', logic.populateTopologyDictionary)
+            timeDisplaySegment(timings, logic)
+            topology_errors = SyntheticCohortUtility.findTopologyErrors(logic.topologyMatrix, args.labels)
+        run = {
+            'imported': bool(imported) and len(logic.caseNames) == args.cases,
+            'workers': number_of_workers,
+            'timings': timings,
+            'memory': logic.getMemoryStatistics(),
+            'meshStore': logic.getMeshStoreStatistics(),
+            'surfaceCache': logic.getSurfaceCacheStatistics(),
+            'stages': logic.getProfileSummary(),
+        }
+        run['startMemory'] = start_memory
+        run['peakMemory'] = run['memory']['peak']
+        if start_memory is not None and run['peakMemory'] is not None:
+            run['peakMemoryIncrease'] = run['peakMemory'] - start_memory
+    finally:
+        timeStage(timings, 'cleanup', logic.cleanup)
+    return run, topology_errors
+
+
+def runBenchmark(args):
+    # Imported here as the DataImporter module itself imports this package
+    from DataImporter import DataImporterLogic
+
+    data_dir = args.data_dir if args.data_dir else tempfile.mkdtemp(prefix='DataImporterBenchmark')
+    results = {
+        'configuration': dict((key, value) for key, value in vars(args).items() if key != 'output'),
+        'environment': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+        },
+        'runs': [],
+    }
+    try:
+        import slicer
+        results['environment']['slicer'] = slicer.app.applicationVersion
+    except (ImportError, AttributeError):
+        pass
+
+    try:
+        generation_time = time.time()
+        file_paths, _ = SyntheticCohortUtility.generateCohort(data_dir, args.cases, args.size, args.labels, args.seed)
+        results['generationTime'] = time.time() - generation_time
+
+        topology_errors = []
+        for _ in range(args.repeat):
+            run, topology_errors = runImport(DataImporterLogic, args, file_paths, args.workers)
+            results['runs'].append(run)
+
+        # Stages that ran in every run
+        stages = set.intersection(*[set(run['timings'].keys()) for run in results['runs']])
+        results['fastest'] = dict((stage, min(run['timings'][stage] for run in results['runs'])) for stage in stages)
+        results['topologyErrors'] = topology_errors
+
+        if args.serial_baseline and args.workers > 1:
+            serial_run, _ = runImport(DataImporterLogic, args, file_paths, 1)
+            results['serialRun'] = serial_run
+            results['importSpeedup'] = serial_run['timings']['importFiles'] / results['fastest']['importFiles']
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=1, sort_keys=True)
+
+    imported = all(run['imported'] for run in results['runs'])
+    return 0 if imported and len(results['topologyErrors']) == 0 else 1
+
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv)
+    return runBenchmark(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from surface import SurfaceUtility
+
+#
+# CaseRecordUtility
+#
+'''
+This class harbors the functions to save and load the processing results of a case:
+its label range and voxel counts, the topology of each label and the per-label surfaces.
+'''
+
+
+class CaseRecordUtility(object):
+    RECORD_FILE_NAME = 'record.json'
+
+    @staticmethod
+    def writeCaseRecord(record_dir, record):
+        if not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+        polydata_files = {}
+        for label, polydata in record['polyData'].items():
+            file_name = 'label_%d.vtp' % label
+            if not SurfaceUtility.writePolyData(polydata, os.path.join(record_dir, file_name)):
+                logging.error('!!! Failed to write surface of label %d in %s', label, record_dir)
+                return False
+            polydata_files[str(label)] = file_name
+        description = {
+            'labelRange': list(record['labelRange']),
+            'topology': dict((str(label), topology) for label, topology in record['topology'].items()),
+            'polyData': polydata_files,
+        }
+        for key in ['labelCounts', 'components']:
+            if key in record:
+                description[key] = dict((str(label), value) for label, value in record[key].items())
+        for key, value in record.items():
+            if key not in description:
+                description[key] = value
+        # Written last, a record without this file is incomplete
+        with open(os.path.join(record_dir, CaseRecordUtility.RECORD_FILE_NAME), 'w') as record_file:
+            json.dump(description, record_file)
+        return True
+
+    @staticmethod
+    def readCaseRecord(record_dir):
+        record_path = os.path.join(record_dir, CaseRecordUtility.RECORD_FILE_NAME)
+        if not os.path.isfile(record_path):
+            return None
+        try:
+            with open(record_path, 'r') as record_file:
+                description = json.load(record_file)
+        except ValueError:
+            logging.error('!!! Corrupted case record: %s', record_path)
+            return None
+        record = dict(description)
+        record['labelRange'] = tuple(description['labelRange'])
+        record['topology'] = dict((int(label), topology) for label, topology in description['topology'].items())
+        for key in ['labelCounts', 'components']:
+            if key in description:
+                record[key] = dict((int(label), value) for label, value in description[key].items())
+        record['polyData'] = {}
+        for label, file_name in description['polyData'].items():
+            polydata = SurfaceUtility.readPolyData(os.path.join(record_dir, file_name))
+            if polydata is None:
+                logging.error('!!! Missing surface %s in case record %s', file_name, record_dir)
+                return None
+            record['polyData'][int(label)] = polydata
+        return record
+
+    @staticmethod
+    def getDirectorySize(directory):
+        size = 0
+        for root, _, file_names in os.walk(directory):
+            for file_name in file_names:
+                size += os.path.getsize(os.path.join(root, file_name))
+        return size
+
+
+#
+# SurfaceCache
+#
+'''
+On-disk cache of case records, keyed by the content of the input file, the
+processing parameters and the version of the processing. The least recently
+used entries are evicted when the cache grows past its maximum size.
+'''
+
+
+class SurfaceCache(object):
+    INDEX_FILE_NAME = 'index.json'
+    # Part of each key, to increment when the processing changes the record of a file for the same parameters,
+    # e.g. a new mesh extraction or topology computation, so that the records of the previous code are not reused
+    VERSION = 1
+
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.entries = {}  # key -> {'size': bytes, 'lastAccess': time}
+        self.file_hashes = {}  # path -> {'size': bytes, 'mtime': time, 'hash': content hash}
+        self._readIndex()
+
+    def setMaximumSize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+            self._writeIndex()
+
+    def computeKey(self, file_path, parameters):
+        content_hash = self.computeFileHash(file_path)
+        parameters_string = json.dumps({'version': self.VERSION, 'parameters': parameters}, sort_keys=True)
+        return hashlib.sha1((content_hash + parameters_string).encode('utf-8')).hexdigest()
+
+    def computeFileHash(self, file_path):
+        # The hash of a file is only recomputed when its size or modification time changed
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self.lock:
+            known = self.file_hashes.get(file_path)
+            if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                return known['hash']
+        content_hash = hashlib.sha1()
+        with open(file_path, 'rb') as input_file:
+            for chunk in iter(lambda: input_file.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+        with self.lock:
+            self.file_hashes[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                           'hash': content_hash.hexdigest()}
+        return content_hash.hexdigest()
+
+    def load(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+        record = CaseRecordUtility.readCaseRecord(os.path.join(self.cache_dir, key))
+        with self.lock:
+            if record is None:
+                self.misses += 1
+                self._removeEntry(key)
+                return None
+            self.hits += 1
+            self.entries[key]['lastAccess'] = time.time()
+            return record
+
+    def store(self, key, record):
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self.lock:
+            self._removeEntry(key)
+        if not CaseRecordUtility.writeCaseRecord(entry_dir, record):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False
+        with self.lock:
+            self.entries[key] = {'size': CaseRecordUtility.getDirectorySize(entry_dir), 'lastAccess': time.time()}
+            self._evict()
+        return True
+
+    def flush(self):
+        with self.lock:
+            self._writeIndex()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._removeEntry(key)
+            self.hits = 0
+            self.misses = 0
+            self._writeIndex()
+
+    def getSize(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+
+    def getStatistics(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'size': self.getSize(),
+                'maxSize': self.max_size,
+            }
+
+    def _evict(self):
+        size = self.getSize()
+        for key in sorted(self.entries.keys(), key=lambda k: self.entries[k]['lastAccess']):
+            if size <= self.max_size:
+                break
+            size -= self.entries[key]['size']
+            self._removeEntry(key)
+
+    def _removeEntry(self, key):
+        self.entries.pop(key, None)
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _readIndex(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE_NAME)
+        index = {}
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, 'r') as index_file:
+                    index = json.load(index_file)
+            except ValueError:
+                logging.warning('Ignoring corrupted surface cache index: %s', index_path)
+        self.file_hashes = index.get('files', {})
+        entries = index.get('entries', {})
+        # Entries whose directory disappeared are dropped, and the ones stored after the
+        # last index update are added back
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if not os.path.isdir(entry_dir):
+                continue
+            if key in entries:
+                self.entries[key] = entries[key]
+            elif os.path.isfile(os.path.join(entry_dir, CaseRecordUtility.RECORD_FILE_NAME)):
+                self.entries[key] = {'size': CaseRecordUtility.getDirectorySize(entry_dir),
+                                     'lastAccess': os.path.getmtime(entry_dir)}
+            else:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _writeIndex(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE_NAME)
+        temporary_path = index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump({'entries': self.entries, 'files': self.file_hashes}, index_file)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rename(temporary_path, index_path)
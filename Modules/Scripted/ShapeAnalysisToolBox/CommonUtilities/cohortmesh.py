@@ -0,0 +1,210 @@
+import json
+import struct
+import numpy
+import vtk
+from vtk.util import numpy_support
+from topology import TopologyUtility, ID_TYPE
+
+#
+# CohortMesh
+#
+'''
+Meshes of a whole cohort packed in two contiguous arrays, the points and the
+triangles, with a table of the offsets of each case and label. The container is
+written to a single file that is memory-mapped when it is opened, so downstream
+tools get NumPy views of the meshes without copies, and a vtkPolyData is only
+built when it is requested.
+'''
+
+
+class CohortMesh(object):
+    MAGIC = b'COHORTMESH\x00\x01'
+    ALIGNMENT = 64
+    FILE_EXTENSION = '.cmesh'
+
+    # Columns of the offset table
+    CASE, LABEL, POINT_OFFSET, NUMBER_OF_POINTS, TRIANGLE_OFFSET, NUMBER_OF_TRIANGLES = range(6)
+
+    def __init__(self, case_names, points, triangles, offsets):
+        # points is a (N, 3) array, triangles a (M, 3) array of point ids local to each mesh and
+        # offsets a (K, 6) array of (case index, label, point offset, number of points,
+        # triangle offset, number of triangles) sorted by case index and label
+        self.case_names = list(case_names)
+        self.points = points
+        self.triangles = triangles
+        self.offsets = offsets
+        self.case_indices = dict((case_name, index) for index, case_name in enumerate(self.case_names))
+        self.rows = dict(((self.case_names[int(row[CohortMesh.CASE])], int(row[CohortMesh.LABEL])), index)
+                         for index, row in enumerate(offsets))
+
+    @staticmethod
+    def build(case_names, get_labels, get_mesh, points_dtype=numpy.float32):
+        # Packs the meshes given by get_mesh(case name, label) for the labels given by get_labels(case name).
+        # Meshes that are missing or empty are skipped.
+        point_blocks = []
+        triangle_blocks = []
+        offsets = []
+        number_of_points = 0
+        number_of_triangles = 0
+        for case_index, case_name in enumerate(case_names):
+            for label in sorted(get_labels(case_name)):
+                polydata = get_mesh(case_name, label)
+                if polydata is None:
+                    continue
+                points, triangles = TopologyUtility.getTriangleArrays(TopologyUtility.triangulate(polydata))
+                if triangles.shape[0] == 0:
+                    continue
+                point_blocks.append(numpy.asarray(points, dtype=points_dtype))
+                triangle_blocks.append(triangles.astype(numpy.int32))
+                offsets.append((case_index, label, number_of_points, points.shape[0],
+                                number_of_triangles, triangles.shape[0]))
+                number_of_points += points.shape[0]
+                number_of_triangles += triangles.shape[0]
+
+        points = numpy.empty((number_of_points, 3), dtype=points_dtype)
+        triangles = numpy.empty((number_of_triangles, 3), dtype=numpy.int32)
+        for offset, block in zip(offsets, point_blocks):
+            points[offset[CohortMesh.POINT_OFFSET]:offset[CohortMesh.POINT_OFFSET] + block.shape[0]] = block
+        for offset, block in zip(offsets, triangle_blocks):
+            triangles[offset[CohortMesh.TRIANGLE_OFFSET]:offset[CohortMesh.TRIANGLE_OFFSET] + block.shape[0]] = block
+        offsets = numpy.array(offsets, dtype=numpy.int64).reshape(-1, 6)
+        return CohortMesh(case_names, points, triangles, offsets)
+
+    @staticmethod
+    def fromMeshStore(mesh_store, case_names=None, points_dtype=numpy.float32):
+        if case_names is None:
+            case_names = mesh_store.getCaseNames()
+        return CohortMesh.build(case_names, mesh_store.getLabels, mesh_store.getMesh, points_dtype)
+
+    @staticmethod
+    def concatenate(cohort_meshes):
+        # Single container with the cases of all the given ones, in order. The points keep the type of the
+        # first container. Memory-mapped containers are read one page at a time.
+        case_names = []
+        for cohort_mesh in cohort_meshes:
+            case_names.extend(cohort_mesh.case_names)
+        points_dtype = cohort_meshes[0].points.dtype if len(cohort_meshes) > 0 else numpy.float32
+        points = numpy.empty((sum(mesh.points.shape[0] for mesh in cohort_meshes), 3), dtype=points_dtype)
+        triangles = numpy.empty((sum(mesh.triangles.shape[0] for mesh in cohort_meshes), 3), dtype=numpy.int32)
+        offset_tables = []
+        number_of_cases = 0
+        number_of_points = 0
+        number_of_triangles = 0
+        for cohort_mesh in cohort_meshes:
+            offsets = numpy.array(cohort_mesh.offsets, dtype=numpy.int64)
+            offsets[:, CohortMesh.CASE] += number_of_cases
+            offsets[:, CohortMesh.POINT_OFFSET] += number_of_points
+            offsets[:, CohortMesh.TRIANGLE_OFFSET] += number_of_triangles
+            offset_tables.append(offsets)
+            points[number_of_points:number_of_points + cohort_mesh.points.shape[0]] = cohort_mesh.points
+            triangles[number_of_triangles:number_of_triangles + cohort_mesh.triangles.shape[0]] = \
+                cohort_mesh.triangles
+            number_of_cases += len(cohort_mesh.case_names)
+            number_of_points += cohort_mesh.points.shape[0]
+            number_of_triangles += cohort_mesh.triangles.shape[0]
+        offsets = numpy.concatenate(offset_tables) if len(offset_tables) > 0 else numpy.zeros((0, 6), numpy.int64)
+        return CohortMesh(case_names, points, triangles, offsets)
+
+    def write(self, file_path):
+        # Layout: magic, length of the header, JSON header, then the offset table, the points and
+        # the triangles, each aligned so that they can be mapped in place
+        sections = [('offsets', self.offsets), ('points', self.points), ('triangles', self.triangles)]
+        header = {'caseNames': self.case_names, 'sections': {}}
+        for name, array in sections:
+            header['sections'][name] = {'dtype': numpy.dtype(array.dtype).newbyteorder('<').str,
+                                        'shape': list(array.shape), 'offset': 0}
+        # The header is sized with zero offsets and room for the digits of the real ones
+        header_size = len(json.dumps(header)) + 32 * len(sections)
+        position = CohortMesh._align(len(CohortMesh.MAGIC) + 8 + header_size)
+        for name, array in sections:
+            header['sections'][name]['offset'] = position
+            position = CohortMesh._align(position + array.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_size)
+
+        with open(file_path, 'wb') as f:
+            f.write(CohortMesh.MAGIC)
+            f.write(struct.pack('<Q', header_size))
+            f.write(header_bytes)
+            for name, array in sections:
+                f.seek(header['sections'][name]['offset'])
+                numpy.ascontiguousarray(array, dtype=header['sections'][name]['dtype']).tofile(f)
+            f.truncate(position)
+
+    @staticmethod
+    def read(file_path, memory_map=True):
+        # With memory_map, the arrays are read-only views of the file and nothing is loaded before it is used
+        with open(file_path, 'rb') as f:
+            if f.read(len(CohortMesh.MAGIC)) != CohortMesh.MAGIC:
+                raise IOError('Not a cohort mesh file: ' + file_path)
+            header_size = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_size).decode('utf-8'))
+            arrays = {}
+            for name, section in header['sections'].items():
+                dtype = numpy.dtype(str(section['dtype']))
+                shape = tuple(section['shape'])
+                if memory_map and numpy.prod(shape) > 0:
+                    arrays[name] = numpy.memmap(file_path, dtype=dtype, mode='r', offset=section['offset'],
+                                                shape=shape)
+                else:
+                    f.seek(section['offset'])
+                    arrays[name] = numpy.fromfile(f, dtype=dtype, count=int(numpy.prod(shape))).reshape(shape)
+        return CohortMesh(header['caseNames'], arrays['points'], arrays['triangles'], arrays['offsets'])
+
+    def getCaseNames(self):
+        return list(self.case_names)
+
+    def getLabels(self, case_name=None):
+        # Labels of a case, or of the whole cohort
+        if case_name is None:
+            return sorted(set(int(label) for label in self.offsets[:, CohortMesh.LABEL]))
+        case_index = self.case_indices[case_name]
+        return [int(row[CohortMesh.LABEL]) for row in self.offsets if row[CohortMesh.CASE] == case_index]
+
+    def getNumberOfMeshes(self):
+        return self.offsets.shape[0]
+
+    def hasMesh(self, case_name, label):
+        return (case_name, label) in self.rows
+
+    def getPoints(self, case_name, label):
+        # (N, 3) view of the points of a mesh
+        row = self.offsets[self.rows[(case_name, label)]]
+        start = int(row[CohortMesh.POINT_OFFSET])
+        return self.points[start:start + int(row[CohortMesh.NUMBER_OF_POINTS])]
+
+    def getTriangles(self, case_name, label):
+        # (M, 3) view of the triangles of a mesh, as ids into its own points
+        row = self.offsets[self.rows[(case_name, label)]]
+        start = int(row[CohortMesh.TRIANGLE_OFFSET])
+        return self.triangles[start:start + int(row[CohortMesh.NUMBER_OF_TRIANGLES])]
+
+    def getPolyData(self, case_name, label):
+        # Builds a new polydata, its arrays are copies so it stays valid after the file is closed
+        points_array = numpy.array(self.getPoints(case_name, label))
+        triangles = self.getTriangles(case_name, label)
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(points_array, deep=1))
+
+        cells = numpy.empty((triangles.shape[0], 4), dtype=ID_TYPE)
+        cells[:, 0] = 3
+        cells[:, 1:] = triangles
+        polys = vtk.vtkCellArray()
+        polys.SetCells(triangles.shape[0], numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=1))
+
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(points)
+        polydata.SetPolys(polys)
+        return polydata
+
+    def getStatistics(self):
+        return {
+            'cases': len(self.case_names),
+            'meshes': self.getNumberOfMeshes(),
+            'points': self.points.shape[0],
+            'triangles': self.triangles.shape[0],
+            'bytes': self.points.nbytes + self.triangles.nbytes + self.offsets.nbytes,
+        }
+
+    @staticmethod
+    def _align(position):
+        return (position + CohortMesh.ALIGNMENT - 1) // CohortMesh.ALIGNMENT * CohortMesh.ALIGNMENT
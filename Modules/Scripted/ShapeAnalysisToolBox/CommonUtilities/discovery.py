@@ -0,0 +1,174 @@
+import fnmatch
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from surface import SurfaceUtility
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for Python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+#
+# DirectoryListingCache
+#
+'''
+Cache of the entries of directories, reused as long as the modification time of
+a directory does not change. Listings use scandir when it is available, which
+knows the type of each entry without an extra stat call.
+'''
+
+
+class DirectoryListingCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}  # directory -> (modification time, list of (name, is directory))
+        self.hits = 0
+        self.misses = 0
+
+    def listDirectory(self, directory):
+        # Returns the list of (name, is directory) of the entries of a directory, empty if it cannot be read
+        try:
+            modification_time = os.stat(directory).st_mtime
+        except OSError:
+            return []
+        with self.lock:
+            listing = self.listings.get(directory)
+            if listing is not None and listing[0] == modification_time:
+                self.hits += 1
+                return listing[1]
+            self.misses += 1
+        try:
+            if scandir is not None:
+                entries = [(entry.name, entry.is_dir()) for entry in scandir(directory)]
+            else:
+                entries = [(name, os.path.isdir(os.path.join(directory, name))) for name in os.listdir(directory)]
+        except OSError:
+            return []
+        entries.sort()
+        with self.lock:
+            self.listings[directory] = (modification_time, entries)
+        return entries
+
+    def clear(self):
+        with self.lock:
+            self.listings = {}
+            self.hits = 0
+            self.misses = 0
+
+    def getStatistics(self):
+        with self.lock:
+            return {'directories': len(self.listings), 'hits': self.hits, 'misses': self.misses}
+
+
+#
+# CaseDiscoveryUtility
+#
+'''
+This class harbors the functions to find the labelmaps of a study from the
+directory layout of the tool that produced them, or the surfaces of a study
+'''
+
+
+class CaseDiscoveryUtility(object):
+    LABELMAP_EXTENSIONS = ['.nrrd', '.nhdr', '.nii', '.nii.gz', '.mgz', '.mha', '.mhd', '.gipl', '.gipl.gz']
+    INPUT_EXTENSIONS = LABELMAP_EXTENSIONS + SurfaceUtility.SURFACE_EXTENSIONS
+
+    # Groups of patterns of the labelmaps relative to the study root, '*' matches any name at its level.
+    # The groups of a layout are tried in order, the files of a subject come from the first group
+    # that matches in this subject.
+    LAYOUTS = {
+        'FreeSurfer': [['*/mri/aseg.mgz']],
+        'FSL': [['*_all_fast_firstseg.nii.gz', '*/*_all_fast_firstseg.nii.gz'], ['*_seg.nii.gz', '*/*_seg.nii.gz']],
+        'Autoseg': [['*/AutoSeg*/*/*AllROIs*.nrrd', '*/*AllROIs*.nrrd', '*AllROIs*.nrrd']],
+        # Labelmaps or surfaces
+        'General VTK': [['*' + extension for extension in INPUT_EXTENSIONS] +
+                        ['*/*' + extension for extension in INPUT_EXTENSIONS]],
+    }
+
+    listing_cache = DirectoryListingCache()
+
+    @staticmethod
+    def getLayoutPatterns(layout, file_name_pattern=''):
+        # Pattern groups of a layout, with the file names replaced by file_name_pattern if one is
+        # given, e.g. aparc+aseg.mgz for FreeSurfer
+        groups = CaseDiscoveryUtility.LAYOUTS[layout]
+        if not file_name_pattern:
+            return [list(group) for group in groups]
+        replaced_group = []
+        for group in groups:
+            for pattern in group:
+                replaced_pattern = '/'.join(pattern.split('/')[:-1] + [file_name_pattern])
+                if replaced_pattern not in replaced_group:
+                    replaced_group.append(replaced_pattern)
+        return [replaced_group]
+
+    @staticmethod
+    def discoverCases(root_dir, layout, file_name_pattern='', number_of_workers=16):
+        # Returns the list of (case name, file path) of the labelmaps found under root_dir, sorted by path.
+        # The directories of each level are listed in parallel, which hides the latency of network storage.
+        root_dir = os.path.abspath(root_dir)
+        pool = ThreadPool(number_of_workers) if number_of_workers > 1 else None
+        try:
+            matches = {}  # subject -> (index of the group, paths matched by this group)
+            groups = CaseDiscoveryUtility.getLayoutPatterns(layout, file_name_pattern)
+            for group_index, group in enumerate(groups):
+                for pattern in group:
+                    for file_path in CaseDiscoveryUtility.findFiles(root_dir, pattern, pool):
+                        subject = os.path.relpath(file_path, root_dir).split(os.sep)[0]
+                        paths = matches.setdefault(subject, (group_index, []))
+                        if paths[0] == group_index:
+                            paths[1].append(file_path)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        cases = []
+        for subject in sorted(matches.keys()):
+            file_paths = sorted(matches[subject][1])
+            for file_path in file_paths:
+                if len(file_paths) == 1:
+                    # The subject directory, or the file itself at the root, names the case
+                    case_name = subject
+                else:
+                    case_name = CaseDiscoveryUtility.stripExtension(os.path.relpath(file_path, root_dir))
+                    case_name = case_name.replace(os.sep, '_')
+                cases.append((case_name, file_path))
+        return cases
+
+    @staticmethod
+    def findFiles(root_dir, pattern, pool=None):
+        # Paths of the files matching a pattern relative to root_dir, one directory level at a time
+        directories = [root_dir]
+        components = pattern.split('/')
+        for level, component in enumerate(components):
+            is_last_level = level == len(components) - 1
+            if pool is not None and len(directories) > 1:
+                listings = pool.map(CaseDiscoveryUtility.listing_cache.listDirectory, directories)
+            else:
+                listings = [CaseDiscoveryUtility.listing_cache.listDirectory(directory) for directory in directories]
+            matched = []
+            for directory, entries in zip(directories, listings):
+                for name, is_directory in entries:
+                    # Directories are only followed at the intermediate levels, files only match at the last one
+                    if is_directory != is_last_level and fnmatch.fnmatch(name, component) and \
+                            not name.startswith('.'):
+                        matched.append(os.path.join(directory, name))
+            directories = matched
+        return directories
+
+    @staticmethod
+    def stripExtension(file_name):
+        for extension in sorted(CaseDiscoveryUtility.INPUT_EXTENSIONS, key=len, reverse=True):
+            if file_name.lower().endswith(extension):
+                return file_name[:-len(extension)]
+        return file_name
+
+    @staticmethod
+    def getListingStatistics():
+        return CaseDiscoveryUtility.listing_cache.getStatistics()
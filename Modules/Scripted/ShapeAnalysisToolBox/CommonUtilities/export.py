@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+#
+# ExportUtility
+#
+'''
+This class harbors the functions to write many files with a pool of writers and
+describe them in a manifest
+'''
+
+
+class ExportUtility(object):
+    MANIFEST_FILE_NAME = 'manifest.json'
+
+    @staticmethod
+    def writeFiles(jobs, number_of_workers=1):
+        # Each job is a dictionary with the 'file' to write and a 'write' function that takes the
+        # file path and returns True on success. Jobs with 'serial' set run on the calling thread,
+        # while the pool writes the others. The other keys are copied to the manifest entries.
+        # Returns the manifest entries, in the order of the jobs, and the statistics of the export.
+        start_time = time.time()
+        entries = [None] * len(jobs)
+        serial_indices = [i for i, job in enumerate(jobs) if job.get('serial', False)]
+        parallel_indices = [i for i, job in enumerate(jobs) if not job.get('serial', False)]
+        if number_of_workers > 1 and len(parallel_indices) > 1:
+            pool = ThreadPool(min(number_of_workers, len(parallel_indices)))
+            try:
+                parallel_entries = pool.map_async(ExportUtility._runJob, [jobs[i] for i in parallel_indices])
+                for i in serial_indices:
+                    entries[i] = ExportUtility._runJob(jobs[i])
+                for i, entry in zip(parallel_indices, parallel_entries.get()):
+                    entries[i] = entry
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries = [ExportUtility._runJob(job) for job in jobs]
+        elapsed_time = time.time() - start_time
+
+        written_entries = [entry for entry in entries if entry['written']]
+        written_size = sum(entry['size'] for entry in written_entries)
+        statistics = {
+            'files': len(written_entries),
+            'failed': len(entries) - len(written_entries),
+            'size': written_size,
+            'seconds': elapsed_time,
+            'filesPerSecond': len(written_entries) / elapsed_time if elapsed_time > 0 else 0.0,
+            'megabytesPerSecond': written_size / 1024.0 ** 2 / elapsed_time if elapsed_time > 0 else 0.0,
+        }
+        return entries, statistics
+
+    @staticmethod
+    def writeManifest(output_dir, entries, statistics, manifest_file_name=MANIFEST_FILE_NAME):
+        # File paths are written relative to the manifest
+        manifest_entries = []
+        for entry in entries:
+            manifest_entry = dict(entry)
+            manifest_entry['file'] = os.path.relpath(entry['file'], output_dir)
+            manifest_entries.append(manifest_entry)
+        manifest_path = os.path.join(output_dir, manifest_file_name)
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({'files': manifest_entries, 'statistics': statistics}, manifest_file, indent=1)
+        return manifest_path
+
+    @staticmethod
+    def formatStatistics(statistics):
+        return '%d files (%.1f MB) written in %.1f s: %.1f files/s, %.1f MB/s, %d failed' % (
+            statistics['files'], statistics['size'] / 1024.0 ** 2, statistics['seconds'],
+            statistics['filesPerSecond'], statistics['megabytesPerSecond'], statistics['failed'])
+
+    @staticmethod
+    def _runJob(job):
+        entry = dict((key, value) for key, value in job.items() if key not in ['write', 'serial'])
+        entry['written'] = False
+        entry['size'] = 0
+        file_dir = os.path.dirname(job['file'])
+        try:
+            if file_dir and not os.path.isdir(file_dir):
+                try:
+                    os.makedirs(file_dir)
+                except OSError:
+                    # Created by another writer in the meantime
+                    if not os.path.isdir(file_dir):
+                        raise
+            entry['written'] = bool(job['write'](job['file']))
+        except Exception as e:
+            entry['error'] = str(e)
+        if entry['written']:
+            entry['size'] = os.path.getsize(job['file'])
+        else:
+            logging.error('!!! Failed to write %s %s', job['file'], entry.get('error', ''))
+        return entry
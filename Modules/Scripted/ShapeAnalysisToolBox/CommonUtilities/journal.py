@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from cache import CaseRecordUtility
+
+#
+# ImportJournal
+#
+'''
+Journal of the cases of an import whose surfaces and topology are complete. Each
+finished case is written as a case record, then appended to an index that is
+synced to disk, so an import that was interrupted resumes after the last case
+that was recorded. Cases whose input file changed since they were recorded, or
+recorded with other processing parameters, are processed again. The journal is
+cleared once its import finished, and the journals of the cohorts that were not
+imported for the longest time are evicted past a maximum size.
+'''
+
+
+class ImportJournal(object):
+    INDEX_FILE_NAME = 'journal.jsonl'
+    PARAMETERS_FILE_NAME = 'parameters.json'
+    SIGNATURE_BLOCK_SIZE = 64 * 1024
+    MAXIMUM_COHORTS_SIZE = 2 * 1024 ** 3  # Journals of all the cohorts of a directory, see evictCohortDirectories
+
+    def __init__(self, journal_dir):
+        self.journal_dir = journal_dir
+        self.lock = threading.RLock()
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        self.entries = {}  # case name -> {'signature': signature of the input, 'record': record directory}
+        self.parameters = None
+        self.resumed = 0
+        self.stale = 0
+        self.recorded = 0
+        self._readIndex()
+
+    @staticmethod
+    def getCohortDirectory(parent_dir, file_paths):
+        # Journal directory of a list of input files, the same cohort imported again resumes from it
+        paths_hash = hashlib.sha1('\n'.join(os.path.abspath(path) for path in file_paths).encode('utf-8'))
+        return os.path.join(parent_dir, paths_hash.hexdigest()[:16])
+
+    @staticmethod
+    def evictCohortDirectories(parent_dir, max_size=MAXIMUM_COHORTS_SIZE, keep_dir=None):
+        # Removes the empty journals of parent_dir, then the others, the least recently used first, until all
+        # the journals take at most max_size bytes. The journal of keep_dir is kept. Returns the removed
+        # directories.
+        if not os.path.isdir(parent_dir):
+            return []
+        keep_dir = os.path.abspath(keep_dir) if keep_dir is not None else None
+        size = 0
+        journals = []
+        for name in os.listdir(parent_dir):
+            journal_dir = os.path.join(parent_dir, name)
+            if not os.path.isdir(journal_dir):
+                continue
+            journal_size = CaseRecordUtility.getDirectorySize(journal_dir)
+            size += journal_size
+            if os.path.abspath(journal_dir) != keep_dir:
+                index_path = os.path.join(journal_dir, ImportJournal.INDEX_FILE_NAME)
+                last_use = os.path.getmtime(index_path if os.path.isfile(index_path) else journal_dir)
+                journals.append((journal_size > 0, last_use, journal_dir, journal_size))
+        removed = []
+        for not_empty, _, journal_dir, journal_size in sorted(journals):
+            if not_empty and size <= max_size:
+                break
+            shutil.rmtree(journal_dir, ignore_errors=True)
+            size -= journal_size
+            removed.append(journal_dir)
+        return removed
+
+    @staticmethod
+    def computeSignature(file_path):
+        # Size, modification time and hash of the first block of a file. This is cheap enough to check
+        # all the cases of a cohort when an import resumes, and the header block covers most rewrites
+        # that keep the size and time of a file.
+        stat = os.stat(file_path)
+        with open(file_path, 'rb') as input_file:
+            block_hash = hashlib.sha1(input_file.read(ImportJournal.SIGNATURE_BLOCK_SIZE)).hexdigest()
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': block_hash}
+
+    def begin(self, parameters):
+        # The recorded cases are only reused if they were processed with the same parameters
+        with self.lock:
+            if self.parameters is not None and self.parameters != parameters:
+                logging.warning('Processing parameters changed, restarting the import journal %s', self.journal_dir)
+                self.clear()
+            self.parameters = parameters
+            with open(os.path.join(self.journal_dir, self.PARAMETERS_FILE_NAME), 'w') as parameters_file:
+                json.dump(parameters, parameters_file)
+            self.resumed = 0
+            self.stale = 0
+            self.recorded = 0
+
+    def load(self, case_name, signature):
+        # Record of a finished case, None if it was not recorded or its input changed
+        with self.lock:
+            entry = self.entries.get(case_name)
+            if entry is None:
+                return None
+            if entry['signature'] != signature:
+                self.stale += 1
+                return None
+        record = CaseRecordUtility.readCaseRecord(os.path.join(self.journal_dir, entry['record']))
+        with self.lock:
+            if record is None:
+                self.entries.pop(case_name, None)
+                return None
+            self.resumed += 1
+            return record
+
+    def record(self, case_name, signature, record):
+        record_name = hashlib.sha1(case_name.encode('utf-8')).hexdigest()
+        record_dir = os.path.join(self.journal_dir, record_name)
+        with self.lock:
+            self.entries.pop(case_name, None)
+        if os.path.isdir(record_dir):
+            shutil.rmtree(record_dir, ignore_errors=True)
+        if not CaseRecordUtility.writeCaseRecord(record_dir, record):
+            shutil.rmtree(record_dir, ignore_errors=True)
+            return False
+        entry = {'case': case_name, 'signature': signature, 'record': record_name}
+        with self.lock:
+            # The case only counts as finished once its line reached the disk
+            with open(os.path.join(self.journal_dir, self.INDEX_FILE_NAME), 'a') as index_file:
+                index_file.write(json.dumps(entry) + '\n')
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            self.entries[case_name] = {'signature': signature, 'record': record_name}
+            self.recorded += 1
+        return True
+
+    def getRecordedCaseNames(self):
+        with self.lock:
+            return sorted(self.entries.keys())
+
+    def clear(self):
+        # Removes all the cases, e.g. once the import finished and there is nothing left to resume
+        with self.lock:
+            self.entries = {}
+            for name in os.listdir(self.journal_dir):
+                path = os.path.join(self.journal_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+    def getStatistics(self):
+        with self.lock:
+            return {
+                'cases': len(self.entries),
+                'resumed': self.resumed,
+                'stale': self.stale,
+                'recorded': self.recorded,
+            }
+
+    def _readIndex(self):
+        parameters_path = os.path.join(self.journal_dir, self.PARAMETERS_FILE_NAME)
+        if os.path.isfile(parameters_path):
+            try:
+                with open(parameters_path, 'r') as parameters_file:
+                    self.parameters = json.load(parameters_file)
+            except ValueError:
+                logging.warning('Ignoring corrupted import journal parameters: %s', parameters_path)
+        index_path = os.path.join(self.journal_dir, self.INDEX_FILE_NAME)
+        if not os.path.isfile(index_path):
+            return
+        complete_size = 0
+        with open(index_path, 'rb') as index_file:
+            for line in index_file:
+                if not line.endswith(b'\n'):
+                    # The last line is cut if the import stopped while it was written
+                    break
+                complete_size += len(line)
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logging.warning('Ignoring corrupted import journal entry in %s', index_path)
+                    continue
+                # A case recorded again replaces its previous entry
+                self.entries[entry['case']] = {'signature': entry['signature'], 'record': entry['record']}
+        if complete_size < os.path.getsize(index_path):
+            # The next entries are appended after the last complete line
+            with open(index_path, 'rb+') as index_file:
+                index_file.truncate(complete_size)
@@ -0,0 +1,182 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+#
+# LabelMapUtility
+#
+'''
+This class harbors the functions to inspect the labels of labelmaps
+'''
+
+
+class LabelMapUtility(object):
+    # Above this many values between the smallest and largest label, the counts are computed by
+    # sorting the voxels instead of with a dense histogram
+    MAXIMUM_HISTOGRAM_SIZE = 1 << 24
+
+    @staticmethod
+    def readLabelmap(file_path):
+        # Reads the voxels of a labelmap file with the reader of the volume storage nodes, without any
+        # MRML node, so this can run in a worker thread. Returns the image data, with a zero origin and
+        # unit spacing as in volume nodes, and its IJK to RAS matrix, or (None, None) if the file cannot
+        # be read.
+        import vtkITK
+        reader = vtkITK.vtkITKArchetypeImageSeriesScalarReader()
+        reader.SetArchetype(file_path)
+        reader.SetSingleFile(1)
+        reader.SetOutputScalarTypeToNative()
+        reader.SetDesiredCoordinateOrientationToNative()
+        reader.SetUseNativeOriginOn()
+        reader.Update()
+        if reader.GetErrorCode() != vtk.vtkErrorCode.NoError or reader.GetOutput().GetNumberOfPoints() == 0:
+            return None, None
+
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Invert(reader.GetRasToIjkMatrix(), ijk_to_ras)
+        # The geometry is in the matrix, the image data only keeps the voxels, as the storage node does
+        image_data = vtk.vtkImageData()
+        image_data.ShallowCopy(reader.GetOutput())
+        image_data.SetOrigin(0, 0, 0)
+        image_data.SetSpacing(1, 1, 1)
+        return image_data, ijk_to_ras
+
+    @staticmethod
+    def getLabelCounts(image_data):
+        # Returns a dictionary label -> number of voxels, for the labels present in the image,
+        # background included. The voxels are visited once.
+        scalars = image_data.GetPointData().GetScalars()
+        if scalars is None or scalars.GetNumberOfTuples() == 0:
+            return {}
+        return LabelMapUtility.getArrayLabelCounts(numpy_support.vtk_to_numpy(scalars).ravel())
+
+    @staticmethod
+    def getArrayLabelCounts(voxels):
+        # Same as getLabelCounts for a flat array of voxels, e.g. memory-mapped from a file
+        if voxels.size == 0:
+            return {}
+        if voxels.dtype.kind == 'f':
+            voxels = numpy.rint(voxels).astype(numpy.int64)
+
+        minimum = int(voxels.min())
+        maximum = int(voxels.max())
+        if maximum - minimum < LabelMapUtility.MAXIMUM_HISTOGRAM_SIZE:
+            if minimum == 0 and voxels.dtype.kind == 'u' and voxels.dtype.isnative and \
+                    voxels.dtype.itemsize < 8:
+                histogram = numpy.bincount(voxels)
+            else:
+                histogram = numpy.bincount(voxels.astype(numpy.int64) - minimum)
+            labels = numpy.flatnonzero(histogram)
+            counts = histogram[labels]
+            labels = labels + minimum
+        else:
+            labels, counts = numpy.unique(voxels, return_counts=True)
+        return dict((int(label), int(count)) for label, count in zip(labels, counts))
+
+    @staticmethod
+    def getStructureLabels(label_counts, background=0):
+        # Sorted labels of the structures, without the background
+        return sorted(label for label in label_counts.keys() if label != background)
+
+    @staticmethod
+    def getLabelRange(label_counts):
+        if len(label_counts) == 0:
+            return (-1, -1)
+        return (min(label_counts.keys()), max(label_counts.keys()))
+
+    @staticmethod
+    def getLabelBounds(voxels, labels):
+        # Bounding box of each label in an array indexed [k, j, i], as a dictionary
+        # label -> (k min, k max, j min, j max, i min, i max). Each axis is a single histogram pass.
+        labels = numpy.array(sorted(labels), dtype=numpy.int64)
+        if len(labels) == 0:
+            return {}
+        minimum = min(int(voxels.min()), int(labels[0]))
+        maximum = max(int(voxels.max()), int(labels[-1]))
+        # 32 bits indices halve the memory of the passes over large volumes
+        index_type = numpy.int32 if (len(labels) + 1) * max(voxels.shape) < 2 ** 31 else numpy.int64
+        if maximum - minimum < LabelMapUtility.MAXIMUM_HISTOGRAM_SIZE:
+            lookup = numpy.full(maximum - minimum + 1, len(labels), dtype=index_type)
+            lookup[labels - minimum] = numpy.arange(len(labels))
+            offset_type = numpy.int32 if voxels.dtype.itemsize < 4 else numpy.int64
+            indices = lookup[voxels.astype(offset_type) - minimum]
+        else:
+            indices = numpy.searchsorted(labels, voxels).astype(index_type)
+            indices[labels[numpy.minimum(indices, len(labels) - 1)] != voxels] = len(labels)
+
+        bounds = numpy.zeros((len(labels), 6), dtype=numpy.int64)
+        for axis in range(3):
+            size = voxels.shape[axis]
+            shape = [1, 1, 1]
+            shape[axis] = size
+            positions = (indices * size + numpy.arange(size, dtype=index_type).reshape(shape)).ravel()
+            present = numpy.bincount(positions, minlength=(len(labels) + 1) * size).reshape(-1, size)[:-1] > 0
+            bounds[:, 2 * axis] = present.argmax(axis=1)
+            bounds[:, 2 * axis + 1] = size - 1 - present[:, ::-1].argmax(axis=1)
+        present = numpy.bincount(indices.ravel(), minlength=len(labels) + 1)[:-1] > 0
+        return dict((int(label), tuple(int(x) for x in bounds[index]))
+                    for index, label in enumerate(labels) if present[index])
+
+    @staticmethod
+    def filterComponents(image_data, labels, fill_holes=False, maximum_hole_size=1000):
+        # Keeps the largest 6-connected component of each label, the voxels of the other components become
+        # background. With fill_holes, the cavities of a label made of at most maximum_hole_size background
+        # voxels are filled. The image data is modified in place. Returns a dictionary label -> number of
+        # 'components' before filtering, 'removedVoxels' and 'filledVoxels'.
+        scalars = image_data.GetPointData().GetScalars()
+        if scalars is None or len(labels) == 0:
+            return {}
+        dimensions = image_data.GetDimensions()
+        voxels = numpy_support.vtk_to_numpy(scalars).reshape(dimensions[2], dimensions[1], dimensions[0])
+        statistics = {}
+        for label, bounds in sorted(LabelMapUtility.getLabelBounds(voxels, labels).items()):
+            # Only the bounding box of the label is labeled
+            block = voxels[bounds[0]:bounds[1] + 1, bounds[2]:bounds[3] + 1, bounds[4]:bounds[5] + 1]
+            mask = block == label
+            components, number_of_components = LabelMapUtility.labelComponents(mask)
+            removed = mask & (components != 1)
+            block[removed] = 0
+            label_statistics = {'components': number_of_components, 'removedVoxels': int(removed.sum()),
+                                'filledVoxels': 0}
+            if fill_holes:
+                label_statistics['filledVoxels'] = LabelMapUtility._fillHoles(block, label, maximum_hole_size)
+            statistics[label] = label_statistics
+        scalars.Modified()
+        return statistics
+
+    @staticmethod
+    def labelComponents(mask):
+        # Labels the 6-connected components of a boolean array by decreasing size from 1, 0 outside the mask.
+        # Returns the labels and the number of components.
+        image = vtk.vtkImageData()
+        image.SetDimensions(mask.shape[2], mask.shape[1], mask.shape[0])
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel().view(numpy.uint8), deep=1))
+        connectivity = vtk.vtkImageConnectivityFilter()
+        connectivity.SetInputData(image)
+        connectivity.SetScalarRange(1, 1)
+        connectivity.SetExtractionModeToAllRegions()
+        connectivity.SetLabelModeToSizeRank()
+        connectivity.SetLabelScalarTypeToInt()
+        connectivity.Update()
+        components = numpy_support.vtk_to_numpy(connectivity.GetOutput().GetPointData().GetScalars())
+        return components.reshape(mask.shape), connectivity.GetNumberOfExtractedRegions()
+
+    @staticmethod
+    def _fillHoles(block, label, maximum_hole_size):
+        # The components of the other voxels of the padded block that do not touch its border are
+        # the cavities of the label, only those made of background are filled
+        outside = numpy.pad(block != label, 1, mode='constant', constant_values=True)
+        components, number_of_components = LabelMapUtility.labelComponents(outside)
+        if number_of_components < 2:
+            return 0
+        # The padding is part of the component that surrounds the label
+        surrounding_component = components[0, 0, 0]
+        components = components[1:-1, 1:-1, 1:-1]
+        sizes = numpy.bincount(components.ravel(), minlength=number_of_components + 1)
+        other_labels = numpy.bincount(components[(block != label) & (block != 0)], minlength=number_of_components + 1)
+        is_hole = (sizes <= maximum_hole_size) & (other_labels == 0)
+        is_hole[0] = False
+        is_hole[surrounding_component] = False
+        holes = is_hole[components]
+        block[holes] = label
+        return int(holes.sum())
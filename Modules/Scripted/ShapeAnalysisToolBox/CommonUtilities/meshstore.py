@@ -0,0 +1,162 @@
+import collections
+import os
+import shutil
+import tempfile
+import threading
+from surface import SurfaceUtility
+
+#
+# MeshStore
+#
+'''
+Store of the per-case, per-label meshes with a memory budget. The most recently
+used meshes stay in memory, the others are spilled to compressed files on disk
+and read back when they are requested again.
+'''
+
+
+class MeshStore(object):
+    def __init__(self, memory_budget=4 * 1024 ** 3, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.owns_spill_dir = False
+        self.lock = threading.RLock()
+        self.labels = collections.OrderedDict()  # case name -> list of labels
+        self.resident = collections.OrderedDict()  # (case name, label) -> (polydata, size), least recent first
+        self.spilled = {}  # (case name, label) -> (file path, size on disk)
+        self.reloads = 0
+        self.next_file_id = 0
+
+    def setMemoryBudget(self, memory_budget):
+        with self.lock:
+            self.memory_budget = memory_budget
+            self._spill()
+
+    def setMesh(self, case_name, label, polydata):
+        key = (case_name, label)
+        with self.lock:
+            self._forget(key)
+            labels = self.labels.setdefault(case_name, [])
+            if label not in labels:
+                labels.append(label)
+            self.resident[key] = (polydata, polydata.GetActualMemorySize() * 1024)
+            self._spill()
+
+    def setMeshes(self, case_name, meshes):
+        for label in sorted(meshes.keys()):
+            self.setMesh(case_name, label, meshes[label])
+
+    def getMesh(self, case_name, label):
+        key = (case_name, label)
+        with self.lock:
+            if key in self.resident:
+                entry = self.resident.pop(key)
+                self.resident[key] = entry
+                return entry[0]
+            if key not in self.spilled:
+                return None
+            polydata = SurfaceUtility.readPolyData(self.spilled[key][0])
+            if polydata is None:
+                return None
+            self.reloads += 1
+            # The spilled file is kept so that the mesh can be dropped again without writing it
+            self.resident[key] = (polydata, polydata.GetActualMemorySize() * 1024)
+            self._spill(keep=key)
+            return polydata
+
+    def getMeshes(self, case_name):
+        return dict((label, self.getMesh(case_name, label)) for label in self.getLabels(case_name))
+
+    def hasMesh(self, case_name, label):
+        with self.lock:
+            return (case_name, label) in self.resident or (case_name, label) in self.spilled
+
+    def hasCase(self, case_name):
+        with self.lock:
+            return case_name in self.labels
+
+    def getLabels(self, case_name):
+        with self.lock:
+            return list(self.labels.get(case_name, []))
+
+    def getCaseNames(self):
+        with self.lock:
+            return list(self.labels.keys())
+
+    def removeMesh(self, case_name, label):
+        with self.lock:
+            labels = self.labels.get(case_name, [])
+            if label in labels:
+                labels.remove(label)
+                self._forget((case_name, label))
+
+    def removeCase(self, case_name):
+        with self.lock:
+            for label in self.labels.pop(case_name, []):
+                self._forget((case_name, label))
+
+    def clear(self):
+        with self.lock:
+            self.labels.clear()
+            self.resident.clear()
+            self.spilled.clear()
+            self.reloads = 0
+            if self.owns_spill_dir and self.spill_dir is not None:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+                self.spill_dir = None
+                self.owns_spill_dir = False
+
+    def getResidentSize(self):
+        with self.lock:
+            return sum(size for _, size in self.resident.values())
+
+    def getSpilledSize(self):
+        with self.lock:
+            return sum(size for key, (_, size) in self.spilled.items() if key not in self.resident)
+
+    def getStatistics(self):
+        with self.lock:
+            return {
+                'memoryBudget': self.memory_budget,
+                'residentMeshes': len(self.resident),
+                'residentSize': self.getResidentSize(),
+                'spilledMeshes': len([key for key in self.spilled if key not in self.resident]),
+                'spilledSize': self.getSpilledSize(),
+                'reloads': self.reloads,
+            }
+
+    def _forget(self, key):
+        self.resident.pop(key, None)
+        spilled = self.spilled.pop(key, None)
+        if spilled is not None and os.path.exists(spilled[0]):
+            os.remove(spilled[0])
+
+    def _spill(self, keep=None):
+        resident_size = self.getResidentSize()
+        for key in list(self.resident.keys()):
+            if resident_size <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            polydata, size = self.resident.pop(key)
+            if key not in self.spilled:
+                file_path = os.path.join(self._getSpillDirectory(), '%08d.vtp' % self.next_file_id)
+                self.next_file_id += 1
+                if not SurfaceUtility.writePolyData(polydata, file_path):
+                    # Keep the mesh in memory rather than losing it
+                    self.resident[key] = (polydata, size)
+                    break
+                self.spilled[key] = (file_path, os.path.getsize(file_path))
+            resident_size -= size
+
+    def _getSpillDirectory(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='MeshStore')
+            self.owns_spill_dir = True
+        elif not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        return self.spill_dir
+
+    def __del__(self):
+        if self.owns_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,169 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+#
+# PipelineProfiler
+#
+'''
+Records the wall time and memory delta of each stage of each case, with the sizes
+the stages add to their record. The records are summarized per stage and per case,
+and can be written as a trace that chrome://tracing or Perfetto can open.
+'''
+
+
+class PipelineProfiler(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.records = []
+        self.origin = time.time()
+        self.peak_memory = 0  # Largest resident memory seen at the start or end of a stage since clear()
+
+    @staticmethod
+    def getResidentMemory():
+        # Resident memory of the process in bytes, None if it cannot be read on this platform
+        if psutil is not None:
+            return psutil.Process(os.getpid()).memory_info().rss
+        try:
+            with open('/proc/self/statm', 'r') as statm_file:
+                return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError, IndexError, AttributeError):
+            return None
+
+    @staticmethod
+    def getPeakResidentMemory():
+        # Largest resident memory of the process since it started in bytes, None if it is not available
+        if psutil is not None:
+            memory_info = psutil.Process(os.getpid()).memory_info()
+            if hasattr(memory_info, 'peak_wset'):
+                # Windows
+                return memory_info.peak_wset
+        if resource is None:
+            return None
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak_memory if sys.platform == 'darwin' else peak_memory * 1024
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+            self.origin = time.time()
+            self.peak_memory = 0
+
+    @contextlib.contextmanager
+    def stage(self, case_name, stage_name, **details):
+        # Times the block. The yielded dictionary is the record of the stage, sizes can be added to it.
+        # The memory delta is the one of the whole process, so it includes the other threads.
+        record = dict(details)
+        if not self.enabled:
+            yield record
+            return
+        memory = PipelineProfiler.getResidentMemory()
+        start_time = time.time()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.time() - start_time
+            record['start'] = start_time - self.origin
+            record['case'] = case_name
+            record['stage'] = stage_name
+            record['thread'] = threading.current_thread().name
+            if memory is not None:
+                end_memory = PipelineProfiler.getResidentMemory()
+                record['memoryDelta'] = end_memory - memory
+            with self.lock:
+                self.records.append(record)
+                if memory is not None:
+                    self.peak_memory = max(self.peak_memory, memory, end_memory)
+
+    def getPeakMemory(self):
+        # Largest resident memory sampled by the stages since clear(), 0 if nothing was sampled
+        with self.lock:
+            return self.peak_memory
+
+    def getRecords(self, case_name=None, stage_name=None):
+        with self.lock:
+            return [record for record in self.records
+                    if (case_name is None or record['case'] == case_name) and
+                    (stage_name is None or record['stage'] == stage_name)]
+
+    def getStageSummary(self):
+        # Dictionary stage -> count, total, mean and max durations, largest memory delta
+        summary = {}
+        for record in self.getRecords():
+            stage_summary = summary.setdefault(record['stage'], {'count': 0, 'total': 0.0, 'max': 0.0,
+                                                                 'maxCase': None, 'maxMemoryDelta': 0})
+            stage_summary['count'] += 1
+            stage_summary['total'] += record['duration']
+            if record['duration'] >= stage_summary['max']:
+                stage_summary['max'] = record['duration']
+                stage_summary['maxCase'] = record['case']
+            stage_summary['maxMemoryDelta'] = max(stage_summary['maxMemoryDelta'], record.get('memoryDelta', 0))
+        for stage_summary in summary.values():
+            stage_summary['mean'] = stage_summary['total'] / stage_summary['count']
+        return summary
+
+    def getCaseDurations(self):
+        # Dictionary case -> total duration of its stages
+        durations = {}
+        for record in self.getRecords():
+            durations[record['case']] = durations.get(record['case'], 0.0) + record['duration']
+        return durations
+
+    def getSlowestCases(self, number_of_cases=5):
+        durations = self.getCaseDurations()
+        return sorted(durations.items(), key=lambda item: item[1], reverse=True)[:number_of_cases]
+
+    def formatSummary(self, number_of_cases=5):
+        summary = self.getStageSummary()
+        lines = ['%-28s %6s %10s %10s %10s %10s  %s' % ('Stage', 'Count', 'Total (s)', 'Mean (s)', 'Max (s)',
+                                                        'Max mem MB', 'Slowest case')]
+        for stage_name, stage_summary in sorted(summary.items(), key=lambda item: item[1]['total'], reverse=True):
+            lines.append('%-28s %6d %10.3f %10.4f %10.4f %10.1f  %s' % (
+                stage_name, stage_summary['count'], stage_summary['total'], stage_summary['mean'],
+                stage_summary['max'], stage_summary['maxMemoryDelta'] / 1024.0 ** 2, stage_summary['maxCase']))
+        for case_name, duration in self.getSlowestCases(number_of_cases):
+            lines.append('Slow case: %s %.3f s' % (case_name, duration))
+        return '\n'.join(lines)
+
+    def writeTrace(self, file_path):
+        # Chrome trace event format, one complete event per record, times in microseconds
+        thread_ids = {}
+        events = []
+        for record in self.getRecords():
+            thread_id = thread_ids.setdefault(record['thread'], len(thread_ids))
+            events.append({
+                'name': record['stage'],
+                'cat': 'DataImporter',
+                'ph': 'X',
+                'ts': record['start'] * 1e6,
+                'dur': record['duration'] * 1e6,
+                'pid': os.getpid(),
+                'tid': thread_id,
+                'args': dict((key, value) for key, value in record.items()
+                             if key not in ['stage', 'start', 'duration', 'thread']),
+            })
+        for thread_name, thread_id in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id,
+                           'args': {'name': thread_name}})
+        with open(file_path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
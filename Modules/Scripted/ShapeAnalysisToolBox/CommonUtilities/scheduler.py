@@ -0,0 +1,122 @@
+import heapq
+import threading
+
+#
+# PriorityTaskPool
+#
+'''
+Pool of worker threads that run the tasks with the smallest priority first. The
+priority of a task can change until it starts, and the results are kept until
+the owner collects them, typically from a timer of the main thread.
+'''
+
+
+class PriorityTaskPool(object):
+    def __init__(self, number_of_workers=1):
+        self.number_of_workers = max(1, number_of_workers)
+        self.condition = threading.Condition()
+        self.heap = []  # (priority, sequence, key), entries of moved or started tasks are skipped
+        self.tasks = {}  # key -> (priority, function, args) of the tasks that did not start
+        self.running = set()
+        self.results = []  # (key, result, error) of the finished tasks, until they are collected
+        self.sequence = 0
+        self.generation = 0
+        self.threads = []
+        self.stopped = False
+
+    def submit(self, key, priority, function, *args):
+        # A task with the same key that did not start yet is replaced
+        with self.condition:
+            self.tasks[key] = (priority, function, args)
+            self._push(key, priority)
+            if len(self.threads) < self.number_of_workers:
+                thread = threading.Thread(target=self._work, name='PriorityTaskPool-%d' % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.condition.notify()
+
+    def setPriority(self, key, priority):
+        # Returns False if the task already started or is unknown
+        with self.condition:
+            task = self.tasks.get(key)
+            if task is None:
+                return False
+            if task[0] != priority:
+                self.tasks[key] = (priority,) + task[1:]
+                self._push(key, priority)
+            return True
+
+    def cancel(self, key):
+        # Returns False if the task already started or is unknown
+        with self.condition:
+            return self.tasks.pop(key, None) is not None
+
+    def isPending(self, key):
+        with self.condition:
+            return key in self.tasks or key in self.running
+
+    def getNumberOfPendingTasks(self):
+        with self.condition:
+            return len(self.tasks) + len(self.running)
+
+    def getResults(self):
+        with self.condition:
+            results = self.results
+            self.results = []
+            return results
+
+    def clear(self):
+        # Drops the waiting tasks and the results, the running tasks finish but their results are dropped too
+        with self.condition:
+            self.tasks = {}
+            self.heap = []
+            self.results = []
+            self.generation += 1
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.tasks = {}
+            self.heap = []
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _push(self, key, priority):
+        heapq.heappush(self.heap, (priority, self.sequence, key))
+        self.sequence += 1
+
+    def _pop(self):
+        # Next task to run, None if there is none
+        while len(self.heap) > 0:
+            priority, _, key = heapq.heappop(self.heap)
+            task = self.tasks.get(key)
+            if task is not None and task[0] == priority:
+                del self.tasks[key]
+                return key, task
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                next_task = self._pop()
+                while next_task is None and not self.stopped:
+                    self.condition.wait()
+                    next_task = self._pop()
+                if self.stopped:
+                    return
+                key, (_, function, args) = next_task
+                self.running.add(key)
+                generation = self.generation
+            result = None
+            error = None
+            try:
+                result = function(*args)
+            except Exception as e:
+                error = e
+            with self.condition:
+                self.running.discard(key)
+                if generation == self.generation:
+                    self.results.append((key, result, error))
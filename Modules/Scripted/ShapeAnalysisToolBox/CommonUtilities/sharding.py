@@ -0,0 +1,426 @@
+'''
+Sharded cohort import, for cohorts too large for the memory or the cores of a
+single Slicer session.
+
+The cases of a CSV manifest or of a study directory are split into shards kept
+in a queue directory:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/sharding.py \
+    split --queue /shared/queue --csv cohort.csv --shard-size 50
+
+Any number of headless workers, on this machine or on cluster nodes that share
+the queue directory, then take the shards one at a time. Each shard is imported
+with the DataImporter logic, its topology is written as JSON and its surfaces as
+a cohort mesh file:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/sharding.py \
+    work --queue /shared/queue --workers 4
+
+Once all the shards are done, the merge step rebuilds the topology of the whole
+cohort and writes the same report as batch.py, with the cohort consistency:
+
+  SlicerSALT --no-main-window --python-script /path/to/CommonUtilities/sharding.py \
+    merge --queue /shared/queue --report report.csv --cohort-mesh cohort.cmesh
+
+On a single node, 'run' does the three steps with the given number of worker
+processes. The exit codes of merge and run are the ones of batch.py.
+'''
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import traceback
+from CommonUtilities import CaseDiscoveryUtility, CohortMesh, TopologyMatrix
+from CommonUtilities.batch import TopologyReportWriter, addProcessingArguments, configureLogic, \
+    EXIT_CONSISTENT, EXIT_INCONSISTENT, EXIT_IMPORT_FAILED
+
+
+#
+# ShardQueue
+#
+'''
+Queue of shards in a directory, one JSON file per shard in the directory of its
+state. Workers take a shard by moving its file from 'pending' to 'running',
+which only one of them can do, so the queue works across processes and nodes
+that share the file system. A running shard whose file was not touched for a
+while is put back by requeueStale, in case its worker died.
+'''
+
+
+class ShardQueue(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = [PENDING, RUNNING, DONE, FAILED]
+    RESULTS = 'results'
+    RESULT_FILE_NAME = 'topology.json'
+    MESH_FILE_NAME = 'meshes' + CohortMesh.FILE_EXTENSION
+    ERROR_FILE_NAME = 'error.txt'
+
+    def __init__(self, queue_dir):
+        self.queue_dir = os.path.abspath(queue_dir)
+        for directory in self.STATES + [self.RESULTS]:
+            path = os.path.join(self.queue_dir, directory)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def create(self, file_paths, case_names, shard_size):
+        # Splits the cases in shards of at most shard_size cases, in order. Returns the names of the shards.
+        if self.getShardNames():
+            raise ValueError('The queue %s already has shards' % self.queue_dir)
+        shard_names = []
+        for start in range(0, len(file_paths), shard_size):
+            shard_name = 'shard_%05d' % len(shard_names)
+            self._writeJSON(self._getShardPath(self.PENDING, shard_name), {
+                'shard': shard_name,
+                'files': file_paths[start:start + shard_size],
+                'caseNames': case_names[start:start + shard_size],
+            })
+            shard_names.append(shard_name)
+        return shard_names
+
+    def claim(self):
+        # Takes the first pending shard, returns its name and its job, None if there is none left
+        for shard_name in self.getShardNames(self.PENDING):
+            try:
+                os.rename(self._getShardPath(self.PENDING, shard_name), self._getShardPath(self.RUNNING, shard_name))
+            except OSError:
+                # Taken by another worker
+                continue
+            with open(self._getShardPath(self.RUNNING, shard_name), 'r') as shard_file:
+                return shard_name, json.load(shard_file)
+        return None
+
+    def heartbeat(self, shard_name):
+        try:
+            os.utime(self._getShardPath(self.RUNNING, shard_name), None)
+        except OSError:
+            pass
+
+    def complete(self, shard_name, result):
+        # The result is written before the shard is done, so the merge only sees complete results
+        self._writeJSON(os.path.join(self.getResultDirectory(shard_name), self.RESULT_FILE_NAME), result)
+        self._move(shard_name, self.RUNNING, self.DONE)
+
+    def fail(self, shard_name, message):
+        with open(os.path.join(self.getResultDirectory(shard_name), self.ERROR_FILE_NAME), 'w') as error_file:
+            error_file.write(message)
+        self._move(shard_name, self.RUNNING, self.FAILED)
+
+    def requeueStale(self, timeout):
+        # Puts back the running shards whose worker did not report for timeout seconds
+        requeued = []
+        for shard_name in self.getShardNames(self.RUNNING):
+            try:
+                age = time.time() - os.path.getmtime(self._getShardPath(self.RUNNING, shard_name))
+            except OSError:
+                continue
+            if age > timeout and self._move(shard_name, self.RUNNING, self.PENDING):
+                requeued.append(shard_name)
+        return requeued
+
+    def requeueFailed(self):
+        return [shard_name for shard_name in self.getShardNames(self.FAILED)
+                if self._move(shard_name, self.FAILED, self.PENDING)]
+
+    def getShardNames(self, state=None):
+        states = self.STATES if state is None else [state]
+        shard_names = []
+        for state in states:
+            shard_names.extend(os.path.splitext(file_name)[0]
+                               for file_name in os.listdir(os.path.join(self.queue_dir, state))
+                               if file_name.endswith('.json'))
+        return sorted(shard_names)
+
+    def getStatus(self):
+        return dict((state, len(self.getShardNames(state))) for state in self.STATES)
+
+    def getResultDirectory(self, shard_name):
+        result_dir = os.path.join(self.queue_dir, self.RESULTS, shard_name)
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        return result_dir
+
+    def readResult(self, shard_name):
+        with open(os.path.join(self.getResultDirectory(shard_name), self.RESULT_FILE_NAME), 'r') as result_file:
+            return json.load(result_file)
+
+    def _getShardPath(self, state, shard_name):
+        return os.path.join(self.queue_dir, state, shard_name + '.json')
+
+    def _move(self, shard_name, source_state, target_state):
+        try:
+            os.rename(self._getShardPath(source_state, shard_name), self._getShardPath(target_state, shard_name))
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _writeJSON(path, content):
+        temporary_path = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+        with open(temporary_path, 'w') as output_file:
+            json.dump(content, output_file)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary_path, path)
+
+
+def processShard(queue, shard_name, job, args):
+    # Imports the cases of a shard and returns its result: the labels of the shard, the topology of each
+    # imported case and the cases that failed or whose labels differ from the first case of the shard
+    from DataImporter import DataImporterLogic
+
+    logic = DataImporterLogic()
+    configureLogic(logic, args)
+    # A case that does not match is reported, the others of the shard are still imported
+    logic.SetSkipMismatchedCases(True)
+    start_time = time.time()
+    result = {'shard': shard_name, 'worker': getWorkerName(), 'cases': [], 'failed': []}
+    try:
+        for case_event in logic.iterImportFiles(job['files'], job['caseNames']):
+            path = job['files'][case_event['index']]
+            if case_event['status'] == 'imported':
+                case_name = case_event['name']
+                logic.processCaseTopology(case_name)
+                result['cases'].append({
+                    'name': case_name,
+                    'path': path,
+                    'topology': stringKeys(logic.topologyDetailsDict[case_name]),
+                    'components': stringKeys(logic.getComponentCounts(case_name)),
+                })
+            else:
+                result['failed'].append({'name': case_event['name'], 'path': path, 'status': case_event['status'],
+                                         'message': case_event['message']})
+            queue.heartbeat(shard_name)
+        result['labels'] = list(logic.getLabelsInCohort())
+        if len(result['cases']) > 0:
+            logic.exportCohortMesh(os.path.join(queue.getResultDirectory(shard_name), ShardQueue.MESH_FILE_NAME))
+        result['memory'] = logic.getMemoryStatistics()
+    finally:
+        logic.cleanup()
+    result['seconds'] = time.time() - start_time
+    return result
+
+
+def stringKeys(dictionary):
+    # JSON objects only have string keys
+    return dict((str(key), value) for key, value in dictionary.items()) if dictionary is not None else {}
+
+
+def integerKeys(dictionary):
+    return dict((int(key), value) for key, value in dictionary.items())
+
+
+def getWorkerName():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def mergeResults(queue):
+    # Topology of the whole cohort from the results of the shards that are done, in the order of the shards.
+    # The labels of the cohort are the ones of most cases, the cases of shards with other labels are
+    # reported as mismatched.
+    results = [queue.readResult(shard_name) for shard_name in queue.getShardNames(ShardQueue.DONE)]
+    label_counts = {}
+    for result in results:
+        if len(result['cases']) > 0:
+            labels = tuple(result['labels'])
+            label_counts[labels] = label_counts.get(labels, 0) + len(result['cases'])
+    cohort_labels = max(sorted(label_counts.keys()), key=lambda labels: label_counts[labels]) if label_counts else ()
+
+    merged = {
+        'labels': list(cohort_labels),
+        'caseNames': [],
+        'topologyDetailsDict': {},
+        'topologyDict': {},
+        'componentsDict': {},
+        'failed': [],
+        'meshFiles': [],
+        'matrix': TopologyMatrix(),
+    }
+    for result in results:
+        merged['failed'].extend(result['failed'])
+        if tuple(result['labels']) != cohort_labels:
+            merged['failed'].extend({'name': case['name'], 'path': case['path'], 'status': 'mismatch',
+                                     'message': 'Labels do not match in the cohort for case: ' + case['name']}
+                                    for case in result['cases'])
+            continue
+        for case in result['cases']:
+            case_name = case['name']
+            topology_details = integerKeys(case['topology'])
+            merged['caseNames'].append(case_name)
+            merged['topologyDetailsDict'][case_name] = topology_details
+            merged['topologyDict'][case_name] = dict((label, topology['euler'])
+                                                     for label, topology in topology_details.items())
+            merged['componentsDict'][case_name] = integerKeys(case['components'])
+            merged['matrix'].setCase(case_name, merged['topologyDict'][case_name])
+        mesh_file = os.path.join(queue.getResultDirectory(result['shard']), ShardQueue.MESH_FILE_NAME)
+        if len(result['cases']) > 0 and os.path.isfile(mesh_file):
+            merged['meshFiles'].append(mesh_file)
+    return merged
+
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(description='Import a cohort in shards processed by independent workers, '
+                                                 'then merge their topology.')
+    commands = parser.add_subparsers(dest='command')
+
+    split = commands.add_parser('split', help='Split the cases of a cohort in shards')
+    addQueueArgument(split)
+    addSplitArguments(split)
+
+    work = commands.add_parser('work', help='Process shards until the queue is empty')
+    addQueueArgument(work)
+    addWorkArguments(work)
+
+    merge = commands.add_parser('merge', help='Merge the results of the shards')
+    addQueueArgument(merge)
+    addMergeArguments(merge)
+
+    run = commands.add_parser('run', help='Split, process the shards with local worker processes, then merge')
+    addQueueArgument(run)
+    addSplitArguments(run)
+    addWorkArguments(run)
+    addMergeArguments(run)
+    run.add_argument('--processes', type=int, default=2, help='Number of worker processes')
+    run.add_argument('--slicer', default='', help='Slicer executable that runs the workers, the current '
+                                                  'application by default')
+    return parser
+
+
+def addQueueArgument(parser):
+    parser.add_argument('--queue', required=True, help='Directory of the shard queue, shared by the workers')
+
+
+def addSplitArguments(parser):
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--csv', help='CSV manifest: a header and one file path per row')
+    inputs.add_argument('--directory', help='Study directory where the labelmaps are found from --layout')
+    parser.add_argument('--layout', choices=sorted(CaseDiscoveryUtility.LAYOUTS.keys()), default='General VTK',
+                        help='Directory layout of the tool that produced the labelmaps')
+    parser.add_argument('--file-name', default='', help='File name pattern of the labelmaps, replaces the one '
+                                                       'of the layout, e.g. aparc+aseg.mgz')
+    parser.add_argument('--shard-size', type=int, default=50, help='Number of cases of each shard')
+
+
+def addWorkArguments(parser):
+    addProcessingArguments(parser)
+    parser.add_argument('--stale-timeout', type=float, default=2 * 3600,
+                        help='Seconds after which a shard whose worker did not report is processed again')
+
+
+def addMergeArguments(parser):
+    parser.add_argument('--report', required=True, help='Report file, CSV if it ends with .csv, JSON lines otherwise')
+    parser.add_argument('--cohort-mesh', default='', help='File where the surfaces of all the shards are packed')
+    parser.add_argument('--partial', action='store_true',
+                        help='Merge the shards that are done even if others are pending or failed')
+
+
+def runSplit(args):
+    queue = ShardQueue(args.queue)
+    if args.directory:
+        cases = CaseDiscoveryUtility.discoverCases(args.directory, args.layout, args.file_name)
+        case_names, file_paths = [case[0] for case in cases], [case[1] for case in cases]
+    else:
+        # Imported here as the DataImporter module itself imports this package
+        from DataImporter import DataImporterLogic
+        file_paths = DataImporterLogic.readCSVManifest(args.csv)
+        case_names = [os.path.basename(path) for path in file_paths]
+    shard_names = queue.create([os.path.abspath(path) for path in file_paths], case_names, max(1, args.shard_size))
+    print 'Split %d cases in %d shards in %s' % (len(file_paths), len(shard_names), queue.queue_dir)
+    return 0
+
+
+def runWorker(args):
+    queue = ShardQueue(args.queue)
+    number_of_shards = 0
+    while True:
+        for shard_name in queue.requeueStale(args.stale_timeout):
+            print 'Shard %s did not report for %d s, processing it again' % (shard_name, args.stale_timeout)
+        claimed = queue.claim()
+        if claimed is None:
+            break
+        shard_name, job = claimed
+        print '%s: processing %s, %d cases' % (getWorkerName(), shard_name, len(job['files']))
+        try:
+            result = processShard(queue, shard_name, job, args)
+        except Exception:
+            message = traceback.format_exc()
+            print 'ERROR: shard %s failed\n%s' % (shard_name, message)
+            queue.fail(shard_name, message)
+            continue
+        queue.complete(shard_name, result)
+        number_of_shards += 1
+    print '%s: processed %d shards' % (getWorkerName(), number_of_shards)
+    return 0
+
+
+def runMerge(args):
+    queue = ShardQueue(args.queue)
+    status = queue.getStatus()
+    writer = TopologyReportWriter(args.report)
+    try:
+        if not args.partial and status[ShardQueue.DONE] != sum(status.values()):
+            print 'ERROR: %d shards pending, %d running and %d failed in %s' % (
+                status[ShardQueue.PENDING], status[ShardQueue.RUNNING], status[ShardQueue.FAILED], queue.queue_dir)
+            writer.writeCohort('ImportFailed')
+            return EXIT_IMPORT_FAILED
+
+        merged = mergeResults(queue)
+        for failed in merged['failed']:
+            print 'ERROR: %s (%s): %s' % (failed['name'], failed['status'], failed['message'])
+        if len(merged['caseNames']) == 0:
+            writer.writeCohort('ImportFailed')
+            return EXIT_IMPORT_FAILED
+        for case_name in merged['caseNames']:
+            writer.writeCase(case_name, merged['topologyDetailsDict'][case_name], merged['componentsDict'][case_name])
+        topology_matrix = merged['matrix']
+        for label in sorted(topology_matrix.getLabels()):
+            writer.writeLabel(label, topology_matrix)
+        print 'Merged %d cases of %d shards, %d failed or mismatched' % (
+            len(merged['caseNames']), status[ShardQueue.DONE], len(merged['failed']))
+
+        if args.cohort_mesh:
+            CohortMesh.concatenate([CohortMesh.read(mesh_file) for mesh_file in merged['meshFiles']]).write(
+                args.cohort_mesh)
+
+        if topology_matrix.isConsistent():
+            writer.writeCohort('Consistent')
+            return EXIT_CONSISTENT
+        writer.writeCohort('InConsistent')
+        return EXIT_INCONSISTENT
+    finally:
+        writer.close()
+
+
+def runLocal(args):
+    runSplit(args)
+    slicer_executable = args.slicer
+    if not slicer_executable:
+        import slicer
+        slicer_executable = slicer.app.applicationFilePath()
+    command = [slicer_executable, '--no-main-window', '--python-script', os.path.abspath(__file__), 'work',
+               '--queue', args.queue, '--workers', str(args.workers), '--fill-holes', str(args.fill_holes),
+               '--stale-timeout', str(args.stale_timeout)]
+    for option in ['multi_label', 'raw_surfaces', 'largest_component', 'release_voxels']:
+        if getattr(args, option):
+            command.append('--' + option.replace('_', '-'))
+    if args.cache:
+        command.extend(['--cache', args.cache])
+    processes = [subprocess.Popen(command) for _ in range(max(1, args.processes))]
+    for process in processes:
+        process.wait()
+    return runMerge(args)
+
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv)
+    commands = {'split': runSplit, 'work': runWorker, 'merge': runMerge, 'run': runLocal}
+    return commands[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
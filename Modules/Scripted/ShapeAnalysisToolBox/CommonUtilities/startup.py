@@ -0,0 +1,104 @@
+'''
+Time that each SALT module adds to the launch of the application.
+
+Run it with any Python interpreter, it starts the application itself:
+
+  python /path/to/CommonUtilities/startup.py --slicer /path/to/SlicerSALT \
+    --output startup.json --repeat 5
+
+The application is launched until it finishes starting up, first with all its
+modules, then once without each of the given modules. The time a module adds is
+the difference between the median launch time with and without it. The launch
+times and the time of each module are written to the output JSON file.
+
+To measure a change, run it on the build before the change, then on the build
+with the change and pass the first output file with --baseline: the difference
+of the startup and of the time of each module is printed and written as well.
+'''
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+SALT_MODULES = ['Home', 'DataImporter']
+
+
+def createArgumentParser():
+    parser = argparse.ArgumentParser(description='Time the startup of the application with and without each '
+                                                 'SALT module.')
+    parser.add_argument('--slicer', required=True, help='Application executable')
+    parser.add_argument('--output', required=True, help='JSON file where the results are written')
+    parser.add_argument('--modules', nargs='+', default=SALT_MODULES, help='Modules to time')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of launches of each configuration')
+    parser.add_argument('--main-window', action='store_true',
+                        help='Show the main window, otherwise the application starts without it')
+    parser.add_argument('--baseline', help='Output file of a previous run, e.g. before a change, to compare with')
+    return parser
+
+
+def timeLaunch(slicer_executable, arguments):
+    start_time = time.time()
+    subprocess.check_call([slicer_executable, '--no-splash', '--exit-after-startup'] + arguments)
+    return time.time() - start_time
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 == 1 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def runStartup(args):
+    common_arguments = [] if args.main_window else ['--no-main-window']
+    configurations = [('all', common_arguments)]
+    for module in args.modules:
+        configurations.append((module, common_arguments + ['--modules-to-ignore', module]))
+
+    # The first launch fills the caches of the file system, it is not timed
+    timeLaunch(args.slicer, common_arguments)
+    launches = dict((name, []) for name, _ in configurations)
+    for _ in range(args.repeat):
+        # Configurations alternate so that a slow period of the machine affects all of them
+        for name, arguments in configurations:
+            launches[name].append(timeLaunch(args.slicer, arguments))
+
+    baseline = median(launches['all'])
+    results = {
+        'configuration': {'slicer': args.slicer, 'repeat': args.repeat, 'mainWindow': args.main_window},
+        'environment': {'platform': platform.platform()},
+        'launches': launches,
+        'startup': baseline,
+        'modules': dict((module, baseline - median(launches[module])) for module in args.modules),
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            previous = json.load(baseline_file)
+        results['baseline'] = {
+            'file': args.baseline,
+            'startup': results['startup'] - previous['startup'],
+            'modules': dict((module, results['modules'][module] - previous['modules'][module])
+                            for module in args.modules if module in previous['modules']),
+        }
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=1, sort_keys=True)
+
+    print('Startup: %.3f s (median of %d launches)' % (baseline, args.repeat))
+    if args.baseline:
+        print('  %-24s %+.3f s' % ('change from baseline', results['baseline']['startup']))
+    for module in args.modules:
+        line = '  %-24s %+.3f s' % (module, results['modules'][module])
+        if args.baseline and module in results['baseline']['modules']:
+            line += ' (%+.3f s from baseline)' % results['baseline']['modules'][module]
+        print(line)
+    return 0
+
+
+def main(argv):
+    args = createArgumentParser().parse_args(argv)
+    return runStartup(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+import numpy
+from topologymatrix import TopologyMatrix
+
+#
+# SubjectTable
+#
+'''
+Rows of the table of imported subjects: the subject name, the number of
+structures whose topology differs from the cohort, then the Euler characteristic
+of each structure. The values of the cohort are gathered in NumPy arrays when the
+table is updated, so that sorting and filtering thousands of subjects only moves
+row indices, and a view reads the cells it shows by row and column.
+'''
+
+
+class SubjectTable(object):
+    NAME_COLUMN = 0
+    OUTLIERS_COLUMN = 1
+    NUMBER_OF_FIXED_COLUMNS = 2
+
+    def __init__(self):
+        self.name_filter = ''
+        self.outlier_label = None
+        self.sort_column = None
+        self.sort_descending = False
+        self.clear()
+
+    def clear(self):
+        # Removes the subjects, the filters and the sort order are kept
+        self.case_names = []  # in the order the subjects were added
+        self.case_index = {}  # case name -> index in case_names
+        self.labels = []
+        self.euler = numpy.full((0, 0), TopologyMatrix.MISSING, dtype=numpy.int32)
+        self.outliers = numpy.zeros((0, 0), dtype=bool)
+        self.number_of_outliers = numpy.zeros(0, dtype=numpy.intp)
+        self.rows = numpy.zeros(0, dtype=numpy.intp)  # shown subjects, as indices into case_names
+        self.row_index = {}  # index in case_names -> shown row
+
+    def addCase(self, case_name):
+        # The subject is shown after the next update
+        if case_name not in self.case_index:
+            self.case_index[case_name] = len(self.case_names)
+            self.case_names.append(case_name)
+
+    def setNameFilter(self, text):
+        # Only the subjects whose name contains the text, ignoring the case
+        self.name_filter = text.strip().lower()
+
+    def setOutlierFilter(self, label):
+        # None shows all the subjects, 0 those that differ from the cohort for any structure,
+        # another label those that differ for that structure
+        self.outlier_label = label
+
+    def setSort(self, column, descending=False):
+        # None keeps the order in which the subjects were added
+        self.sort_column = column
+        self.sort_descending = descending
+
+    def update(self, topology_matrix, labels):
+        # Gathers the topology of the subjects for the given labels, then filters and sorts the rows
+        self.labels = list(labels)
+        rows = topology_matrix.getRows(self.case_names)
+        columns = topology_matrix.getColumns(self.labels)
+        matrix = topology_matrix.getMatrix()
+        outlier_matrix = topology_matrix.getOutlierMatrix()
+
+        # Subjects and labels that are not in the matrix yet have no value
+        self.euler = numpy.full((len(self.case_names), len(self.labels)), TopologyMatrix.MISSING, dtype=numpy.int32)
+        self.outliers = numpy.zeros(self.euler.shape, dtype=bool)
+        known_rows = numpy.flatnonzero(rows >= 0)
+        known_columns = numpy.flatnonzero(columns >= 0)
+        if len(known_rows) > 0 and len(known_columns) > 0:
+            selection = numpy.ix_(rows[known_rows], columns[known_columns])
+            self.euler[numpy.ix_(known_rows, known_columns)] = matrix[selection]
+            self.outliers[numpy.ix_(known_rows, known_columns)] = outlier_matrix[selection]
+        self.number_of_outliers = numpy.count_nonzero(self.outliers, axis=1)
+
+        order = self._getOrder()
+        self.rows = order[self._getFilterMask()[order]]
+        self.row_index = dict((int(case), row) for row, case in enumerate(self.rows))
+
+    def getNumberOfCases(self):
+        return len(self.case_names)
+
+    def getRowCount(self):
+        return len(self.rows)
+
+    def getColumnCount(self):
+        return self.NUMBER_OF_FIXED_COLUMNS + len(self.labels)
+
+    def getLabel(self, column):
+        # Label of a column, None for the name and outliers columns
+        if column < self.NUMBER_OF_FIXED_COLUMNS:
+            return None
+        return self.labels[column - self.NUMBER_OF_FIXED_COLUMNS]
+
+    def getColumn(self, label):
+        # Column of a label, None if it is not in the table
+        if label not in self.labels:
+            return None
+        return self.NUMBER_OF_FIXED_COLUMNS + self.labels.index(label)
+
+    def getCaseName(self, row):
+        return self.case_names[self.rows[row]]
+
+    def getRow(self, case_name):
+        # Shown row of a subject, None if it is filtered out or not in the table
+        return self.row_index.get(self.case_index.get(case_name))
+
+    def getEuler(self, row, column):
+        # Euler characteristic of a cell, None if the subject has no surface for the label
+        euler = self.euler[self.rows[row], column - self.NUMBER_OF_FIXED_COLUMNS]
+        return None if euler == TopologyMatrix.MISSING else int(euler)
+
+    def isOutlier(self, row, column):
+        # Whether the topology of a cell differs from the most common one of its label
+        if column == self.OUTLIERS_COLUMN:
+            return self.number_of_outliers[self.rows[row]] > 0
+        if column < self.NUMBER_OF_FIXED_COLUMNS:
+            return False
+        return bool(self.outliers[self.rows[row], column - self.NUMBER_OF_FIXED_COLUMNS])
+
+    def getNumberOfOutliers(self, row):
+        return int(self.number_of_outliers[self.rows[row]])
+
+    def _getFilterMask(self):
+        mask = numpy.ones(len(self.case_names), dtype=bool)
+        if self.name_filter:
+            mask &= numpy.array([self.name_filter in case_name.lower() for case_name in self.case_names], dtype=bool)
+        if self.outlier_label == 0:
+            mask &= self.number_of_outliers > 0
+        elif self.outlier_label is not None:
+            if self.outlier_label in self.labels:
+                mask &= self.outliers[:, self.labels.index(self.outlier_label)]
+            else:
+                mask[:] = False
+        return mask
+
+    def _getOrder(self):
+        # Stable order of all the subjects, ties keep the order in which the subjects were added
+        number_of_cases = len(self.case_names)
+        if self.sort_column is None or self.sort_column >= self.getColumnCount() or number_of_cases == 0:
+            return numpy.arange(number_of_cases, dtype=numpy.intp)
+        if self.sort_column == self.NAME_COLUMN:
+            # The names are unique, see addCase
+            order = numpy.argsort(numpy.array(self.case_names), kind='mergesort')
+            return order[::-1] if self.sort_descending else order
+        if self.sort_column == self.OUTLIERS_COLUMN:
+            values = self.number_of_outliers.astype(numpy.int64)
+            missing = numpy.zeros(number_of_cases, dtype=bool)
+        else:
+            values = self.euler[:, self.sort_column - self.NUMBER_OF_FIXED_COLUMNS].astype(numpy.int64)
+            missing = values == TopologyMatrix.MISSING
+        if self.sort_descending:
+            values = -values
+        # Subjects without a value come last in both directions
+        return numpy.lexsort((values, missing)).astype(numpy.intp)
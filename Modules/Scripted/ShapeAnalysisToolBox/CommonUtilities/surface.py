@@ -0,0 +1,171 @@
+import os
+import vtk
+import numpy
+from vtk.util import numpy_support
+from topology import TopologyUtility
+
+#
+# SurfaceUtility
+#
+'''
+This class harbors the functions to generate surfaces from labelmaps
+'''
+
+
+class SurfaceUtility(object):
+    SURFACE_EXTENSIONS = ['.vtp', '.vtk', '.stl']
+
+    @staticmethod
+    def extractLabelSurfaces(image_data, labels, ijk_to_ras=None, compute_normals=True):
+        # Extracts the surfaces of all the given labels in a single pass over the volume.
+        # Returns a dictionary label -> vtkPolyData, in RAS coordinates when ijk_to_ras is given.
+        # The image data is expected to have a zero origin and unit spacing, as in volume nodes.
+        if len(labels) == 0:
+            return {}
+
+        # Pad with background so that structures touching the border give closed surfaces
+        extent = image_data.GetExtent()
+        padder = vtk.vtkImageConstantPad()
+        padder.SetInputData(image_data)
+        padder.SetConstant(0)
+        padder.SetOutputWholeExtent(extent[0] - 1, extent[1] + 1, extent[2] - 1, extent[3] + 1,
+                                    extent[4] - 1, extent[5] + 1)
+
+        # Discrete marching cubes visits each voxel once and checks all the labels there, while
+        # vtkDiscreteFlyingEdges3D makes a full pass over the volume for every label.
+        contour = vtk.vtkDiscreteMarchingCubes()
+        contour.SetInputConnection(padder.GetOutputPort())
+        for i, label in enumerate(labels):
+            contour.SetValue(i, label)
+        contour.ComputeScalarsOn()
+        contour.ComputeNormalsOff()
+        contour.ComputeGradientsOff()
+        contour.Update()
+        surfaces = vtk.vtkPolyData()
+        surfaces.ShallowCopy(contour.GetOutput())
+        if surfaces.GetNumberOfPolys() == 0:
+            return {}
+
+        # Each triangle is tagged with its label in the cell scalars
+        points, triangles = TopologyUtility.getTriangleArrays(surfaces)
+        triangle_labels = numpy_support.vtk_to_numpy(surfaces.GetCellData().GetScalars())
+        triangle_labels = numpy.rint(triangle_labels).astype(numpy.int64)
+        surfaces.GetCellData().Initialize()
+        surfaces.GetPointData().Initialize()
+
+        if ijk_to_ras is not None:
+            matrix = numpy.array([[ijk_to_ras.GetElement(i, j) for j in range(4)] for i in range(4)])
+            ras_points = numpy.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+            surfaces.GetPoints().SetData(numpy_support.numpy_to_vtk(ras_points, deep=1))
+            if numpy.linalg.det(matrix[:3, :3]) < 0:
+                # Keep the triangles oriented outwards after a mirroring transform
+                triangles = triangles[:, [0, 2, 1]]
+
+        if compute_normals:
+            surfaces = TopologyUtility.buildPolyData(surfaces, triangles)
+            normals = vtk.vtkPolyDataNormals()
+            normals.SetInputData(surfaces)
+            normals.SplittingOff()
+            normals.ConsistencyOff()
+            normals.ComputePointNormalsOn()
+            normals.ComputeCellNormalsOff()
+            normals.Update()
+            surfaces = normals.GetOutput()
+            # buildPolyData removed the unused points, the triangles are read again from the result
+            points, triangles = TopologyUtility.getTriangleArrays(surfaces)
+
+        # Split the triangles by label
+        order = numpy.argsort(triangle_labels, kind='mergesort')
+        sorted_labels = triangle_labels[order]
+        label_surfaces = {}
+        for label in labels:
+            start, end = numpy.searchsorted(sorted_labels, [label, label + 1])
+            if start == end:
+                continue
+            label_surfaces[int(label)] = TopologyUtility.buildPolyData(surfaces, triangles[order[start:end]])
+        return label_surfaces
+
+    @staticmethod
+    def decimatePolyData(polydata, number_of_triangles):
+        # Preview of a surface with about number_of_triangles triangles, or the surface itself when
+        # it is smaller. Quadric clustering makes a single pass over the triangles, an order of
+        # magnitude faster than vtkQuadricDecimation.
+        if polydata is None or polydata.GetNumberOfPolys() <= number_of_triangles:
+            return polydata
+        # A closed surface crosses about 9 d^2 of the d^3 bins
+        divisions = max(8, int(numpy.sqrt(number_of_triangles / 9.0)))
+        clustering = vtk.vtkQuadricClustering()
+        clustering.SetInputData(polydata)
+        clustering.SetNumberOfDivisions(divisions, divisions, divisions)
+        clustering.AutoAdjustNumberOfDivisionsOn()
+        clustering.CopyCellDataOff()
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputConnection(clustering.GetOutputPort())
+        normals.SplittingOff()
+        normals.ComputeCellNormalsOff()
+        normals.Update()
+        preview = vtk.vtkPolyData()
+        preview.ShallowCopy(normals.GetOutput())
+        return preview
+
+    @staticmethod
+    def writePolyData(polydata, file_path, compress=True):
+        # Binary VTK XML PolyData, zlib compressed by default, or binary legacy VTK for .vtk files
+        if os.path.splitext(file_path)[1].lower() == '.vtk':
+            legacy_writer = vtk.vtkPolyDataWriter()
+            legacy_writer.SetFileName(file_path)
+            legacy_writer.SetInputData(polydata)
+            legacy_writer.SetFileTypeToBinary()
+            return legacy_writer.Write() == 1
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetFileName(file_path)
+        writer.SetInputData(polydata)
+        writer.SetDataModeToAppended()
+        writer.EncodeAppendedDataOff()
+        if compress:
+            writer.SetCompressorTypeToZLib()
+        else:
+            writer.SetCompressorTypeToNone()
+        return writer.Write() == 1
+
+    @staticmethod
+    def readPolyData(file_path):
+        if not os.path.isfile(file_path):
+            return None
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(file_path)
+        reader.Update()
+        if reader.GetErrorCode() != 0:
+            return None
+        polydata = vtk.vtkPolyData()
+        polydata.ShallowCopy(reader.GetOutput())
+        return polydata
+
+    @staticmethod
+    def isSurfaceFile(file_path):
+        return os.path.splitext(file_path)[1].lower() in SurfaceUtility.SURFACE_EXTENSIONS
+
+    @staticmethod
+    def readSurfaceFile(file_path):
+        # Reads a VTK XML PolyData, legacy VTK or STL surface in the coordinates of the file.
+        # Returns None if the file cannot be read or has no surface.
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == '.vtp':
+            reader = vtk.vtkXMLPolyDataReader()
+        elif extension == '.vtk':
+            reader = vtk.vtkPolyDataReader()
+        elif extension == '.stl':
+            reader = vtk.vtkSTLReader()
+            # The duplicate points of the triangles are merged when the topology is computed
+            reader.MergingOff()
+        else:
+            return None
+        if not os.path.isfile(file_path):
+            return None
+        reader.SetFileName(file_path)
+        reader.Update()
+        if reader.GetErrorCode() != 0 or reader.GetOutput() is None or reader.GetOutput().GetNumberOfPolys() == 0:
+            return None
+        polydata = vtk.vtkPolyData()
+        polydata.ShallowCopy(reader.GetOutput())
+        return polydata
@@ -0,0 +1,143 @@
+import csv
+import gzip
+import os
+import numpy
+
+#
+# SyntheticCohortUtility
+#
+'''
+This class harbors the functions to generate cohorts of labelmaps whose structures
+have a known topology, for benchmarks and tests
+'''
+
+
+class SyntheticCohortUtility(object):
+    # Shape of each label, in turn, and the Euler characteristic of the largest component of its surface
+    SHAPES = ['sphere', 'torus', 'slab', 'twoSpheres', 'doubleTorus']
+    EXPECTED_EULER = {
+        'sphere': 2,
+        'torus': 0,
+        'slab': 2,  # a thin solid, its closed surface is a sphere
+        'twoSpheres': 2,  # two components, the largest one is a sphere
+        'doubleTorus': -2,
+    }
+
+    @staticmethod
+    def getLabelShapes(number_of_labels):
+        # Dictionary label -> shape, labels start at 1
+        shapes = SyntheticCohortUtility.SHAPES
+        return dict((label, shapes[(label - 1) % len(shapes)]) for label in range(1, number_of_labels + 1))
+
+    @staticmethod
+    def getExpectedTopology(number_of_labels):
+        # Dictionary label -> Euler characteristic of the cleaned surface
+        return dict((label, SyntheticCohortUtility.EXPECTED_EULER[shape])
+                    for label, shape in SyntheticCohortUtility.getLabelShapes(number_of_labels).items())
+
+    @staticmethod
+    def createLabelVolume(size, number_of_labels, random_state=None):
+        # Array of size^3 voxels, indexed [k, j, i], where each label fills a cell of a regular grid.
+        # With a random_state, the shapes are slightly moved and scaled so that the cases differ.
+        grid = int(numpy.ceil(number_of_labels ** (1.0 / 3) - 1e-9))
+        cell_size = size // grid
+        volume = numpy.zeros((size, size, size), dtype=numpy.int16)
+        coordinates = numpy.arange(cell_size) - (cell_size - 1) / 2.0
+        z, y, x = numpy.meshgrid(coordinates, coordinates, coordinates, indexing='ij')
+        for label, shape in sorted(SyntheticCohortUtility.getLabelShapes(number_of_labels).items()):
+            cell = numpy.unravel_index(label - 1, (grid, grid, grid))
+            scale = 1.0
+            offset = numpy.zeros(3)
+            if random_state is not None:
+                scale = random_state.uniform(0.95, 1.05)
+                offset = random_state.uniform(-1, 1, 3)
+            mask = SyntheticCohortUtility._createShape(shape, x - offset[0], y - offset[1], z - offset[2],
+                                                       cell_size * scale)
+            start = [c * cell_size for c in cell]
+            block = volume[start[0]:start[0] + cell_size, start[1]:start[1] + cell_size,
+                           start[2]:start[2] + cell_size]
+            block[mask] = label
+        return volume
+
+    @staticmethod
+    def _createShape(shape, x, y, z, cell_size):
+        if shape == 'sphere':
+            return x ** 2 + y ** 2 + z ** 2 < (0.35 * cell_size) ** 2
+        if shape == 'torus':
+            return SyntheticCohortUtility._createTorus(x, y, z, 0.25 * cell_size, 0.1 * cell_size)
+        if shape == 'slab':
+            return (x ** 2 + y ** 2 < (0.38 * cell_size) ** 2) & (numpy.abs(z) < max(1.5, 0.06 * cell_size))
+        if shape == 'twoSpheres':
+            return ((x + 0.18 * cell_size) ** 2 + y ** 2 + z ** 2 < (0.2 * cell_size) ** 2) | \
+                   ((x - 0.28 * cell_size) ** 2 + y ** 2 + z ** 2 < (0.12 * cell_size) ** 2)
+        if shape == 'doubleTorus':
+            radius = 0.15 * cell_size
+            return SyntheticCohortUtility._createTorus(x + radius, y, z, radius, 0.08 * cell_size) | \
+                SyntheticCohortUtility._createTorus(x - radius, y, z, radius, 0.08 * cell_size)
+        raise ValueError('Unknown shape: ' + shape)
+
+    @staticmethod
+    def _createTorus(x, y, z, radius, tube_radius):
+        return (numpy.sqrt(x ** 2 + y ** 2) - radius) ** 2 + z ** 2 < tube_radius ** 2
+
+    @staticmethod
+    def writeNRRD(file_path, volume, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), compress=False):
+        # Writes an array indexed [k, j, i] as a NRRD volume in LPS space
+        types = {'int16': 'short', 'uint16': 'ushort', 'uint8': 'uchar', 'int32': 'int', 'float32': 'float'}
+        header = [
+            'NRRD0004',
+            'type: ' + types[volume.dtype.name],
+            'dimension: 3',
+            'space: left-posterior-superior',
+            'sizes: %d %d %d' % (volume.shape[2], volume.shape[1], volume.shape[0]),
+            'space directions: (%r,0,0) (0,%r,0) (0,0,%r)' % tuple(float(s) for s in spacing),
+            'kinds: domain domain domain',
+            'endian: little',
+            'encoding: ' + ('gzip' if compress else 'raw'),
+            'space origin: (%r,%r,%r)' % tuple(float(o) for o in origin),
+        ]
+        data = numpy.ascontiguousarray(volume, dtype=volume.dtype.newbyteorder('<'))
+        data = data.tobytes() if hasattr(data, 'tobytes') else data.tostring()
+        with open(file_path, 'wb') as nrrd_file:
+            nrrd_file.write(('\n'.join(header) + '\n\n').encode('ascii'))
+            if compress:
+                with gzip.GzipFile(fileobj=nrrd_file, mode='wb') as gzip_file:
+                    gzip_file.write(data)
+            else:
+                nrrd_file.write(data)
+
+    @staticmethod
+    def generateCohort(output_dir, number_of_cases, size, number_of_labels, seed=0, compress=False):
+        # Writes the labelmaps of the cohort and a CSV manifest of their paths.
+        # Returns the list of file paths and the path of the manifest.
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        random_state = numpy.random.RandomState(seed)
+        file_paths = []
+        for case in range(number_of_cases):
+            file_path = os.path.join(output_dir, 'case%04d.nrrd' % case)
+            volume = SyntheticCohortUtility.createLabelVolume(size, number_of_labels, random_state)
+            SyntheticCohortUtility.writeNRRD(file_path, volume, compress=compress)
+            file_paths.append(file_path)
+
+        manifest_path = os.path.join(output_dir, 'cohort.csv')
+        with open(manifest_path, 'w') as manifest_file:
+            writer = csv.writer(manifest_file)
+            writer.writerow(['file'])
+            for file_path in file_paths:
+                writer.writerow([file_path])
+        return file_paths, manifest_path
+
+    @staticmethod
+    def findTopologyErrors(topology_matrix, number_of_labels):
+        # Compares the Euler characteristics of a TopologyMatrix with the expected ones.
+        # Returns a list of dictionaries with the 'case', 'label', 'expected' and computed 'euler'.
+        errors = []
+        expected_topology = SyntheticCohortUtility.getExpectedTopology(number_of_labels)
+        for case_name in topology_matrix.getCaseNames():
+            for label in sorted(expected_topology.keys()):
+                euler = topology_matrix.getEuler(case_name, label)
+                if euler != expected_topology[label]:
+                    errors.append({'case': case_name, 'label': label, 'expected': expected_topology[label],
+                                   'euler': euler})
+        return errors
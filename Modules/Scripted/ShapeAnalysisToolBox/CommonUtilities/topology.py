@@ -0,0 +1,233 @@
+import contextlib
+import vtk
+import numpy
+from vtk.util import numpy_support
+
+ID_TYPE = numpy.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else numpy.int32
+
+#
+# TopologyUtility
+#
+'''
+This class harbors the functions to clean triangulated surfaces and to compute
+their topology directly on the point and triangle arrays.
+'''
+
+
+class TopologyUtility(object):
+    TOPOLOGY_NAMES = {
+        1: 'Disk',
+        0: 'Circle/Torus/Mobius Strip',
+        2: 'Sphere',
+        -2: 'Double Torus',
+        -4: 'Triple Torus',
+    }
+
+    @staticmethod
+    def getTopologyName(euler):
+        return TopologyUtility.TOPOLOGY_NAMES.get(euler, 'n/a')
+
+    @staticmethod
+    def triangulate(polydata):
+        # Returns the polydata itself when it only has triangles, a triangulated copy otherwise
+        polys = polydata.GetPolys()
+        number_of_cells = polys.GetNumberOfCells()
+        if number_of_cells > 0 and polydata.GetNumberOfStrips() == 0:
+            connectivity = numpy_support.vtk_to_numpy(polys.GetData())
+            if connectivity.size == 4 * number_of_cells and numpy.all(connectivity[::4] == 3):
+                return polydata
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputData(polydata)
+        triangle_filter.PassVertsOff()
+        triangle_filter.PassLinesOff()
+        triangle_filter.Update()
+        return triangle_filter.GetOutput()
+
+    @staticmethod
+    def getTriangleArrays(polydata):
+        # Returns the points as a (N, 3) array and the triangles as a (M, 3) array of point ids.
+        # The polydata must only have triangles, see triangulate().
+        if polydata.GetNumberOfPoints() == 0 or polydata.GetNumberOfPolys() == 0:
+            return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=numpy.int64)
+        points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+        connectivity = numpy_support.vtk_to_numpy(polydata.GetPolys().GetData())
+        triangles = connectivity.reshape(-1, 4)[:, 1:].astype(numpy.int64)
+        return points, triangles
+
+    @staticmethod
+    def mergeDuplicatePoints(points, triangles):
+        # Equivalent of vtkCleanPolyData with a zero tolerance: coincident points are merged and the
+        # triangles that became degenerate are dropped. Returns the merged triangles, expressed with
+        # the id of the first occurrence of each point, and the indices of the triangles that were kept.
+        if points.shape[0] == 0:
+            return triangles, numpy.arange(triangles.shape[0])
+        order = numpy.lexsort((points[:, 2], points[:, 1], points[:, 0]))
+        sorted_points = points[order]
+        new_group = numpy.concatenate(([True], numpy.any(sorted_points[1:] != sorted_points[:-1], axis=1)))
+        # lexsort is stable, so the first point of each group is its first occurrence
+        first_index = order[numpy.flatnonzero(new_group)]
+        merged_ids = numpy.empty(points.shape[0], dtype=numpy.int64)
+        merged_ids[order] = first_index[numpy.cumsum(new_group) - 1]
+        merged = merged_ids[triangles]
+        valid = (merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) & (merged[:, 0] != merged[:, 2])
+        return merged[valid], numpy.nonzero(valid)[0]
+
+    @staticmethod
+    def getEdges(triangles):
+        # Returns the unique edges as sorted (lower id, higher id) pairs, and how many triangles use each of them
+        if triangles.shape[0] == 0:
+            return numpy.zeros((0, 2), dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        first = numpy.concatenate((triangles[:, 0], triangles[:, 1], triangles[:, 2]))
+        second = numpy.concatenate((triangles[:, 1], triangles[:, 2], triangles[:, 0]))
+        base = triangles.max() + 1
+        keys = numpy.minimum(first, second) * base + numpy.maximum(first, second)
+        keys.sort()
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = numpy.diff(numpy.append(starts, keys.size))
+        unique_keys = keys[starts]
+        return numpy.column_stack((unique_keys // base, unique_keys % base)), counts
+
+    @staticmethod
+    def connectedComponents(number_of_points, edges):
+        # Vectorized union-find: roots are hooked to the smallest connected root and the
+        # trees are flattened by pointer jumping until no edge connects two different roots.
+        labels = numpy.arange(number_of_points)
+        while edges.shape[0] > 0:
+            first = labels[edges[:, 0]]
+            second = labels[edges[:, 1]]
+            different = first != second
+            if not numpy.any(different):
+                break
+            low = numpy.minimum(first[different], second[different])
+            high = numpy.maximum(first[different], second[different])
+            numpy.minimum.at(labels, high, low)
+            while True:
+                jumped = labels[labels]
+                if numpy.array_equal(jumped, labels):
+                    break
+                labels = jumped
+        return labels
+
+    @staticmethod
+    def extractLargestComponent(triangles):
+        # Keeps the connected component with the most triangles, as vtkPolyDataConnectivityFilter does
+        # with SetExtractionModeToLargestRegion. Returns the indices of the triangles that were kept.
+        if triangles.shape[0] == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        number_of_points = triangles.max() + 1
+        edges = numpy.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]]))
+        labels = TopologyUtility.connectedComponents(number_of_points, edges)
+        triangle_labels = labels[triangles[:, 0]]
+        largest = numpy.argmax(numpy.bincount(triangle_labels))
+        return numpy.nonzero(triangle_labels == largest)[0]
+
+    @staticmethod
+    def computeTopology(triangles):
+        # Euler characteristic V - E + F of the surface, with the genus, the number of boundary
+        # loops and the number of non-manifold edges (edges shared by more than two triangles).
+        # The genus is only given for a single connected orientable manifold, None otherwise.
+        edges, counts = TopologyUtility.getEdges(triangles)
+        number_of_points = numpy.count_nonzero(numpy.bincount(triangles.ravel())) if triangles.size > 0 else 0
+        number_of_edges = edges.shape[0]
+        number_of_faces = triangles.shape[0]
+        euler = int(number_of_points - number_of_edges + number_of_faces)
+
+        non_manifold_edges = int(numpy.count_nonzero(counts > 2))
+        boundary_edges = edges[counts == 1]
+        boundary_loops = 0
+        if boundary_edges.shape[0] > 0:
+            boundary_point_ids, compact_edges = numpy.unique(boundary_edges, return_inverse=True)
+            labels = TopologyUtility.connectedComponents(boundary_point_ids.size, compact_edges.reshape(-1, 2))
+            boundary_loops = int(numpy.unique(labels).size)
+
+        genus = None
+        if non_manifold_edges == 0 and (2 - boundary_loops - euler) % 2 == 0:
+            genus = (2 - boundary_loops - euler) // 2
+
+        return {
+            'euler': euler,
+            'genus': genus,
+            'boundaryLoops': boundary_loops,
+            'nonManifoldEdges': non_manifold_edges,
+            'numberOfPoints': int(number_of_points),
+            'numberOfEdges': int(number_of_edges),
+            'numberOfFaces': int(number_of_faces),
+        }
+
+    @staticmethod
+    def buildPolyData(source_polydata, triangles, triangle_ids=None):
+        # Creates a polydata with only the points used by the triangles. Point data is copied from the
+        # source, and cell data as well when the source ids of the triangles are given.
+        if triangles.shape[0] == 0:
+            return vtk.vtkPolyData()
+        used = numpy.bincount(triangles.ravel(), minlength=source_polydata.GetNumberOfPoints()) > 0
+        point_ids = numpy.flatnonzero(used)
+        compact_ids = numpy.cumsum(used) - 1
+        compact_triangles = compact_ids[triangles]
+
+        source_points = numpy_support.vtk_to_numpy(source_polydata.GetPoints().GetData())
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(source_points[point_ids], deep=1))
+
+        cells = numpy.empty((compact_triangles.shape[0], 4), dtype=ID_TYPE)
+        cells[:, 0] = 3
+        cells[:, 1:] = compact_triangles
+        polys = vtk.vtkCellArray()
+        polys.SetCells(compact_triangles.shape[0], numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=1))
+
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(points)
+        polydata.SetPolys(polys)
+        TopologyUtility._copyArrays(source_polydata.GetPointData(), polydata.GetPointData(), point_ids)
+        if triangle_ids is not None and source_polydata.GetNumberOfVerts() == 0 \
+                and source_polydata.GetNumberOfLines() == 0:
+            TopologyUtility._copyArrays(source_polydata.GetCellData(), polydata.GetCellData(), triangle_ids)
+        return polydata
+
+    @staticmethod
+    def _copyArrays(source_data, target_data, ids):
+        for i in range(source_data.GetNumberOfArrays()):
+            source_array = source_data.GetArray(i)
+            if source_array is None:
+                continue
+            array = numpy_support.vtk_to_numpy(source_array)
+            target_array = numpy_support.numpy_to_vtk(array[ids], deep=1, array_type=source_array.GetDataType())
+            if source_array.GetName():
+                target_array.SetName(source_array.GetName())
+            target_data.AddArray(target_array)
+        for attribute in range(vtk.vtkDataSetAttributes.NUM_ATTRIBUTES):
+            source_array = source_data.GetAttribute(attribute)
+            if source_array is not None and source_array.GetName():
+                target_data.SetActiveAttribute(source_array.GetName(), attribute)
+
+    @staticmethod
+    def cleanLargestComponent(polydata, stage=None):
+        # Cleans the surface, keeps its largest connected component and computes its topology.
+        # Returns the cleaned polydata and the topology dictionary, None if the surface has no triangle.
+        # stage, if given, is called with the name of each step and returns a context manager
+        # around it, e.g. PipelineProfiler.stage, and a dictionary where sizes are recorded.
+        if stage is None:
+            stage = TopologyUtility._noStage
+        with stage('mergeDuplicatePoints') as record:
+            polydata = TopologyUtility.triangulate(polydata)
+            points, triangles = TopologyUtility.getTriangleArrays(polydata)
+            merged, triangle_ids = TopologyUtility.mergeDuplicatePoints(points, triangles)
+            record['points'] = len(points)
+            record['triangles'] = len(triangles)
+        if len(merged) == 0:
+            return None
+        with stage('extractLargestComponent') as record:
+            largest = TopologyUtility.extractLargestComponent(merged)
+            merged = merged[largest]
+            triangle_ids = triangle_ids[largest]
+            record['triangles'] = len(merged)
+        with stage('computeTopology'):
+            topology = TopologyUtility.computeTopology(merged)
+        with stage('buildPolyData'):
+            clean_polydata = TopologyUtility.buildPolyData(polydata, merged, triangle_ids)
+        return clean_polydata, topology
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _noStage(stage_name):
+        yield {}
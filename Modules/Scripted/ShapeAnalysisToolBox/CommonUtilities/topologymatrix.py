@@ -0,0 +1,208 @@
+import numpy
+
+#
+# TopologyMatrix
+#
+'''
+Euler characteristics of a cohort in a cases x labels array, with the consistency,
+the majority topology and the outlier cases of each label.
+'''
+
+
+class TopologyMatrix(object):
+    # Euler characteristic of a label that has no surface in a case
+    MISSING = numpy.iinfo(numpy.int32).min
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.case_names = []
+        self.case_index = {}  # case name -> row
+        self.labels = []
+        self.label_index = {}  # label -> column
+        self.euler = numpy.full((0, 0), self.MISSING, dtype=numpy.int32)
+        self._invalidate()
+
+    def setCase(self, case_name, topology):
+        # topology is a dictionary label -> Euler characteristic
+        for label in sorted(topology.keys()):
+            if label not in self.label_index:
+                self._addLabel(label)
+        if case_name not in self.case_index:
+            self._addCase(case_name)
+        row = self.case_index[case_name]
+        self.euler[row, :] = self.MISSING
+        if len(topology) > 0:
+            columns = [self.label_index[label] for label in topology.keys()]
+            self.euler[row, columns] = list(topology.values())
+        self._invalidate()
+
+    def setEuler(self, case_name, label, euler):
+        # Single value of a case, None for a label without surface
+        if label not in self.label_index:
+            self._addLabel(label)
+        if case_name not in self.case_index:
+            self._addCase(case_name)
+        self.euler[self.case_index[case_name], self.label_index[label]] = self.MISSING if euler is None else euler
+        self._invalidate()
+
+    def getNumberOfCases(self):
+        return len(self.case_names)
+
+    def getCaseNames(self):
+        return list(self.case_names)
+
+    def getLabels(self):
+        return list(self.labels)
+
+    def getMatrix(self):
+        # Rows follow getCaseNames(), columns getLabels()
+        return self.euler[:len(self.case_names), :]
+
+    def getEuler(self, case_name, label):
+        if case_name not in self.case_index or label not in self.label_index:
+            return None
+        euler = self.euler[self.case_index[case_name], self.label_index[label]]
+        return None if euler == self.MISSING else int(euler)
+
+    def getNumberOfKnownCases(self, label):
+        # Cases with a surface for this label
+        if label not in self.label_index:
+            return 0
+        return int(numpy.count_nonzero(self.getMatrix()[:, self.label_index[label]] != self.MISSING))
+
+    def isConsistent(self, label=None):
+        # Labels without any known Euler characteristic, e.g. still pending, do not make the cohort inconsistent
+        self._update()
+        if label is None:
+            return bool(self.consistent.all())
+        if label not in self.label_index:
+            return False
+        return bool(self.consistent[self.label_index[label]])
+
+    def getConsistency(self, label):
+        # 'Consistent', 'InConsistent' or None for an unknown label or a label without any known case
+        if label not in self.label_index or self.getNumberOfKnownCases(label) == 0:
+            return None
+        return 'Consistent' if self.isConsistent(label) else 'InConsistent'
+
+    def getMajorityEuler(self, label):
+        # Most frequent Euler characteristic of the label, the largest one on ties
+        self._update()
+        if label not in self.label_index:
+            return None
+        euler = self.majority[self.label_index[label]]
+        return None if euler == self.MISSING else int(euler)
+
+    def getOutlierCases(self, label):
+        # Cases whose topology differs from the majority for this label
+        self._update()
+        return [self.case_names[row] for row in self.outlier_rows.get(label, [])]
+
+    def getCases(self, label, euler):
+        # Cases with the given Euler characteristic for this label
+        self._update()
+        return [self.case_names[row] for row in self.class_rows.get((label, euler), [])]
+
+    def getCasesWithout(self, label, euler):
+        # Cases with a surface for this label and another Euler characteristic, e.g. the
+        # non-spherical ones with euler=2
+        self._update()
+        rows = [self.class_rows[key] for key in self.label_classes.get(label, []) if key[1] != euler]
+        if len(rows) == 0:
+            return []
+        return [self.case_names[row] for row in numpy.sort(numpy.concatenate(rows))]
+
+    def getTopologyClasses(self, label):
+        # Dictionary Euler characteristic -> number of cases
+        self._update()
+        return dict((key[1], len(self.class_rows[key])) for key in self.label_classes.get(label, []))
+
+    def getInconsistentLabels(self):
+        self._update()
+        return [self.labels[column] for column in numpy.flatnonzero(~self.consistent)]
+
+    def getOutlierMatrix(self):
+        # True where a case has a surface whose topology differs from the majority of the label,
+        # rows and columns as in getMatrix()
+        self._update()
+        euler = self.getMatrix()
+        return (euler != self.majority[numpy.newaxis, :]) & (euler != self.MISSING)
+
+    def getRows(self, case_names):
+        # Row of each case in getMatrix(), -1 for the cases that are not in the matrix
+        return numpy.array([self.case_index.get(case_name, -1) for case_name in case_names], dtype=numpy.intp)
+
+    def getColumns(self, labels):
+        # Column of each label in getMatrix(), -1 for the labels that are not in the matrix
+        return numpy.array([self.label_index.get(label, -1) for label in labels], dtype=numpy.intp)
+
+    def _addCase(self, case_name):
+        number_of_cases = len(self.case_names)
+        if number_of_cases == self.euler.shape[0]:
+            # Rows are allocated by doubling so that adding cases one at a time stays linear
+            capacity = max(16, 2 * number_of_cases)
+            euler = numpy.full((capacity, self.euler.shape[1]), self.MISSING, dtype=numpy.int32)
+            euler[:number_of_cases, :] = self.euler[:number_of_cases, :]
+            self.euler = euler
+        self.case_index[case_name] = number_of_cases
+        self.case_names.append(case_name)
+
+    def _addLabel(self, label):
+        self.label_index[label] = len(self.labels)
+        self.labels.append(label)
+        column = numpy.full((self.euler.shape[0], 1), self.MISSING, dtype=numpy.int32)
+        self.euler = numpy.hstack([self.euler, column])
+
+    def _invalidate(self):
+        self.up_to_date = False
+
+    def _update(self):
+        if self.up_to_date:
+            return
+        euler = self.getMatrix()
+        number_of_labels = len(self.labels)
+
+        # Group the known values by (label, Euler characteristic)
+        rows, columns = numpy.nonzero(euler != self.MISSING)
+        values = euler[rows, columns]
+        order = numpy.lexsort((rows, values, columns))
+        rows, columns, values = rows[order], columns[order], values[order]
+        starts = numpy.flatnonzero(numpy.concatenate([[True], (columns[1:] != columns[:-1]) |
+                                                      (values[1:] != values[:-1])])) if len(rows) > 0 else \
+            numpy.zeros(0, dtype=numpy.intp)
+        counts = numpy.diff(numpy.append(starts, len(rows)))
+        group_columns = columns[starts]
+        group_values = values[starts]
+
+        # Majority class of each label: groups are sorted by label then value, so the last
+        # group with the maximum count is the largest Euler characteristic among the ties
+        self.majority = numpy.full(number_of_labels, self.MISSING, dtype=numpy.int32)
+        best_counts = numpy.zeros(number_of_labels, dtype=numpy.intp)
+        numpy.maximum.at(best_counts, group_columns, counts)
+        best_groups = numpy.full(number_of_labels, -1, dtype=numpy.intp)
+        is_best = counts == best_counts[group_columns]
+        numpy.maximum.at(best_groups, group_columns[is_best], numpy.flatnonzero(is_best))
+        has_values = best_groups >= 0
+        self.majority[has_values] = group_values[best_groups[has_values]]
+
+        classes_per_label = numpy.bincount(group_columns, minlength=number_of_labels)
+        self.consistent = classes_per_label <= 1
+
+        self.class_rows = {}
+        self.label_classes = {}
+        for start, count, column, value in zip(starts, counts, group_columns, group_values):
+            key = (self.labels[column], int(value))
+            self.class_rows[key] = rows[start:start + count]
+            self.label_classes.setdefault(key[0], []).append(key)
+
+        # The outliers stay sorted by label, then split per label
+        is_outlier = values != self.majority[columns]
+        outlier_rows = rows[is_outlier]
+        outlier_columns = columns[is_outlier]
+        self.outlier_rows = {}
+        for column in numpy.unique(outlier_columns):
+            start, end = numpy.searchsorted(outlier_columns, [column, column + 1])
+            self.outlier_rows[self.labels[column]] = numpy.sort(outlier_rows[start:end])
+        self.up_to_date = True
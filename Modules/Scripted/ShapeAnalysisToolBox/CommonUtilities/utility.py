@@ -1,6 +1,107 @@
 import vtk, ctk, slicer
+import contextlib
 import logging
 import os
+from export import ExportUtility
+from surface import SurfaceUtility
+
+#
+# MRMLNodeIndex
+#
+'''
+Index of the nodes of a scene by name, kept up to date by observing the nodes that
+are added to and removed from the scene, so that looking up a node does not scan
+the scene, even when the name is not there. Renames are not observed, since
+observing every node would run Python for each modification of the view nodes:
+the name of a node is checked when it is looked up, and a node renamed after it
+was added to the scene is indexed again with updateNode.
+'''
+
+
+class MRMLNodeIndex(object):
+    def __init__(self, scene):
+        self.scene = scene
+        self.nodes = {}  # name -> nodes with this name, in the order they were added
+        self.names = {}  # node ID -> indexed name
+        self.scene_observers = [
+            scene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded),
+            scene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+            scene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.onSceneChanged),
+            scene.AddObserver(slicer.vtkMRMLScene.EndImportEvent, self.onSceneChanged),
+            scene.AddObserver(slicer.vtkMRMLScene.EndRestoreEvent, self.onSceneChanged),
+        ]
+        self.rebuild()
+
+    def getNode(self, node_name):
+        # First indexed node with this name, None if there is none
+        for node in list(self.nodes.get(node_name, [])):
+            if node.GetName() == node_name:
+                return node
+            # Renamed since it was indexed
+            self.updateNode(node)
+        return None
+
+    def updateNode(self, node):
+        # Moves a node of the scene under its current name
+        node_id = node.GetID()
+        if node_id is None:
+            return
+        if node_id in self.names:
+            self._unindex(node, self.names.pop(node_id))
+        self.addNode(node)
+
+    def contains(self, node):
+        return node is not None and node.GetID() is not None and node.GetID() in self.names
+
+    def rebuild(self):
+        self.clear()
+        for i in range(self.scene.GetNumberOfNodes()):
+            self.addNode(self.scene.GetNthNode(i))
+
+    def clear(self):
+        self.nodes = {}
+        self.names = {}
+
+    def addNode(self, node):
+        node_id = node.GetID()
+        if node_id is None or node_id in self.names:
+            return
+        self.names[node_id] = node.GetName()
+        self.nodes.setdefault(node.GetName(), []).append(node)
+
+    def removeNode(self, node):
+        node_id = node.GetID()
+        if node_id not in self.names:
+            return
+        self._unindex(node, self.names.pop(node_id))
+
+    def close(self):
+        self.clear()
+        for tag in self.scene_observers:
+            self.scene.RemoveObserver(tag)
+        self.scene_observers = []
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeAdded(self, caller, event, node):
+        self.addNode(node)
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        self.removeNode(node)
+
+    def onSceneChanged(self, caller, event):
+        self.rebuild()
+
+    def _unindex(self, node, node_name):
+        nodes = self.nodes.get(node_name, [])
+        node_id = node.GetID()
+        for i in range(len(nodes)):
+            if nodes[i].GetID() == node_id:
+                del nodes[i]
+                break
+        if len(nodes) == 0:
+            self.nodes.pop(node_name, None)
+
 
 #
 # MRMLUtility
@@ -11,9 +112,32 @@ This class harbors all the utility functions to save and remove mrml nodes
 
 
 class MRMLUtility(object):
+    node_index = None
+
+    @staticmethod
+    def getNodeIndex():
+        # Created the first time a node is looked up in the scene
+        if MRMLUtility.node_index is None:
+            MRMLUtility.node_index = MRMLNodeIndex(slicer.mrmlScene)
+        return MRMLUtility.node_index
+
+    @staticmethod
+    def getNodeByName(node_name):
+        return MRMLUtility.getNodeIndex().getNode(node_name)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def batchProcess():
+        # Scene events are compressed until the end of the block
+        slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+        try:
+            yield
+        finally:
+            slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+
     @staticmethod
     def loadMRMLNode(node_name, file_dir, file_name, file_type):
-        node = slicer.util.getNode(node_name)
+        node = MRMLUtility.getNodeByName(node_name)
         if node is None:
             properties = {}
             file_path = os.path.join(file_dir, file_name)
@@ -28,6 +152,47 @@ class MRMLUtility(object):
             if file_type == 'MarkupsFiducials':
                 node.SetLocked(1)
             node.SetName(node_name)
+            # Added to the scene under the name of its file
+            MRMLUtility.getNodeIndex().updateNode(node)
+        return node
+
+    @staticmethod
+    def readMRMLNode(node_name, file_dir, file_name, file_type):
+        # The node is not added to the scene, use addMRMLNode() to add it afterwards
+        file_path = os.path.join(file_dir, file_name)
+        if file_type == 'LabelMap':
+            node = slicer.vtkMRMLLabelMapVolumeNode()
+            storage_node = slicer.vtkMRMLVolumeArchetypeStorageNode()
+        else:
+            logging.error('!!! Unsupported file type for reading: %s', file_type)
+            return None
+        storage_node.SetFileName(file_path)
+        if not storage_node.ReadData(node):
+            logging.error('!!! Failed to read: %s', file_path)
+            return None
+        node.SetName(node_name)
+        return node
+
+    @staticmethod
+    def createLabelMapNode(node_name, image_data, ijk_to_ras):
+        # Labelmap node of voxels read with LabelMapUtility.readLabelmap, not added to the scene
+        node = slicer.vtkMRMLLabelMapVolumeNode()
+        node.SetName(node_name)
+        node.SetIJKToRASMatrix(ijk_to_ras)
+        node.SetAndObserveImageData(image_data)
+        return node
+
+    @staticmethod
+    def addMRMLNodes(nodes):
+        with MRMLUtility.batchProcess():
+            for node in nodes:
+                MRMLUtility.addMRMLNode(node)
+        return nodes
+
+    @staticmethod
+    def addMRMLNode(node):
+        slicer.mrmlScene.AddNode(node)
+        node.CreateDefaultDisplayNodes()
         return node
 
     @staticmethod
@@ -54,11 +219,12 @@ class MRMLUtility(object):
         if transform is not None:
             mrml_node.ApplyTransform(transform)
         mrml_node.SetName(node_name)
+        MRMLUtility.getNodeIndex().updateNode(mrml_node)
         return mrml_node
 
     @staticmethod
     def getMRMLNode(node_name, mrml_type, copy_node=None, transform=None):
-        mrml_node = slicer.util.getNode(node_name)
+        mrml_node = MRMLUtility.getNodeByName(node_name)
         if mrml_node is None:
             mrml_node = MRMLUtility.createNewMRMLNode(node_name, mrml_type, copy_node, transform)
             already_exists = False
@@ -89,35 +255,90 @@ class MRMLUtility(object):
         return node_empty
 
     @staticmethod
-    def saveMRMLNodes(nodes, case_dir):
-        for i in range(len(nodes)):
-            MRMLUtility.saveMRMLNode(nodes[i], case_dir)
-
-    @staticmethod
-    def saveMRMLNode(node, case_dir):
-        if slicer.util.getNode(node.GetName()):
-            file_name = node.GetName()
-            class_name = node.GetClassName()
-            if class_name == 'vtkMRMLScalarVolumeNode' or class_name == 'vtkMRMLLabelMapVolumeNode':
-                file_name += '.nrrd'
-            elif class_name == 'vtkMRMLModelNode':
-                file_name += '.vtk'
-            elif class_name == 'vtkMRMLLinearTransformNode' or class_name == 'vtkMRMLTransformNode':
-                file_name += '.mat'
-            elif class_name == 'vtkMRMLMarkupsFiducialNode':
-                file_name += '.fcsv'
-            elif class_name == 'vtkMRMLDoubleArrayNode':
-                file_name += '.mcsv'
+    def saveMRMLNodes(nodes, case_dir, compress=False, number_of_workers=1, manifest_file_name=None):
+        # Saves the nodes with slicer.util.saveNode, as saveMRMLNode does. With compress or more than one worker,
+        # the models are written by a pool of writers from their polydata, taken on this thread so that the
+        # writers do not touch MRML, and the volumes are written on this thread, as gzip NRRD when compress is
+        # set. Returns the statistics of the export, and writes a manifest of the files if a name is given.
+        use_writers = compress or number_of_workers > 1
+        jobs = []
+        for node in nodes:
+            if not MRMLUtility.getNodeIndex().contains(node):
+                continue
+            job = {
+                'file': os.path.join(case_dir, MRMLUtility.getMRMLNodeFileName(node, compress)),
+                'name': node.GetName(),
+                'class': node.GetClassName(),
+            }
+            if use_writers and node.GetClassName() == 'vtkMRMLModelNode':
+                job['write'] = lambda path, polydata=node.GetPolyData(): \
+                    SurfaceUtility.writePolyData(polydata, path, compress)
+            elif use_writers and MRMLUtility.isVolumeNode(node):
+                job['write'] = lambda path, node=node: MRMLUtility.writeMRMLNode(node, path, compress)
+                job['serial'] = True
+            else:
+                # Saving through the scene has to stay on the main thread
+                job['write'] = lambda path, node=node: slicer.util.saveNode(node, path)
+                job['serial'] = True
+            jobs.append(job)
+
+        entries, statistics = ExportUtility.writeFiles(jobs, number_of_workers)
+        if manifest_file_name is not None:
+            ExportUtility.writeManifest(case_dir, entries, statistics, manifest_file_name)
+        logging.info('Saved in %s: %s', case_dir, ExportUtility.formatStatistics(statistics))
+        return statistics
+
+    @staticmethod
+    def isVolumeNode(node):
+        return node.GetClassName() in ['vtkMRMLScalarVolumeNode', 'vtkMRMLLabelMapVolumeNode']
+
+    @staticmethod
+    def writeMRMLNode(node, file_path, compress=False):
+        # Writes the data of a model or volume node without going through the scene. This reads the node,
+        # so it runs on the main thread.
+        class_name = node.GetClassName()
+        if class_name == 'vtkMRMLModelNode':
+            return SurfaceUtility.writePolyData(node.GetPolyData(), file_path, compress)
+        if MRMLUtility.isVolumeNode(node):
+            storage_node = slicer.vtkMRMLVolumeArchetypeStorageNode()
+            storage_node.SetFileName(file_path)
+            storage_node.SetUseCompression(1 if compress else 0)
+            return storage_node.WriteData(node) == 1
+        logging.error('!!! Unsupported node class for writing: %s', class_name)
+        return False
+
+    @staticmethod
+    def getMRMLNodeFileName(node, compress=False):
+        file_name = node.GetName()
+        class_name = node.GetClassName()
+        if class_name == 'vtkMRMLScalarVolumeNode' or class_name == 'vtkMRMLLabelMapVolumeNode':
+            file_name += '.nrrd'
+        elif class_name == 'vtkMRMLModelNode':
+            file_name += '.vtp' if compress else '.vtk'
+        elif class_name == 'vtkMRMLLinearTransformNode' or class_name == 'vtkMRMLTransformNode':
+            file_name += '.mat'
+        elif class_name == 'vtkMRMLMarkupsFiducialNode':
+            file_name += '.fcsv'
+        elif class_name == 'vtkMRMLDoubleArrayNode':
+            file_name += '.mcsv'
+        return file_name
+
+    @staticmethod
+    def saveMRMLNode(node, case_dir, compress=False):
+        if MRMLUtility.getNodeIndex().contains(node):
+            file_name = MRMLUtility.getMRMLNodeFileName(node, compress)
             file_path = os.path.join(case_dir, file_name)
             logging.info("Saving %s in %s", file_name, case_dir)
-            slicer.util.saveNode(node, file_path)
+            return slicer.util.saveNode(node, file_path)
+        return False
 
     @staticmethod
     def removeMRMLNodes(nodes):
-        for i in range(len(nodes)):
-            MRMLUtility.removeMRMLNode(nodes[i])
+        with MRMLUtility.batchProcess():
+            for node in nodes:
+                MRMLUtility.removeMRMLNode(node)
 
     @staticmethod
     def removeMRMLNode(node):
-        if slicer.util.getNode(node.GetName()):
+        if MRMLUtility.getNodeIndex().contains(node):
             slicer.mrmlScene.RemoveNode(node)
@@ -0,0 +1,506 @@
+import gzip
+import json
+import os
+import re
+import struct
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+import numpy
+from labelmap import LabelMapUtility
+from surface import SurfaceUtility
+
+#
+# ImageHeaderUtility
+#
+'''
+This class harbors the functions to read the geometry and pixel type of images
+from their headers, and their voxels without loading them in Slicer. Raw voxels
+are memory-mapped, compressed ones are decompressed in memory.
+'''
+
+
+class ImageHeaderUtility(object):
+    FORMATS = [('.nrrd', 'NRRD'), ('.nhdr', 'NRRD'), ('.nii.gz', 'NIfTI'), ('.nii', 'NIfTI'),
+               ('.mha', 'MetaImage'), ('.mhd', 'MetaImage'), ('.mgz', 'MGH'), ('.mgh', 'MGH')]
+
+    NRRD_TYPES = {
+        'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+        'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+        'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2',
+        'int16_t': 'i2',
+        'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+        'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+        'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+        'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+        'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+        'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8',
+        'uint64_t': 'u8',
+        'float': 'f4', 'double': 'f8',
+    }
+    NIFTI_TYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8',
+                   1280: 'u8'}
+    METAIMAGE_TYPES = {'MET_CHAR': 'i1', 'MET_UCHAR': 'u1', 'MET_SHORT': 'i2', 'MET_USHORT': 'u2', 'MET_INT': 'i4',
+                       'MET_UINT': 'u4', 'MET_LONG': 'i4', 'MET_ULONG': 'u4', 'MET_LONG_LONG': 'i8',
+                       'MET_ULONG_LONG': 'u8', 'MET_FLOAT': 'f4', 'MET_DOUBLE': 'f8'}
+    MGH_TYPES = {0: 'u1', 1: 'i4', 3: 'f4', 4: 'i2'}
+    NIFTI_HEADER_SIZE = 348
+    MGH_HEADER_SIZE = 284
+
+    @staticmethod
+    def getFormat(file_path):
+        for extension, file_format in ImageHeaderUtility.FORMATS:
+            if file_path.lower().endswith(extension):
+                return file_format
+        return None
+
+    @staticmethod
+    def readHeader(file_path):
+        # Returns a dictionary with the 'format', the 'size', 'spacing', axis 'directions' and 'origin'
+        # in LPS space, the numpy 'dtype' and number of 'components' of the voxels and where the voxels are
+        # stored. Raises ValueError if the format is not supported or the header is not valid.
+        readers = {
+            'NRRD': ImageHeaderUtility._readNRRDHeader,
+            'NIfTI': ImageHeaderUtility._readNIfTIHeader,
+            'MetaImage': ImageHeaderUtility._readMetaImageHeader,
+            'MGH': ImageHeaderUtility._readMGHHeader,
+        }
+        file_format = ImageHeaderUtility.getFormat(file_path)
+        if file_format is None:
+            raise ValueError('Unsupported file format')
+        return readers[file_format](file_path)
+
+    @staticmethod
+    def readVoxels(header):
+        # Flat array of the voxels, memory-mapped when they are stored raw.
+        # None if the encoding of the voxels is not supported.
+        if header['dataFile'] is None or header['encoding'] not in ['raw', 'gzip', 'zlib']:
+            return None
+        dtype = numpy.dtype(header['dtype'])
+        count = int(numpy.prod(header['size'])) * header['components']
+        data_size = count * dtype.itemsize
+        byte_skip = header['byteSkip']
+        if header['encoding'] == 'raw':
+            file_size = os.path.getsize(header['dataFile'])
+            if byte_skip == -1:
+                # The voxels are at the end of the file
+                offset = file_size - data_size
+            else:
+                offset = header['dataOffset'] + byte_skip
+            if offset < 0 or offset + data_size > file_size:
+                raise ValueError('Truncated voxel data')
+            if count == 0:
+                return numpy.zeros(0, dtype)
+            return numpy.memmap(header['dataFile'], dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+        with open(header['dataFile'], 'rb') as data_file:
+            data_file.seek(header['dataOffset'])
+            if header['encoding'] == 'gzip':
+                with gzip.GzipFile(fileobj=data_file, mode='rb') as gzip_file:
+                    data = gzip_file.read()
+            else:
+                data = zlib.decompress(data_file.read())
+        if byte_skip == -1:
+            byte_skip = len(data) - data_size
+        if byte_skip < 0 or byte_skip + data_size > len(data):
+            raise ValueError('Truncated voxel data')
+        return numpy.frombuffer(data, dtype, count, byte_skip)
+
+    @staticmethod
+    def _createHeader(file_format, sizes, axis_vectors, origin, dtype, components, data_file, data_offset,
+                      byte_skip, encoding, ras=False):
+        # axis_vectors are the spacing times the direction of each spatial axis. Images with less than
+        # three axes get unit axes, RAS coordinates are converted to LPS.
+        sizes = list(sizes) + [1] * (3 - len(sizes))
+        axis_vectors = [numpy.array(vector, dtype=float) for vector in axis_vectors]
+        origin = numpy.array(list(origin) + [0.0] * (3 - len(origin)), dtype=float)[:3]
+        for axis in range(len(axis_vectors), 3):
+            axis_vectors.append(numpy.eye(3)[axis])
+        axis_vectors = [numpy.concatenate([vector, numpy.zeros(3)])[:3] for vector in axis_vectors[:3]]
+        if ras:
+            flip = numpy.array([-1.0, -1.0, 1.0])
+            axis_vectors = [vector * flip for vector in axis_vectors]
+            origin = origin * flip
+        spacing = [float(numpy.linalg.norm(vector)) for vector in axis_vectors]
+        directions = [[float(x) + 0.0 for x in (vector / norm if norm > 0 else vector)]
+                      for vector, norm in zip(axis_vectors, spacing)]
+        return {
+            'format': file_format,
+            'size': [int(size) for size in sizes[:3]],
+            'spacing': spacing,
+            'directions': directions,
+            'origin': [float(x) + 0.0 for x in origin],
+            'dtype': numpy.dtype(dtype).str,
+            'components': int(components),
+            'dataFile': data_file,
+            'dataOffset': data_offset,
+            'byteSkip': byte_skip,
+            'encoding': encoding,
+        }
+
+    @staticmethod
+    def _readNRRDHeader(file_path):
+        fields = {}
+        with open(file_path, 'rb') as nrrd_file:
+            if not nrrd_file.readline().startswith(b'NRRD'):
+                raise ValueError('Not a NRRD file')
+            while True:
+                line = nrrd_file.readline()
+                if not line:
+                    break
+                line = line.decode('latin-1').rstrip('\r\n')
+                if line == '':
+                    break
+                if line.startswith('#') or ':=' in line:
+                    continue
+                key, _, value = line.partition(':')
+                fields[key.strip().lower()] = value.strip()
+            data_offset = nrrd_file.tell()
+
+        dimension = int(fields['dimension'])
+        sizes = [int(size) for size in fields['sizes'].split()]
+        dtype = ImageHeaderUtility.NRRD_TYPES.get(fields['type'].lower())
+        if dtype is None:
+            raise ValueError('Unsupported pixel type: ' + fields['type'])
+        dtype = ('>' if fields.get('endian', 'little') == 'big' else '<') + dtype
+
+        axis_directions = [None if direction == 'none' else [float(x) for x in vector.split(',')]
+                           for vector, direction in re.findall(r'\(([^)]*)\)|(none)',
+                                                               fields.get('space directions', ''))]
+        if len(axis_directions) != dimension:
+            # Per axis spacings, the axes of kind domain or space are the spatial ones
+            kinds = fields.get('kinds', '').split()
+            spacings = fields.get('spacings', '').split()
+            spatial_axes = [axis for axis in range(dimension)
+                            if len(kinds) != dimension or kinds[axis].lower() in ['domain', 'space']]
+            axis_directions = [None] * dimension
+            for index, axis in enumerate(spatial_axes[:3]):
+                spacing = float(spacings[axis]) if axis < len(spacings) and spacings[axis] != 'nan' else 1.0
+                axis_directions[axis] = list(numpy.eye(3)[index] * spacing)
+        spatial_axes = [axis for axis in range(dimension) if axis_directions[axis] is not None]
+        components = int(numpy.prod([sizes[axis] for axis in range(dimension) if axis not in spatial_axes]))
+        origin = [float(x) for x in fields.get('space origin', '').strip('()').split(',') if x.strip()]
+        space = fields.get('space', '').lower()
+
+        data_file = file_path
+        file_name = fields.get('data file', fields.get('datafile'))
+        if file_name is not None:
+            data_offset = 0
+            if file_name.startswith('LIST') or len(file_name.split()) > 1:
+                # Data split in several files, the voxels are not read
+                data_file = None
+            else:
+                data_file = os.path.join(os.path.dirname(file_path), file_name)
+        if int(fields.get('line skip', fields.get('lineskip', 0))) > 0:
+            data_file = None
+        encoding = fields.get('encoding', 'raw').lower()
+        encoding = 'gzip' if encoding == 'gz' else encoding
+
+        return ImageHeaderUtility._createHeader(
+            'NRRD', [sizes[axis] for axis in spatial_axes], [axis_directions[axis] for axis in spatial_axes],
+            origin, dtype, components, data_file, data_offset,
+            int(fields.get('byte skip', fields.get('byteskip', 0))), encoding,
+            space in ['right-anterior-superior', 'ras'])
+
+    @staticmethod
+    def _readNIfTIHeader(file_path):
+        compressed = file_path.lower().endswith('.gz')
+        with (gzip.open if compressed else open)(file_path, 'rb') as nifti_file:
+            data = nifti_file.read(ImageHeaderUtility.NIFTI_HEADER_SIZE)
+        if len(data) < ImageHeaderUtility.NIFTI_HEADER_SIZE:
+            raise ValueError('Truncated NIfTI header')
+        endian = '<'
+        if struct.unpack('<i', data[:4])[0] != ImageHeaderUtility.NIFTI_HEADER_SIZE:
+            endian = '>'
+            if struct.unpack('>i', data[:4])[0] != ImageHeaderUtility.NIFTI_HEADER_SIZE:
+                raise ValueError('Not a NIfTI-1 file')
+        if data[344:347] != b'n+1':
+            raise ValueError('Only single file NIfTI images are supported')
+        dim = struct.unpack(endian + '8h', data[40:56])
+        datatype = struct.unpack(endian + 'h', data[70:72])[0]
+        pixdim = struct.unpack(endian + '8f', data[76:108])
+        vox_offset = int(struct.unpack(endian + 'f', data[108:112])[0])
+        qform_code, sform_code = struct.unpack(endian + '2h', data[252:256])
+        quatern = struct.unpack(endian + '6f', data[256:280])
+        srow = numpy.array(struct.unpack(endian + '12f', data[280:328])).reshape(3, 4)
+        if datatype not in ImageHeaderUtility.NIFTI_TYPES:
+            raise ValueError('Unsupported NIfTI datatype: %d' % datatype)
+
+        number_of_axes = min(max(dim[0], 1), 7)
+        spatial_size = min(number_of_axes, 3)
+        spacing = [abs(pixdim[axis + 1]) or 1.0 for axis in range(3)]
+        if sform_code > 0:
+            axis_vectors = [srow[:, axis] for axis in range(3)]
+            origin = srow[:, 3]
+        elif qform_code > 0:
+            b, c, d = quatern[:3]
+            a = numpy.sqrt(max(0.0, 1.0 - b * b - c * c - d * d))
+            rotation = numpy.array([
+                [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+            qfac = -1.0 if pixdim[0] < 0 else 1.0
+            axis_vectors = [rotation[:, axis] * spacing[axis] * (qfac if axis == 2 else 1.0) for axis in range(3)]
+            origin = quatern[3:6]
+        else:
+            axis_vectors = [numpy.eye(3)[axis] * spacing[axis] for axis in range(3)]
+            origin = [0.0, 0.0, 0.0]
+
+        return ImageHeaderUtility._createHeader(
+            'NIfTI', dim[1:spatial_size + 1], axis_vectors[:spatial_size], origin,
+            endian + ImageHeaderUtility.NIFTI_TYPES[datatype],
+            int(numpy.prod(dim[4:number_of_axes + 1])) if number_of_axes > 3 else 1,
+            file_path, 0, vox_offset, 'gzip' if compressed else 'raw', True)
+
+    @staticmethod
+    def _readMetaImageHeader(file_path):
+        fields = {}
+        with open(file_path, 'rb') as meta_file:
+            while True:
+                line = meta_file.readline()
+                if not line:
+                    break
+                key, _, value = line.decode('latin-1').partition('=')
+                fields[key.strip()] = value.strip()
+                if key.strip() == 'ElementDataFile':
+                    break
+            data_offset = meta_file.tell()
+
+        dimension = int(fields['NDims'])
+        sizes = [int(size) for size in fields['DimSize'].split()]
+        spacing = [float(x) for x in fields.get('ElementSpacing', fields.get('ElementSize', '')).split()]
+        spacing = spacing + [1.0] * (dimension - len(spacing))
+        matrix = fields.get('TransformMatrix', fields.get('Rotation', fields.get('Orientation', '')))
+        matrix = [float(x) for x in matrix.split()]
+        if len(matrix) != dimension * dimension:
+            matrix = list(numpy.eye(dimension).ravel())
+        axis_vectors = [numpy.array(matrix[axis * dimension:(axis + 1) * dimension]) * spacing[axis]
+                        for axis in range(dimension)]
+        origin = fields.get('Offset', fields.get('Origin', fields.get('Position', '')))
+        dtype = ImageHeaderUtility.METAIMAGE_TYPES.get(fields['ElementType'])
+        if dtype is None:
+            raise ValueError('Unsupported pixel type: ' + fields['ElementType'])
+        big_endian = fields.get('BinaryDataByteOrderMSB', fields.get('ElementByteOrderMSB', 'False'))
+        dtype = ('>' if big_endian.lower() == 'true' else '<') + dtype
+
+        data_file = file_path
+        byte_skip = 0
+        file_name = fields.get('ElementDataFile', '')
+        if file_name != 'LOCAL':
+            data_offset = 0
+            byte_skip = int(fields.get('HeaderSize', 0))
+            if file_name in ['', 'LIST'] or len(file_name.split()) > 1:
+                data_file = None
+            else:
+                data_file = os.path.join(os.path.dirname(file_path), file_name)
+        encoding = 'zlib' if fields.get('CompressedData', 'False').lower() == 'true' else 'raw'
+
+        return ImageHeaderUtility._createHeader(
+            'MetaImage', sizes[:3], axis_vectors[:3], [float(x) for x in origin.split()], dtype,
+            int(fields.get('ElementNumberOfChannels', 1)), data_file, data_offset, byte_skip, encoding)
+
+    @staticmethod
+    def _readMGHHeader(file_path):
+        compressed = file_path.lower().endswith('.mgz')
+        with (gzip.open if compressed else open)(file_path, 'rb') as mgh_file:
+            data = mgh_file.read(ImageHeaderUtility.MGH_HEADER_SIZE)
+        if len(data) < 90:
+            raise ValueError('Truncated MGH header')
+        _, width, height, depth, frames, data_type, _ = struct.unpack('>7i', data[:28])
+        if data_type not in ImageHeaderUtility.MGH_TYPES:
+            raise ValueError('Unsupported MGH data type: %d' % data_type)
+        sizes = [width, height, depth]
+        if struct.unpack('>h', data[28:30])[0] > 0:
+            spacing = struct.unpack('>3f', data[30:42])
+            directions = numpy.array(struct.unpack('>9f', data[42:78])).reshape(3, 3)
+            center = numpy.array(struct.unpack('>3f', data[78:90]))
+        else:
+            # Coronal conformed space of FreeSurfer
+            spacing = (1.0, 1.0, 1.0)
+            directions = numpy.array([[-1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+            center = numpy.zeros(3)
+        axis_vectors = [directions[axis] * spacing[axis] for axis in range(3)]
+        origin = center - sum(axis_vectors[axis] * sizes[axis] / 2.0 for axis in range(3))
+
+        return ImageHeaderUtility._createHeader(
+            'MGH', sizes, axis_vectors, origin, '>' + ImageHeaderUtility.MGH_TYPES[data_type], frames,
+            file_path, 0, ImageHeaderUtility.MGH_HEADER_SIZE, 'gzip' if compressed else 'raw', True)
+
+
+#
+# CohortValidationUtility
+#
+'''
+This class harbors the functions to check that the labelmaps of a cohort can be
+imported together before loading any of them: geometry, pixel type and labels
+are read from the files directly, without creating MRML nodes. Surface files have
+no voxels, they are checked to be readable and count as a case with label 1, as
+they are imported.
+'''
+
+
+class CohortValidationUtility(object):
+    SPACING_TOLERANCE = 1e-3  # Relative
+    DIRECTION_TOLERANCE = 1e-3
+
+    @staticmethod
+    def inspectFile(file_path, check_labels=True):
+        # Returns a dictionary with the geometry, pixel type and labels of a labelmap and the
+        # 'errors' and 'warnings' found in this file alone
+        start_time = time.time()
+        case = {'file': file_path, 'labels': None, 'errors': [], 'warnings': []}
+        if SurfaceUtility.isSurfaceFile(file_path):
+            case['format'] = 'Surface'
+            if check_labels:
+                if SurfaceUtility.readSurfaceFile(file_path) is None:
+                    case['errors'].append('Surface could not be read')
+                else:
+                    case['labels'] = [1]
+            elif not os.path.isfile(file_path):
+                case['errors'].append('Surface file not found')
+            case['seconds'] = time.time() - start_time
+            return case
+        try:
+            header = ImageHeaderUtility.readHeader(file_path)
+        except (IOError, OSError, ValueError, KeyError, IndexError, struct.error, zlib.error, EOFError) as e:
+            case['errors'].append('Header could not be read: ' + str(e))
+            case['seconds'] = time.time() - start_time
+            return case
+        for key in ['format', 'size', 'spacing', 'directions', 'origin', 'components']:
+            case[key] = header[key]
+        case['pixelType'] = numpy.dtype(header['dtype']).name
+
+        if header['components'] != 1:
+            case['errors'].append('%d components per voxel, a labelmap has one' % header['components'])
+        elif check_labels:
+            try:
+                voxels = ImageHeaderUtility.readVoxels(header)
+                if voxels is None:
+                    case['warnings'].append('Labels not checked, the voxels are stored with the %s encoding or '
+                                            'in several files' % header['encoding'])
+                else:
+                    case['labels'] = LabelMapUtility.getStructureLabels(LabelMapUtility.getArrayLabelCounts(voxels))
+                    del voxels
+                    if len(case['labels']) == 0:
+                        case['errors'].append('No structure, the labelmap only has background')
+            except (IOError, OSError, ValueError, zlib.error, EOFError) as e:
+                case['errors'].append('Voxels could not be read: ' + str(e))
+        if numpy.dtype(header['dtype']).kind == 'f':
+            case['warnings'].append('Floating point voxels, the labels are rounded')
+        case['seconds'] = time.time() - start_time
+        return case
+
+    @staticmethod
+    def validateCohort(file_paths, case_names=None, check_labels=True, strict_geometry=False, number_of_workers=4):
+        # Inspects the files in parallel and compares each case with the most common values of the cohort.
+        # Label sets that differ are errors, as the import would stop on them. Size, spacing, orientation
+        # and pixel type that differ are warnings, or errors with strict_geometry.
+        start_time = time.time()
+        if case_names is None:
+            case_names = [os.path.basename(file_path) for file_path in file_paths]
+        inspect = lambda file_path: CohortValidationUtility.inspectFile(file_path, check_labels)
+        if number_of_workers > 1 and len(file_paths) > 1:
+            pool = ThreadPool(min(number_of_workers, len(file_paths)))
+            try:
+                cases = pool.map(inspect, file_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            cases = [inspect(file_path) for file_path in file_paths]
+        for case, case_name in zip(cases, case_names):
+            case['name'] = case_name
+
+        reference = {}
+        for key in ['size', 'spacing', 'directions', 'pixelType', 'labels']:
+            reference[key] = CohortValidationUtility._getMostCommonValue(
+                [case[key] for case in cases if case.get(key) is not None])
+
+        for case in cases:
+            if case['labels'] is not None and reference['labels'] is not None and \
+                    case['labels'] != reference['labels']:
+                missing_labels = sorted(set(reference['labels']) - set(case['labels']))
+                extra_labels = sorted(set(case['labels']) - set(reference['labels']))
+                case['errors'].append('Labels differ from the cohort, missing: %s, extra: %s' % (
+                    missing_labels, extra_labels))
+            # Surfaces and files whose header could not be read have no geometry
+            if 'size' not in case:
+                continue
+            geometry_problems = case['errors'] if strict_geometry else case['warnings']
+            if case['size'] != reference['size']:
+                geometry_problems.append('Size %s differs from %s' % (case['size'], reference['size']))
+            if numpy.any(numpy.abs(numpy.array(case['spacing']) - reference['spacing']) >
+                         CohortValidationUtility.SPACING_TOLERANCE * numpy.abs(reference['spacing'])):
+                geometry_problems.append('Spacing %s differs from %s' % (
+                    CohortValidationUtility._formatVector(case['spacing']),
+                    CohortValidationUtility._formatVector(reference['spacing'])))
+            if numpy.any(numpy.abs(numpy.array(case['directions']) - reference['directions']) >
+                         CohortValidationUtility.DIRECTION_TOLERANCE):
+                geometry_problems.append('Orientation differs from the cohort')
+            if case['pixelType'] != reference['pixelType']:
+                geometry_problems.append('Pixel type %s differs from %s' % (case['pixelType'], reference['pixelType']))
+
+        return {
+            'cases': cases,
+            'reference': reference,
+            'numberOfCases': len(cases),
+            'numberOfInvalidCases': len([case for case in cases if len(case['errors']) > 0]),
+            'numberOfWarnings': sum(len(case['warnings']) for case in cases),
+            'valid': all(len(case['errors']) == 0 for case in cases),
+            'strictGeometry': strict_geometry,
+            'seconds': time.time() - start_time,
+        }
+
+    @staticmethod
+    def getValidCases(report):
+        # Indices of the cases without errors, in the order of the files
+        return [index for index, case in enumerate(report['cases']) if len(case['errors']) == 0]
+
+    @staticmethod
+    def formatSummary(report):
+        return '%d/%d cases invalid, %d warnings, %d cases checked in %.1f s' % (
+            report['numberOfInvalidCases'], report['numberOfCases'], report['numberOfWarnings'],
+            report['numberOfCases'], report['seconds'])
+
+    @staticmethod
+    def formatReport(report, number_of_cases=10):
+        # Summary followed by the problems of the first cases that have some
+        lines = [CohortValidationUtility.formatSummary(report)]
+        reference = report['reference']
+        if reference['size'] is not None:
+            lines.append('Cohort: size %s, spacing %s, %s voxels, labels %s' % (
+                reference['size'], CohortValidationUtility._formatVector(reference['spacing']),
+                reference['pixelType'], reference['labels']))
+        problem_cases = [case for case in report['cases'] if case['errors'] or case['warnings']]
+        for case in problem_cases[:number_of_cases]:
+            for error in case['errors']:
+                lines.append('ERROR: %s: %s' % (case['name'], error))
+            for warning in case['warnings']:
+                lines.append('WARNING: %s: %s' % (case['name'], warning))
+        if len(problem_cases) > number_of_cases:
+            lines.append('... and %d more cases' % (len(problem_cases) - number_of_cases))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def writeReport(file_path, report):
+        with open(file_path, 'w') as report_file:
+            json.dump(report, report_file, indent=1, sort_keys=True)
+
+    @staticmethod
+    def _getMostCommonValue(values):
+        # Most common value, the first one seen wins a tie. Floating point values are compared rounded.
+        counts = {}
+        first_indices = {}
+        for index, value in enumerate(values):
+            key = json.dumps(numpy.round(numpy.array(value, dtype=float), 4).tolist()) \
+                if not isinstance(value, str) else value
+            counts[key] = counts.get(key, 0) + 1
+            first_indices.setdefault(key, index)
+        if len(counts) == 0:
+            return None
+        most_common_key = max(counts.keys(), key=lambda key: (counts[key], -first_indices[key]))
+        return values[first_indices[most_common_key]]
+
+    @staticmethod
+    def _formatVector(vector):
+        return '(' + ', '.join('%g' % x for x in vector) + ')'
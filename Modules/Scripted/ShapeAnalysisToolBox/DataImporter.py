@@ -1,7 +1,16 @@
-import vtk, qt, ctk, slicer
+import vtk, qt, slicer
 from slicer.ScriptedLoadableModule import *
 from CommonUtilities import *
+import argparse
+import bisect
+import collections
 import csv
+import json
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 #
 # DataImporter
@@ -33,20 +42,185 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
   def __init__(self):
     ScriptedLoadableModuleLogic.__init__(self)
 
-    self.saveCleanedData = False
+    self.saveCleanData = False
+    self.caseNames = [] # Imported cases, in the order of the input files
     self.testCaseDict = {}
     self.segmentationDict = {}
+    self.casePathDict = {} # Input file of each case, to read it again once its nodes were released
+    self.releaseVoxelData = False
+    self.releasedCaseNames = set() # Cases whose labelmap is read again when their segmentation is shown
+    self.reloadedCaseName = None
+    self.cacheKeyDict = {}
+    self.cachedCaseNames = set()
     self.topologyDict = {}
-    self.consistentTopologyDict = {}
-    self.polyDataDict = {}
-
+    self.topologyDetailsDict = {}
+    self.topologyMatrix = TopologyMatrix()
+    self.polyDataDict = MeshStore()
+    self.previewPolyDataDict = MeshStore() # Decimated meshes shown while browsing the cohort
+    self.previewNumberOfTriangles = 20000
+    self.previewPool = None
+    self.previewLock = threading.Lock()
+    self.pendingPreviews = set()
+    self.previewGeneration = 0
+    self.profiler = PipelineProfiler() # Wall time, sizes and memory of each stage of each case, see SetProfiling
+
+    # Created the first time a structure is shown, see displaySegment
     self.singleDisplayedSegmentation = None
-    self.createSingleDisplaySegmentModelNode()
     self.labelRangeInCohort = (-1, -1)
+    self.labelsInCohort = () # Labels of the structures, without the background
+    self.labelCountsDict = {}
+    self.numberOfWorkers = 1
+    self.surfaceExtractionMode = 'Segmentation'
+    self.componentFiltering = False
+    self.fillHoles = False
+    self.maximumHoleSize = 1000
+    self.componentsDict = {} # Number of voxel components of each label before filtering
+    self.surfaceCache = None
+    self.importJournal = None
+    self.journalSignatureDict = {} # Signature of the input file of each case, when the import is journaled
+    self.importFinished = False # All the files of the last import were processed, it was not interrupted
+    self.skipMismatchedCases = False
+    self.validationReport = None
+    self.evaluatedTopology = set() # (case, label) pairs whose topology is known or that have no surface
+    self.topologyPool = None # Evaluates the topology of the cohort in the background
+    self.topologyTasks = {} # label -> case -> index of the case, for the pairs left to the pool
+    self.topologyPriorityLabel = None
 
   def SetSaveCleanData(self, save):
     self.saveCleanData = save
 
+  #
+  # If set, cases whose label range does not match the cohort are left out instead of stopping the import
+  #
+  def SetSkipMismatchedCases(self, skip):
+    self.skipMismatchedCases = skip
+
+  #
+  # Number of threads that evaluate the topology and write the exported files. In the 'MultiLabel' mode, also
+  # the number of cases loaded and converted to surfaces in parallel, see iterLoadCases.
+  #
+  def SetNumberOfWorkers(self, numberOfWorkers):
+    self.numberOfWorkers = max(1, int(numberOfWorkers))
+
+  #
+  # 'Segmentation' creates the surfaces of each label with the closed surface conversion of the
+  # segmentation node. 'MultiLabel' extracts the surfaces of all labels in one pass over the volume,
+  # the closed surfaces of the segmentation are then only created when the whole segmentation is shown.
+  #
+  def SetSurfaceExtractionMode(self, mode):
+    self.surfaceExtractionMode = mode
+
+  #
+  # Keep the largest connected component of each label on the voxel grid before the surfaces are
+  # extracted, and optionally fill the cavities of at most maximumHoleSize voxels.
+  #
+  def SetComponentFiltering(self, enabled, fillHoles=False, maximumHoleSize=1000):
+    self.componentFiltering = enabled
+    self.fillHoles = fillHoles
+    self.maximumHoleSize = maximumHoleSize
+
+  #
+  # Remove the labelmap and segmentation nodes of each case once the surfaces and topology of all its labels
+  # are known, so that only the meshes stay in memory. The labelmap of a case is read again from its file
+  # when its whole segmentation is shown, and only the last one that was shown is kept.
+  #
+  def SetReleaseVoxelData(self, release):
+    self.releaseVoxelData = release
+
+  #
+  # Cache the surfaces and topology of each case on disk, keyed by the content of the file and
+  # the processing parameters. An empty cacheDirectory disables the cache.
+  #
+  def SetSurfaceCache(self, cacheDirectory, maximumSize=2 * 1024 ** 3):
+    if not cacheDirectory:
+      self.surfaceCache = None
+    elif self.surfaceCache is None or self.surfaceCache.cache_dir != cacheDirectory:
+      self.surfaceCache = SurfaceCache(cacheDirectory, maximumSize)
+    else:
+      self.surfaceCache.setMaximumSize(maximumSize)
+
+  #
+  # Record each finished case in a journal, so that an import that was interrupted skips the cases that
+  # were finished and whose files did not change. An empty journalDirectory disables the journal.
+  #
+  def SetImportJournal(self, journalDirectory):
+    if not journalDirectory:
+      self.importJournal = None
+    elif self.importJournal is None or self.importJournal.journal_dir != journalDirectory:
+      self.importJournal = ImportJournal(journalDirectory)
+
+  #
+  # Memory budget, in bytes, of the meshes kept in memory. The other meshes are written to disk.
+  #
+  def SetMeshMemoryBudget(self, memoryBudget):
+    self.polyDataDict.setMemoryBudget(memoryBudget)
+
+  #
+  # Approximate size of the preview meshes shown while browsing, 0 always shows the full resolution
+  #
+  def SetPreviewNumberOfTriangles(self, numberOfTriangles):
+    self.previewNumberOfTriangles = max(0, int(numberOfTriangles))
+    self.clearPreviews()
+
+  #
+  # Record the wall time, sizes and memory of each stage of each case. Off by default, as each stage then
+  # reads the memory of the process and the records grow with the number of cases.
+  #
+  def SetProfiling(self, enabled):
+    self.profiler.setEnabled(enabled)
+
+  #
+  # Per stage count, total, mean and max durations of the import and topology computation
+  #
+  def getProfileSummary(self):
+    return self.profiler.getStageSummary()
+
+  def getProfileRecords(self, nodeName=None):
+    return self.profiler.getRecords(nodeName)
+
+  #
+  # Write the stages of all the cases as a trace that chrome://tracing or Perfetto can open
+  #
+  def writeProfileTrace(self, filePath):
+    self.profiler.writeTrace(filePath)
+
+  def getMeshStoreStatistics(self):
+    return self.polyDataDict.getStatistics()
+
+  def getSurfaceCacheStatistics(self):
+    return self.surfaceCache.getStatistics() if self.surfaceCache is not None else None
+
+  #
+  # Resident memory of the process now and at its peak, in bytes. The peak is the largest value sampled by
+  # the stages of the last import when profiling, the peak of the whole process otherwise. Values that
+  # cannot be read on this platform are None.
+  #
+  def getMemoryStatistics(self):
+    current = PipelineProfiler.getResidentMemory()
+    processPeak = PipelineProfiler.getPeakResidentMemory()
+    peak = processPeak
+    if self.profiler.enabled and current is not None:
+      peak = max(self.profiler.getPeakMemory(), current)
+    return {
+      'current': current,
+      'peak': peak,
+      'processPeak': processPeak,
+      'loadedCases': len(self.testCaseDict),
+      'releasedCases': len(self.releasedCaseNames) - (1 if self.reloadedCaseName is not None else 0),
+    }
+
+  #
+  # Parameters that change the surfaces or topology computed for a file
+  #
+  def getProcessingParameters(self):
+    return {
+      'saveCleanData': bool(self.saveCleanData),
+      'surfaceExtractionMode': self.surfaceExtractionMode,
+      'componentFiltering': bool(self.componentFiltering),
+      'fillHoles': bool(self.componentFiltering and self.fillHoles),
+      'maximumHoleSize': self.maximumHoleSize if self.componentFiltering and self.fillHoles else 0,
+    }
+
   def createSingleDisplaySegmentModelNode(self):
     if MRMLUtility.isMRMLNodeEmpty(self.singleDisplayedSegmentation, 'vtkMRMLModelNode'):
       self.singleDisplayedSegmentation = MRMLUtility.createNewMRMLNode('CurrentSegmentation', slicer.vtkMRMLModelNode())
@@ -58,136 +232,737 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
   def cleanup(self):
     print 'Deleting nodes'
     if self.testCaseDict is not None:
+      # All the nodes are removed in a single batch of scene events
+      nodes = []
       for node_name in self.testCaseDict.keys():
-        print 'Deleting node: ' + node_name
-        MRMLUtility.removeMRMLNode(self.testCaseDict[node_name])
-        MRMLUtility.removeMRMLNode(self.segmentationDict[node_name])
+        nodes.append(self.testCaseDict[node_name])
+        if node_name in self.segmentationDict:
+          nodes.append(self.segmentationDict[node_name])
+      print 'Deleting ' + str(len(nodes)) + ' nodes'
+      MRMLUtility.removeMRMLNodes(nodes)
+    self.caseNames = []
+    self.testCaseDict = {}
+    self.segmentationDict = {}
+    self.casePathDict = {}
+    self.releasedCaseNames = set()
+    self.reloadedCaseName = None
+    self.cacheKeyDict = {}
+    self.cachedCaseNames = set()
+    self.journalSignatureDict = {}
+    self.importFinished = False
 
     if self.singleDisplayedSegmentation is not None:
       MRMLUtility.removeMRMLNode(self.singleDisplayedSegmentation)
       self.singleDisplayedSegmentation = None
 
     self.labelRangeInCohort = (-1, -1)
+    self.labelsInCohort = ()
+    self.labelCountsDict = {} # Number of voxels of each label
+    self.componentsDict = {}
     self.topologyDict = {}
-    self.consistentTopologyDict = {}
-    self.polyDataDict = {} # Dictionary that has all the segmentations.
+    self.topologyDetailsDict = {} # Euler number, genus, boundary loops and non-manifold edges
+    self.topologyMatrix.clear() # Euler characteristics of the cohort, cases x labels
+    if self.topologyPool is not None:
+      self.topologyPool.clear()
+    self.evaluatedTopology = set()
+    self.topologyTasks = {}
+    self.polyDataDict.clear() # Store that has all the segmentations.
+    self.clearPreviews()
+    self.profiler.clear()
+
+  def importFiles(self, filePaths, caseNames=None):
+    # Nothing is shown until the end of the import, the scene events are sent at once
+    with MRMLUtility.batchProcess():
+      for caseEvent in self.iterImportFiles(filePaths, caseNames):
+        if caseEvent['status'] == 'mismatch':
+          return False
+
+    print 'Cohort labels are: ' + str(list(self.labelsInCohort))
+    return True
 
-  def importFiles(self, filePaths):
+  #
+  # Import the files one case at a time. Yields for each file a dictionary with its 'name', its 'index'
+  # in filePaths, the 'total' number of files and a 'status':
+  #  - 'imported': the case was added to the scene
+  #  - 'failed': the case could not be loaded, see 'message'
+  #  - 'skipped': the labels do not match the cohort and skipMismatchedCases is set
+  #  - 'mismatch': the labels do not match the cohort, the import stops
+  # The cases are named after caseNames if given, after their file names otherwise.
+  # The import can be cancelled by closing the generator.
+  #
+  def iterImportFiles(self, filePaths, caseNames=None):
+
+    if caseNames is None:
+      caseNames = [os.path.basename(path) for path in filePaths]
+    self.importFinished = False
+    if self.importJournal is not None:
+      self.importJournal.begin(self.getProcessingParameters())
+    # The nodes are created and added to the scene here, in the order of filePaths
+    caseResults = self.iterLoadCases(filePaths, caseNames)
+
+    try:
+      for index, caseResult in enumerate(caseResults):
+        caseEvent = {
+          'name': caseResult['name'],
+          'index': index,
+          'total': len(filePaths),
+          'status': 'imported',
+          'message': '',
+        }
+        if caseResult['error'] is not None:
+          print 'ERROR: ' + caseResult['error']
+          caseEvent['status'] = 'failed'
+          caseEvent['message'] = caseResult['error']
+          yield caseEvent
+          continue
 
-    for path in filePaths:
-      # load each file
-      pathPair = os.path.split(path)
-      directory = pathPair[0]
-      fileName = pathPair[1]
+        # the labels of each file have to match the ones of the cohort
+        labels = tuple(LabelMapUtility.getStructureLabels(caseResult['labelCounts']))
+        if len(self.caseNames) > 0 and labels != self.labelsInCohort:
+          caseEvent['message'] = 'Labels do not match in the cohort for case: ' + caseResult['name']
+          print 'ERROR: ' + caseEvent['message']
+          if self.skipMismatchedCases:
+            caseEvent['status'] = 'skipped'
+            yield caseEvent
+            continue
+          caseEvent['status'] = 'mismatch'
+          yield caseEvent
+          return
+
+        if caseResult['imageData'] is not None:
+          error = self.createCaseNodes(caseResult)
+          if error is not None:
+            print 'ERROR: ' + error
+            caseEvent['status'] = 'failed'
+            caseEvent['message'] = error
+            yield caseEvent
+            continue
+
+        self.labelsInCohort = labels
+        self.labelRangeInCohort = LabelMapUtility.getLabelRange(caseResult['labelCounts'])
+        with self.profiler.stage(caseResult['name'], 'registerCase'):
+          self.registerCase(caseResult)
+        yield caseEvent
+      self.importFinished = True
+    finally:
+      caseResults.close()
 
-      self.testCaseDict[fileName] = MRMLUtility.loadMRMLNode(fileName, directory, fileName, 'LabelMap')
-      if self.testCaseDict[fileName] is None:
-        print 'ERROR: Failed to load ' + fileName + 'as a labelmap'
-        # make sure each one is a labelmap
-        continue
+  #
+  # Results of loadCase for each file, in order. In MultiLabel mode, the reading and surface extraction of
+  # the next cases run in numberOfWorkers threads on VTK and NumPy data that no other thread sees. In
+  # Segmentation mode, the closed surfaces are created by the segmentation node, on the main thread, so the
+  # cases are loaded one at a time. At most two cases per worker are loaded ahead, so that the labelmaps of
+  # the whole cohort are not held while the main thread adds them to the scene.
+  #
+  def iterLoadCases(self, filePaths, caseNames):
+    if self.surfaceExtractionMode != 'MultiLabel' or self.numberOfWorkers < 2 or len(filePaths) < 2:
+      for path, caseName in zip(filePaths, caseNames):
+        yield self.loadCase(path, caseName)
+      return
+
+    numberOfWorkers = min(self.numberOfWorkers, len(filePaths))
+    pool = ThreadPool(numberOfWorkers)
+    try:
+      pending = collections.deque()
+      for path, caseName in zip(filePaths, caseNames):
+        if len(pending) == 2 * numberOfWorkers:
+          yield pending.popleft().get()
+        pending.append(pool.apply_async(self.loadCase, (path, caseName)))
+      while len(pending) > 0:
+        yield pending.popleft().get()
+    finally:
+      pool.terminate()
+      pool.join()
+
+  #
+  # Read the voxels of a labelmap, and extract its surfaces in MultiLabel mode, or read a surface file.
+  # Only VTK and NumPy objects that no other thread uses are created, no MRML node, so this can run in a
+  # worker thread. The nodes are created by createCaseNodes on the main thread.
+  #
+  def loadCase(self, path, caseName=None):
+    pathPair = os.path.split(path)
+    fileName = caseName if caseName is not None else pathPair[1]
+    caseResult = {
+      'name': fileName,
+      'path': path,
+      'imageData': None,
+      'ijkToRAS': None,
+      'labelmapNode': None,
+      'segmentationNode': None,
+      'labelCounts': None,
+      'components': None,
+      'surfaces': None,
+      'cacheKey': None,
+      'journalSignature': None,
+      'record': None,
+      'journaled': False,
+      'error': None,
+    }
+
+    try:
+      if self.importJournal is not None:
+        # Cases finished by an interrupted import are reused if their file did not change
+        with self.profiler.stage(fileName, 'journalLookup') as stageRecord:
+          caseResult['journalSignature'] = ImportJournal.computeSignature(path)
+          record = self.importJournal.load(fileName, caseResult['journalSignature'])
+          stageRecord['hit'] = record is not None and 'labelCounts' in record
+        if stageRecord['hit']:
+          caseResult['record'] = record
+          caseResult['labelCounts'] = record['labelCounts']
+          caseResult['journaled'] = True
+          if SurfaceUtility.isSurfaceFile(path):
+            return caseResult
+
+      if SurfaceUtility.isSurfaceFile(path):
+        # Surfaces are the structures of their case as label 1, without labelmap, segmentation or cache.
+        # The number of triangles stands for the number of voxels of the label.
+        with self.profiler.stage(fileName, 'readSurface') as stageRecord:
+          polydata = SurfaceUtility.readSurfaceFile(path)
+          if polydata is None:
+            caseResult['error'] = 'Failed to load ' + path + ' as a surface'
+            return caseResult
+          stageRecord['triangles'] = polydata.GetNumberOfPolys()
+        caseResult['surfaces'] = {1: polydata}
+        caseResult['labelCounts'] = {1: polydata.GetNumberOfPolys()}
+        return caseResult
+
+      if self.surfaceCache is not None and not caseResult['journaled']:
+        with self.profiler.stage(fileName, 'cacheLookup') as stageRecord:
+          caseResult['cacheKey'] = self.surfaceCache.computeKey(path, self.getProcessingParameters())
+          record = self.surfaceCache.load(caseResult['cacheKey'])
+          stageRecord['hit'] = record is not None and 'labelCounts' in record
+        if stageRecord['hit']:
+          # Surfaces and topology are reused, the segmentation is only created if it is shown
+          caseResult['record'] = record
+          caseResult['labelCounts'] = record['labelCounts']
+
+      if caseResult['record'] is not None:
+        # The labelmap is only read if the whole segmentation is shown, see getLabelmapNode
+        return caseResult
+
+      with self.profiler.stage(fileName, 'readLabelmap') as stageRecord:
+        imageData, ijkToRAS = LabelMapUtility.readLabelmap(path)
+        if imageData is None:
+          caseResult['error'] = 'Failed to load ' + path + ' as a labelmap'
+          return caseResult
+        stageRecord['voxels'] = imageData.GetNumberOfPoints()
+      caseResult['imageData'] = imageData
+      caseResult['ijkToRAS'] = ijkToRAS
+
+      # One pass over the voxels gives the labels that are actually present
+      with self.profiler.stage(fileName, 'labelCounts') as stageRecord:
+        labelCounts = LabelMapUtility.getLabelCounts(imageData)
+        stageRecord['labels'] = len(labelCounts)
+
+      if self.componentFiltering:
+        # Only the largest component of each label is meshed
+        with self.profiler.stage(fileName, 'componentFiltering') as stageRecord:
+          caseResult['components'] = LabelMapUtility.filterComponents(
+            imageData, LabelMapUtility.getStructureLabels(labelCounts), self.fillHoles, self.maximumHoleSize)
+          stageRecord['removedVoxels'] = 0
+          for label, statistics in caseResult['components'].items():
+            labelCounts[label] += statistics['filledVoxels'] - statistics['removedVoxels']
+            labelCounts[0] = labelCounts.get(0, 0) + statistics['removedVoxels'] - statistics['filledVoxels']
+            stageRecord['removedVoxels'] += statistics['removedVoxels']
+
+      if self.surfaceExtractionMode == 'MultiLabel':
+        with self.profiler.stage(fileName, 'multiLabelExtraction') as stageRecord:
+          labels = LabelMapUtility.getStructureLabels(labelCounts)
+          caseResult['surfaces'] = SurfaceUtility.extractLabelSurfaces(imageData, labels, ijkToRAS)
+          stageRecord['triangles'] = sum(surface.GetNumberOfPolys() for surface in caseResult['surfaces'].values())
+
+      caseResult['labelCounts'] = labelCounts
+    except Exception as e:
+      caseResult['error'] = 'Failed to import ' + fileName + ': ' + str(e)
+
+    return caseResult
+
+  #
+  # Create the labelmap node of a case read by loadCase, and its segmentation with closed surfaces unless they
+  # were extracted in MultiLabel mode. The cases read from the cache or the journal have no node until they are
+  # shown. The nodes are not added to the scene yet, but MRML and the segmentation logic are not thread-safe,
+  # so this runs on the main thread.
+  # Returns an error message, None on success.
+  #
+  def createCaseNodes(self, caseResult):
+    fileName = caseResult['name']
+    try:
+      caseResult['labelmapNode'] = MRMLUtility.createLabelMapNode(fileName, caseResult['imageData'],
+                                                                  caseResult['ijkToRAS'])
+      caseResult['imageData'] = None
 
       # Create segmentation representations.
-      self.segmentationDict[fileName] = MRMLUtility.createNewMRMLNode(fileName + '_allSegments',
-                                                                      slicer.vtkMRMLSegmentationNode())
-      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(self.testCaseDict[fileName],
-                                                                            self.segmentationDict[fileName])
-      t = self.segmentationDict[fileName].CreateClosedSurfaceRepresentation()
-      if t == False:
-        print 'ERROR: Failed to create closed surface representation'
-        continue
+      with self.profiler.stage(fileName, 'labelmapToSegmentation'):
+        segmentationNode = self.createSegmentationNode(caseResult['labelmapNode'])
+      if self.surfaceExtractionMode != 'MultiLabel':
+        with self.profiler.stage(fileName, 'closedSurface'):
+          created = segmentationNode.CreateClosedSurfaceRepresentation()
+        if not created:
+          return 'Failed to create closed surface representation for ' + fileName
+      caseResult['segmentationNode'] = segmentationNode
+    except Exception as e:
+      return 'Failed to import ' + fileName + ': ' + str(e)
+    return None
 
-      self.segmentationDict[fileName].SetDisplayVisibility(False)
+  #
+  # Import a labelmap into a new segmentation node that is not in the scene.
+  #
+  def createSegmentationNode(self, labelmapNode):
+    segmentationNode = slicer.vtkMRMLSegmentationNode()
+    segmentationNode.SetName(labelmapNode.GetName() + '_allSegments')
+    slicer.vtkSlicerSegmentationsModuleLogic.ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    return segmentationNode
 
-      # find how many labels each file has..
-      labelRange = self.testCaseDict[fileName].GetImageData().GetScalarRange()
-      if self.labelRangeInCohort != (-1, -1) and labelRange != self.labelRangeInCohort:
-        print 'ERROR: Number of labels do not match in the cohort'
-        return False
+  #
+  # Add the nodes of a loaded case to the scene. This must run on the main thread.
+  #
+  def registerCase(self, caseResult):
+    fileName = caseResult['name']
+    self.caseNames.append(fileName)
+    self.casePathDict[fileName] = caseResult['path']
+    # The nodes of the case are added in a single batch of scene events
+    nodes = [node for node in [caseResult['labelmapNode'], caseResult['segmentationNode']] if node is not None]
+    MRMLUtility.addMRMLNodes(nodes)
+    if caseResult['labelmapNode'] is not None:
+      self.testCaseDict[fileName] = caseResult['labelmapNode']
+    if caseResult['segmentationNode'] is not None:
+      self.initializeSegmentationNode(fileName, caseResult['segmentationNode'])
+    if caseResult['surfaces'] is not None:
+      self.polyDataDict.setMeshes(fileName, caseResult['surfaces'])
+    if caseResult['cacheKey'] is not None:
+      self.cacheKeyDict[fileName] = caseResult['cacheKey']
+    if caseResult['journalSignature'] is not None:
+      self.journalSignatureDict[fileName] = caseResult['journalSignature']
+    self.labelCountsDict[fileName] = caseResult['labelCounts']
+    if caseResult['components'] is not None:
+      self.componentsDict[fileName] = caseResult['components']
+
+    record = caseResult['record']
+    if record is not None:
+      self.cachedCaseNames.add(fileName)
+      if 'components' in record:
+        self.componentsDict[fileName] = record['components']
+      self.polyDataDict.setMeshes(fileName, record['polyData'])
+      self.topologyDetailsDict[fileName] = record['topology']
+      self.topologyDict[fileName] = dict((segmentNum, topology['euler'])
+                                         for segmentNum, topology in record['topology'].items())
+      self.evaluatedTopology.update((fileName, segmentNum) for segmentNum in self.labelsInCohort)
+      if caseResult['journalSignature'] is not None and not caseResult['journaled']:
+        # Read from the cache, the case is finished already
+        with self.profiler.stage(fileName, 'journalStore'):
+          self.importJournal.record(fileName, caseResult['journalSignature'], record)
+      # No node was created, the labelmap is read from its file when it is needed
+      self.releaseCase(fileName)
+
+  def addSegmentationNode(self, nodeName, segmentationNode):
+    MRMLUtility.addMRMLNode(segmentationNode)
+    self.initializeSegmentationNode(nodeName, segmentationNode)
 
-      self.labelRangeInCohort = labelRange
+  #
+  # Color and name the segments of a segmentation node of the scene after the labels of its labelmap, and
+  # hide it.
+  #
+  def initializeSegmentationNode(self, nodeName, segmentationNode):
+    # The segments were created without a color table, use the one of the labelmap.
+    colorNode = self.getLabelmapNode(nodeName).GetDisplayNode().GetColorNode()
+    segmentation = segmentationNode.GetSegmentation()
+    for segmentIndex in range(segmentation.GetNumberOfSegments()):
+      segment = segmentation.GetNthSegment(segmentIndex)
+      label = int(segmentation.GetNthSegmentID(segmentIndex))
+      color = [0, 0, 0, 0]
+      colorNode.GetColor(label, color)
+      segment.SetColor(color[0:3])
+      segment.SetName(colorNode.GetColorName(label))
+
+    segmentationNode.SetDisplayVisibility(False)
+    self.segmentationDict[nodeName] = segmentationNode
 
-    print 'Cohort label range is: ' + str(self.labelRangeInCohort)
-    # given labels, and current mode populate the structures slider
-    self.labelRangeInCohort = (int(self.labelRangeInCohort[0]), int(self.labelRangeInCohort[1]))
-    return True
+  #
+  # Segmentation node of a case, created on demand for the cases that were read from the cache.
+  #
+  def getSegmentationNode(self, nodeName):
+    if nodeName not in self.segmentationDict:
+      self.addSegmentationNode(nodeName, self.createSegmentationNode(self.getLabelmapNode(nodeName)))
+    return self.segmentationDict[nodeName]
+
+  #
+  # Labelmap node of a case, read again from its file if it was released. The case read before is released
+  # again so that a single one stays in memory. None for the cases imported from surface files.
+  #
+  def getLabelmapNode(self, nodeName):
+    if nodeName not in self.testCaseDict and nodeName in self.releasedCaseNames:
+      if self.reloadedCaseName is not None:
+        self.releaseCase(self.reloadedCaseName)
+      path = self.casePathDict[nodeName]
+      with self.profiler.stage(nodeName, 'reloadLabelmap'):
+        labelmapNode = MRMLUtility.readMRMLNode(nodeName, os.path.dirname(path), os.path.basename(path), 'LabelMap')
+        if labelmapNode is None:
+          print 'ERROR: failed to read ' + path + ' again'
+          return None
+        if self.componentFiltering:
+          # The shown voxels are the ones the surfaces were extracted from
+          LabelMapUtility.filterComponents(labelmapNode.GetImageData(), self.labelsInCohort, self.fillHoles,
+                                           self.maximumHoleSize)
+      self.testCaseDict[nodeName] = MRMLUtility.addMRMLNode(labelmapNode)
+      self.reloadedCaseName = nodeName
+    return self.testCaseDict.get(nodeName)
+
+  #
+  # Remove the labelmap and segmentation nodes of a case, its meshes and topology are kept. With keepShown,
+  # a case whose segmentation is shown is only released when another one is shown.
+  #
+  def releaseCase(self, nodeName, keepShown=False):
+    if SurfaceUtility.isSurfaceFile(self.casePathDict[nodeName]):
+      return
+    self.releasedCaseNames.add(nodeName)
+    segmentationNode = self.segmentationDict.get(nodeName)
+    if keepShown and segmentationNode is not None and segmentationNode.GetDisplayVisibility():
+      if self.reloadedCaseName is not None and self.reloadedCaseName != nodeName:
+        self.releaseCase(self.reloadedCaseName)
+      self.reloadedCaseName = nodeName
+      return
+    nodes = []
+    if nodeName in self.testCaseDict:
+      nodes.append(self.testCaseDict.pop(nodeName))
+    if nodeName in self.segmentationDict:
+      nodes.append(self.segmentationDict.pop(nodeName))
+    with self.profiler.stage(nodeName, 'releaseCase'):
+      MRMLUtility.removeMRMLNodes(nodes)
+    if nodeName == self.reloadedCaseName:
+      self.reloadedCaseName = None
+
+  #
+  # Find the labelmaps of a study from the directory layout of the tool that produced them:
+  # 'FreeSurfer', 'FSL', 'Autoseg' or 'General VTK'. fileNamePattern replaces the file name of
+  # the layout if given, e.g. aparc+aseg.mgz. Returns the case names and the file paths.
+  #
+  def discoverFiles(self, rootDirectory, layout, fileNamePattern=''):
+    startTime = time.time()
+    cases = CaseDiscoveryUtility.discoverCases(rootDirectory, layout, fileNamePattern)
+    statistics = CaseDiscoveryUtility.getListingStatistics()
+    print 'Found %d cases in %s in %.2f s (%d directories listed, %d listings reused)' % (
+      len(cases), rootDirectory, time.time() - startTime, statistics['misses'], statistics['hits'])
+    return [case[0] for case in cases], [case[1] for case in cases]
+
+  #
+  # Check the headers, pixel types and labels of the files before importing them, without creating
+  # any node. Raw voxels are memory-mapped so that a cohort is checked in about the time it takes to
+  # read it from the disk. Without checkLabels, only the headers are read: the voxels of compressed files
+  # are not decompressed, and the labels are left to the check of each case during the import.
+  # Returns the report of CohortValidationUtility.validateCohort.
+  #
+  def validateFiles(self, filePaths, caseNames=None, strictGeometry=False, checkLabels=True):
+    # Reading the files is bound by the latency of the storage rather than by the processor
+    self.validationReport = CohortValidationUtility.validateCohort(
+      filePaths, caseNames, check_labels=checkLabels, strict_geometry=strictGeometry,
+      number_of_workers=max(4, self.numberOfWorkers))
+    print CohortValidationUtility.formatReport(self.validationReport)
+    return self.validationReport
+
+  #
+  # Read the file paths of a CSV manifest: a header followed by one file path per row.
+  #
+  @staticmethod
+  def readCSVManifest(csvFileName):
+    filePaths = []
+    with open(csvFileName, 'r') as csvfile:
+      reader = csv.reader(csvfile)
+      # ignore the header
+      next(reader, None)
+      # assuming that each row is just a file path.
+      for row in reader:
+        if len(row) > 0:
+          filePaths.append(row[0])
+    return filePaths
+
+  def isCohortTopologyConsistent(self):
+    return self.topologyMatrix.isConsistent()
 
   def getLabelRangeInCohort(self):
     return self.labelRangeInCohort
 
+  def getLabelsInCohort(self):
+    return self.labelsInCohort
+
+  def getLabelCounts(self, nodeName):
+    return self.labelCountsDict.get(nodeName, {})
+
+  #
+  # Dictionary label -> number of voxel 'components' before filtering, 'removedVoxels' and 'filledVoxels'
+  # of a case, empty if the components were not filtered.
+  #
+  def getComponentCounts(self, nodeName):
+    return self.componentsDict.get(nodeName, {})
+
   #
   # Function to estimate topology of segmentations, and check for consistencies.
   #
   def populateTopologyDictionary(self):
 
-    # Create vtk objects that will be used to clean the geometries
+    self.topologyMatrix.clear()
+    for nodeName in self.caseNames:
+      self.processCaseTopology(nodeName)
 
-    firstValue = {}  # This will be used for checking consistent, inconsistent topologies
+    self.finishTopologyDictionary()
 
-    for nodeName in self.testCaseDict.keys():
-      # Topology table is a dictionary of dictionaries.
-      self.topologyDict[nodeName] = {}
-      self.polyDataDict[nodeName] = {}
-      for segmentNum in range(self.labelRangeInCohort[0], self.labelRangeInCohort[1] + 1):
-        # 0 label is assumed to be the background.
-        if segmentNum == 0:
-          continue
-        segmentId = str(segmentNum)
-        polydata = self.segmentationDict[nodeName].GetClosedSurfaceRepresentation(segmentId)
-        if polydata == None:
-          print 'Ignoring segment id ' + segmentId + ' for case: ' + nodeName
+  #
+  # Compute the topology of a case, unless it was read from the cache, and add it to the cohort consistency.
+  #
+  def processCaseTopology(self, nodeName):
+    if nodeName not in self.cachedCaseNames:
+      self.computeCaseTopology(nodeName)
+    self.updateTopologyConsistency(nodeName)
+
+  def finishTopologyDictionary(self):
+    if self.surfaceCache is not None:
+      self.surfaceCache.flush()
+      statistics = self.surfaceCache.getStatistics()
+      print 'Surface cache: ' + str(statistics['hits']) + ' hits, ' + str(statistics['misses']) + ' misses'
+
+    if self.importJournal is not None:
+      statistics = self.importJournal.getStatistics()
+      print 'Import journal: %d cases resumed, %d recorded, %d changed since they were recorded' % (
+        statistics['resumed'], statistics['recorded'], statistics['stale'])
+      if self.importFinished:
+        # Nothing is left to resume, the surface cache keeps the surfaces if it is enabled
+        self.importJournal.clear()
+
+    statistics = self.polyDataDict.getStatistics()
+    print 'Meshes in memory: %d (%.1f MB), on disk: %d (%.1f MB)' % (
+      statistics['residentMeshes'], statistics['residentSize'] / 1024.0 ** 2,
+      statistics['spilledMeshes'], statistics['spilledSize'] / 1024.0 ** 2)
+
+    statistics = self.getMemoryStatistics()
+    if statistics['current'] is not None and statistics['peak'] is not None:
+      print 'Memory after import: %.1f MB, peak: %.1f MB, %d cases released, %d loaded' % (
+        statistics['current'] / 1024.0 ** 2, statistics['peak'] / 1024.0 ** 2,
+        statistics['releasedCases'], statistics['loadedCases'])
+
+    if self.profiler.enabled:
+      print 'Import profile:\n' + self.profiler.formatSummary()
+
+  def computeCaseTopology(self, nodeName):
+    # Topology table is a dictionary of dictionaries.
+    self.topologyDict.setdefault(nodeName, {})
+    self.topologyDetailsDict.setdefault(nodeName, {})
+    # 0 label is assumed to be the background.
+    for segmentNum in self.labelsInCohort:
+      self.computeLabelTopology(nodeName, segmentNum)
+
+  #
+  # Compute the topology of a label of a case right away, unless it is known already.
+  # Returns its Euler characteristic, None if the label has no surface.
+  #
+  def computeLabelTopology(self, nodeName, segmentNum):
+    key = (nodeName, segmentNum)
+    if key not in self.evaluatedTopology:
+      if self.topologyPool is not None:
+        # Computed twice if a worker started it already, the first result is kept
+        self.topologyPool.cancel(key)
+      polydata = self.getClosedSurface(nodeName, segmentNum)
+      self.setLabelTopology(nodeName, segmentNum, self.evaluateLabelTopology(nodeName, segmentNum, polydata))
+    return self.topologyMatrix.getEuler(nodeName, segmentNum)
+
+  #
+  # Closed surface of a label of the segmentation of a case whose topology is not known yet, None for the
+  # cases without segmentation. This reads the segmentation so it must run on the main thread.
+  #
+  def getClosedSurface(self, nodeName, segmentNum):
+    if nodeName not in self.segmentationDict or self.polyDataDict.hasMesh(nodeName, segmentNum):
+      return None
+    with self.profiler.stage(nodeName, 'getClosedSurface', label=segmentNum):
+      return self.segmentationDict[nodeName].GetClosedSurfaceRepresentation(str(segmentNum))
+
+  #
+  # Clean the surface of a label and compute its topology. The surface is the given polydata or the one
+  # extracted at import time in the 'MultiLabel' mode. Nothing is changed so this can run in a worker thread.
+  # Returns the mesh to keep and the topology, None if the label has no surface.
+  #
+  def evaluateLabelTopology(self, nodeName, segmentNum, polydata=None):
+    if polydata is None:
+      polydata = self.polyDataDict.getMesh(nodeName, segmentNum)
+    if polydata is None:
+      return None
+
+    # clean up polydata, keep the largest connected component and compute its topology
+    cleanResult = TopologyUtility.cleanLargestComponent(
+      polydata, lambda stageName: self.profiler.stage(nodeName, stageName, label=segmentNum))
+    if cleanResult is None:
+      # The surface has no triangle, the label is reported as missing
+      return None
+    cleanData, topology = cleanResult
+    return {
+      'polyData': cleanData if self.saveCleanData else polydata,
+      'topology': topology,
+    }
+
+  #
+  # Store the topology of a label, and the surfaces and topology of the case in the cache and in the
+  # import journal once all its labels are known. This must run on the main thread.
+  #
+  def setLabelTopology(self, nodeName, segmentNum, result):
+    self.evaluatedTopology.add((nodeName, segmentNum))
+    self.topologyTasks.get(segmentNum, {}).pop(nodeName, None)
+    if result is None:
+      print 'Ignoring segment id ' + str(segmentNum) + ' for case: ' + nodeName
+      self.topologyMatrix.setEuler(nodeName, segmentNum, None)
+    else:
+      self.topologyDict.setdefault(nodeName, {})[segmentNum] = result['topology']['euler']
+      self.topologyDetailsDict.setdefault(nodeName, {})[segmentNum] = result['topology']
+      self.topologyMatrix.setEuler(nodeName, segmentNum, result['topology']['euler'])
+      self.polyDataDict.setMesh(nodeName, segmentNum, result['polyData'])
+      self.previewPolyDataDict.removeMesh(nodeName, segmentNum)
+
+    if all((nodeName, label) in self.evaluatedTopology for label in self.labelsInCohort):
+      self.storeCaseRecord(nodeName)
+      if self.releaseVoxelData:
+        self.releaseCase(nodeName, keepShown=True)
+
+  def storeCaseRecord(self, nodeName):
+    cached = self.surfaceCache is not None and nodeName in self.cacheKeyDict
+    journaled = self.importJournal is not None and nodeName in self.journalSignatureDict
+    if not cached and not journaled:
+      return
+    record = {
+      'labelRange': self.labelRangeInCohort,
+      'labelCounts': self.labelCountsDict[nodeName],
+      'components': self.componentsDict.get(nodeName, {}),
+      'topology': self.topologyDetailsDict[nodeName],
+      'polyData': self.polyDataDict.getMeshes(nodeName),
+    }
+    if cached:
+      with self.profiler.stage(nodeName, 'cacheStore'):
+        self.surfaceCache.store(self.cacheKeyDict[nodeName], record)
+    if journaled:
+      with self.profiler.stage(nodeName, 'journalStore'):
+        self.importJournal.record(nodeName, self.journalSignatureDict[nodeName], record)
+
+  #
+  # Evaluate the topology of the given cases in the background. The labels are evaluated in order, the
+  # one given to prioritizeTopology first, and the results are added by collectTopologyResults.
+  #
+  def scheduleTopology(self, nodeNames):
+    if self.topologyPool is None:
+      self.topologyPool = PriorityTaskPool(self.numberOfWorkers)
+    for nodeName in nodeNames:
+      # Cases are evaluated in the order they were scheduled
+      caseIndex = len(self.topologyDict)
+      self.topologyDict.setdefault(nodeName, {})
+      self.topologyDetailsDict.setdefault(nodeName, {})
+      if nodeName in self.cachedCaseNames:
+        self.updateTopologyConsistency(nodeName)
+        continue
+      for segmentNum in self.labelsInCohort:
+        key = (nodeName, segmentNum)
+        if key in self.evaluatedTopology:
           continue
+        self.topologyTasks.setdefault(segmentNum, {})[nodeName] = caseIndex
+        self.topologyPool.submit(key, self.getTopologyPriority(nodeName, segmentNum), self.evaluateLabelTopology,
+                                 nodeName, segmentNum, self.getClosedSurface(nodeName, segmentNum))
 
-        polydataCleaner = vtk.vtkCleanPolyData()
-        connectivityFilter = vtk.vtkPolyDataConnectivityFilter()
-        extractEdgeFilter = vtk.vtkExtractEdges()
+  def getTopologyPriority(self, nodeName, segmentNum):
+    return (segmentNum != self.topologyPriorityLabel, segmentNum, self.topologyTasks[segmentNum][nodeName])
 
-        # clean up polydata
-        polydataCleaner.SetInputData(polydata)
-        polydataCleaner.Update()
-        cleanData = polydataCleaner.GetOutput()
+  #
+  # Evaluate the given label of all the cases before the other labels
+  #
+  def prioritizeTopology(self, segmentNum):
+    if segmentNum == self.topologyPriorityLabel:
+      return
+    previousLabel = self.topologyPriorityLabel
+    self.topologyPriorityLabel = segmentNum
+    if self.topologyPool is None:
+      return
+    for label in [previousLabel, segmentNum]:
+      for nodeName in self.topologyTasks.get(label, {}).keys():
+        self.topologyPool.setPriority((nodeName, label), self.getTopologyPriority(nodeName, label))
 
-        # Get the largest connected component
-        connectivityFilter.SetInputData(cleanData)
-        connectivityFilter.SetExtractionModeToLargestRegion()
-        connectivityFilter.SetScalarConnectivity(0)
-        connectivityFilter.Update()
-        largestComponent = connectivityFilter.GetOutput()
+  #
+  # Add the topology evaluated in the background since the last call. This must run on the main thread.
+  # Returns the (case, label) pairs that were added.
+  #
+  def collectTopologyResults(self):
+    if self.topologyPool is None:
+      return []
+    keys = []
+    for key, result, error in self.topologyPool.getResults():
+      if key in self.evaluatedTopology or key[0] not in self.topologyTasks.get(key[1], {}):
+        # Computed on demand in the meantime, or from a cohort that was cleared
+        continue
+      if error is not None:
+        print 'ERROR: failed to compute the topology of ' + key[0] + ' and ' + str(key[1]) + ': ' + str(error)
+        result = None
+      self.setLabelTopology(key[0], key[1], result)
+      keys.append(key)
+    return keys
 
-        # Clean the largest component to get rid of spurious points
-        polydataCleaner.SetInputData(largestComponent)
-        polydataCleaner.Update()
-        cleanData = polydataCleaner.GetOutput()
+  def isTopologyComplete(self):
+    return self.getNumberOfPendingTopologies() == 0
 
+  def getNumberOfPendingTopologies(self, segmentNum=None):
+    if segmentNum is not None:
+      return len(self.topologyTasks.get(segmentNum, {}))
+    return sum(len(tasks) for tasks in self.topologyTasks.values())
 
+  #
+  # Check the topology consistency of the whole cohort, or add a single case to it.
+  #
+  def updateTopologyConsistency(self, nodeName=None):
+    # The consistency, majority topology and outliers of each label are computed by the
+    # matrix the next time they are queried
+    if nodeName is None:
+      self.topologyMatrix.clear()
+      nodeNames = self.caseNames
+    else:
+      nodeNames = [nodeName]
 
-        # run extract edge filter
-        extractEdgeFilter.SetInputData(cleanData)
-        extractEdgeFilter.Update()
-        edges = extractEdgeFilter.GetOutput()
+    for nodeName in nodeNames:
+      self.topologyMatrix.setCase(nodeName, self.topologyDict[nodeName])
 
-        # calculate the numbers
-        topologyNumber = cleanData.GetNumberOfPoints() - edges.GetNumberOfLines()\
-                         + cleanData.GetNumberOfPolys()
+  #
+  # Write the surfaces of all the cases, one directory per label, with a manifest of the files.
+  # Returns the statistics of the export.
+  #
+  def exportSurfaces(self, outputDirectory, compress=True):
+    extension = '.vtp' if compress else '.vtk'
+    jobs = []
+    for nodeName in self.caseNames:
+      caseName = self.getCaseBaseName(nodeName)
+      for segmentNum in self.polyDataDict.getLabels(nodeName):
+        jobs.append({
+          'file': os.path.join(outputDirectory, 'label_' + str(segmentNum), caseName + extension),
+          'case': nodeName,
+          'label': segmentNum,
+          # Meshes spilled to disk are read back by the writers
+          'write': lambda path, nodeName=nodeName, segmentNum=segmentNum:
+            SurfaceUtility.writePolyData(self.polyDataDict.getMesh(nodeName, segmentNum), path, compress),
+        })
+
+    entries, statistics = ExportUtility.writeFiles(jobs, self.numberOfWorkers)
+    ExportUtility.writeManifest(outputDirectory, entries, statistics)
+    print 'Exported surfaces to ' + outputDirectory + ': ' + ExportUtility.formatStatistics(statistics)
+    return statistics
 
-        self.topologyDict[nodeName][segmentNum] = topologyNumber
-        if self.saveCleanData:
-          self.polyDataDict[nodeName][segmentNum] = cleanData
-        else:
-          self.polyDataDict[nodeName][segmentNum] = polydata
-
-        del edges
-        del largestComponent
-        del cleanData
-
-        # Check for consistency in the cohort for this segment label
-        if segmentNum not in self.consistentTopologyDict.keys():
-          self.consistentTopologyDict[segmentNum] = 'Consistent'
-          firstValue[segmentNum] = self.topologyDict[nodeName][segmentNum]
-          # print 'Adding segment num ' + segmentId + ' with top number: ' + str(topologyNumber) + ' For consistencies'
-        elif firstValue[segmentNum] != self.topologyDict[nodeName][segmentNum] \
-                and self.consistentTopologyDict[segmentNum] is 'Consistent':
-          self.consistentTopologyDict[segmentNum] = 'InConsistent'
-          # print 'Setting to inconsistent for segment num: ' + segmentId + ' and current number: ' + str(topologyNumber)
+  #
+  # Pack the surfaces of all the cases in a single container, see CohortMesh. Its arrays are views of
+  # the file once it is written and read back, so downstream tools do not copy the meshes.
+  #
+  def buildCohortMesh(self):
+    return CohortMesh.fromMeshStore(self.polyDataDict, [nodeName for nodeName in self.caseNames
+                                                        if self.polyDataDict.hasCase(nodeName)])
+
+  def exportCohortMesh(self, filePath):
+    cohortMesh = self.buildCohortMesh()
+    cohortMesh.write(filePath)
+    statistics = cohortMesh.getStatistics()
+    print 'Packed %d surfaces of %d cases in %s: %d points, %d triangles' % (
+      statistics['meshes'], statistics['cases'], filePath, statistics['points'], statistics['triangles'])
+    return statistics
+
+  @staticmethod
+  def getCaseBaseName(nodeName):
+    # Cases named after their subject directory have no extension
+    return CaseDiscoveryUtility.stripExtension(nodeName)
 
   def reset3dView(self):
     layoutManager = slicer.app.layoutManager()
@@ -195,20 +970,70 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     threeDView = threeDWidget.threeDView()
     threeDView.resetFocalPoint()
 
-  def displaySegment(self, nodeName, segmentId):
+  #
+  # Build in the background the previews of a label for the given cases. Their full resolution
+  # meshes are read back from disk at the same time if they were spilled.
+  #
+  def requestPreviews(self, nodeNames, segmentNum):
+    if self.previewNumberOfTriangles == 0 or segmentNum == 0:
+      return
+    if self.previewPool is None:
+      # A single worker keeps the main thread responsive
+      self.previewPool = ThreadPool(1)
+    with self.previewLock:
+      for nodeName in nodeNames:
+        key = (nodeName, segmentNum)
+        if key in self.pendingPreviews or self.previewPolyDataDict.hasMesh(nodeName, segmentNum):
+          continue
+        self.pendingPreviews.add(key)
+        self.previewPool.apply_async(self.buildPreview, (nodeName, segmentNum, self.previewGeneration))
+
+  def buildPreview(self, nodeName, segmentNum, generation):
+    try:
+      polydata = self.polyDataDict.getMesh(nodeName, segmentNum)
+      preview = SurfaceUtility.decimatePolyData(polydata, self.previewNumberOfTriangles)
+      with self.previewLock:
+        # Previews of a cohort that was cleared in the meantime are dropped
+        if preview is not None and generation == self.previewGeneration:
+          self.previewPolyDataDict.setMesh(nodeName, segmentNum, preview)
+    except Exception as e:
+      print 'ERROR: failed to build the preview of ' + nodeName + ' and ' + str(segmentNum) + ': ' + str(e)
+    finally:
+      with self.previewLock:
+        self.pendingPreviews.discard((nodeName, segmentNum))
+
+  def clearPreviews(self):
+    with self.previewLock:
+      self.previewGeneration = self.previewGeneration + 1
+      self.pendingPreviews = set()
+      self.previewPolyDataDict.clear()
+
+  #
+  # Show a label of a case, or the whole segmentation for segment '0'. With preview set, the
+  # decimated mesh is shown if it was built already.
+  #
+  def displaySegment(self, nodeName, segmentId, preview=False, resetView=True):
+    if segmentId == '0' and SurfaceUtility.isSurfaceFile(self.casePathDict[nodeName]):
+      # Cases imported from surface files have no segmentation, their first structure is shown
+      segmentId = str(min(self.polyDataDict.getLabels(nodeName)))
     if segmentId == '0':
-      self.segmentationDict[nodeName].SetDisplayVisibility(True)
+      # Not created at import time in the 'MultiLabel' mode or for cached cases
+      segmentationNode = self.getSegmentationNode(nodeName)
+      segmentationNode.CreateClosedSurfaceRepresentation()
+      segmentationNode.SetDisplayVisibility(True)
       self.reset3dView()
       return
 
-    if self.segmentationDict[nodeName].GetDisplayVisibility() is 1:
+    if nodeName in self.segmentationDict and self.segmentationDict[nodeName].GetDisplayVisibility() is 1:
       self.segmentationDict[nodeName].SetDisplayVisibility(False)
 
     segmentIdNum = int(segmentId)
     polydata = None
-
-    if nodeName in self.polyDataDict.keys() and segmentIdNum in self.polyDataDict[nodeName].keys():
-      polydata = self.polyDataDict[nodeName][segmentIdNum] #elf.segmentationDict[nodeName].GetClosedSurfaceRepresentation(segmentId)
+    if preview:
+      polydata = self.previewPolyDataDict.getMesh(nodeName, segmentIdNum)
+    if polydata is None:
+      # Meshes that were spilled to disk are read back by the store
+      polydata = self.polyDataDict.getMesh(nodeName, segmentIdNum)
     if polydata == None:
       print 'ERROR: polydata for ' + nodeName + ' and ' + segmentId + ' does not exist!!'
       return
@@ -219,28 +1044,156 @@ class DataImporterLogic(ScriptedLoadableModuleLogic):
     self.singleDisplayedSegmentation.SetDisplayVisibility(1)
     color = [0, 0, 0, 0]
 
-    slicer.util.getNode('GenericAnatomyColors').GetColor(segmentIdNum, color)
+    MRMLUtility.getNodeByName('GenericAnatomyColors').GetColor(segmentIdNum, color)
     self.singleDisplayedSegmentation.GetDisplayNode().SetColor(color[0:3])
-    self.reset3dView()
+    if resetView:
+      self.reset3dView()
 
   def getTopologyAndConsistencyString(self, nodeName, segmentId):
     segmentNum = int(segmentId)
+    return self.getTopologyString(nodeName, segmentNum), self.getConsistencyString(segmentNum)
+
+  #
+  # Topology of a structure of a case, 'Pending' while it is evaluated in the background
+  #
+  def getTopologyString(self, nodeName, segmentNum):
+    return self.formatTopologyString(nodeName, segmentNum, self.topologyMatrix.getEuler(nodeName, segmentNum))
+
+  #
+  # Topology of a structure of a case given its Euler characteristic, e.g. the one gathered by a subject table
+  #
+  def formatTopologyString(self, nodeName, segmentNum, euler):
     topologyString = 'n/a'
 
-    if nodeName in self.topologyDict and segmentNum in self.topologyDict[nodeName]:
-      topologyNum = self.topologyDict[nodeName][segmentNum]
-      topologyString = {
-        1: 'Disk',
-        0: 'Circle/Torus/Mobius Strip',
-        2: 'Sphere',
-        -2: 'Double Torus',
-        -4: 'Triple Torus',
-      }.get(topologyNum, 'n/a')
+    if euler is not None:
+      topologyString = TopologyUtility.getTopologyName(euler)
+      numberOfComponents = self.getComponentCounts(nodeName).get(segmentNum, {}).get('components', 1)
+      if numberOfComponents > 1:
+        topologyString += ' (largest of %d voxel components)' % numberOfComponents
+    elif nodeName in self.topologyTasks.get(segmentNum, {}):
+      topologyString = 'Pending'
+    return topologyString
+
+  #
+  # Consistency of the topology of a structure across the cohort
+  #
+  def getConsistencyString(self, segmentNum):
+    consistentTopologyString = 'n/a'
+    consistency = self.topologyMatrix.getConsistency(segmentNum)
+    if consistency == 'Consistent':
+      consistentTopologyString = consistency
+    elif consistency is not None:
+      # Tell how many cases differ from the most common topology
+      consistentTopologyString = consistency + ': ' + str(len(self.topologyMatrix.getOutlierCases(segmentNum))) + \
+        '/' + str(self.topologyMatrix.getNumberOfCases()) + ' cases differ from ' + \
+        TopologyUtility.getTopologyName(self.topologyMatrix.getMajorityEuler(segmentNum))
+    numberOfPendingCases = self.getNumberOfPendingTopologies(segmentNum)
+    if consistency is not None and numberOfPendingCases > 0:
+      # The consistency of the evaluated cases so far
+      consistentTopologyString += ' (%d pending)' % numberOfPendingCases
+    return consistentTopologyString
+
+#
+# SubjectTableModel
+#
+
+class SubjectTableModel(qt.QAbstractTableModel):
+  """Table of the imported subjects with the topology of each structure. The view only asks for the cells
+  it shows, so the table does not build an item per subject and structure.
+  """
+
+  OUTLIER_COLOR = qt.QColor(255, 200, 200)
+
+  def __init__(self, logic, parent=None):
+    qt.QAbstractTableModel.__init__(self, parent)
+    self.logic = logic
+    self.table = SubjectTable()
+
+  def rowCount(self, parent=None):
+    if parent is not None and parent.isValid():
+      return 0
+    return self.table.getRowCount()
+
+  def columnCount(self, parent=None):
+    if parent is not None and parent.isValid():
+      return 0
+    return self.table.getColumnCount()
+
+  def data(self, index, role):
+    if not index.isValid():
+      return None
+    row = index.row()
+    column = index.column()
+    label = self.table.getLabel(column)
+    if role == qt.Qt.DisplayRole:
+      if column == SubjectTable.NAME_COLUMN:
+        return self.table.getCaseName(row)
+      if column == SubjectTable.OUTLIERS_COLUMN:
+        return self.table.getNumberOfOutliers(row)
+      # The Euler characteristic the rows were sorted and filtered by, not the one evaluated since
+      return self.logic.formatTopologyString(self.table.getCaseName(row), label, self.table.getEuler(row, column))
+    if role == qt.Qt.BackgroundRole and self.table.isOutlier(row, column):
+      return self.OUTLIER_COLOR
+    if role == qt.Qt.ToolTipRole and label is not None and self.table.isOutlier(row, column):
+      return 'Most cases are ' + TopologyUtility.getTopologyName(self.logic.topologyMatrix.getMajorityEuler(label))
+    return None
+
+  def headerData(self, section, orientation, role):
+    if orientation != qt.Qt.Horizontal or section >= self.table.getColumnCount():
+      return None
+    label = self.table.getLabel(section)
+    if role == qt.Qt.DisplayRole:
+      if section == SubjectTable.NAME_COLUMN:
+        return 'Subject name'
+      if section == SubjectTable.OUTLIERS_COLUMN:
+        return 'Differences'
+      numberOfOutliers = len(self.logic.topologyMatrix.getOutlierCases(label))
+      return str(label) if numberOfOutliers == 0 else '%d (%d differ)' % (label, numberOfOutliers)
+    if role == qt.Qt.ToolTipRole:
+      if section == SubjectTable.OUTLIERS_COLUMN:
+        return 'Number of structures whose topology differs from the most common one in the cohort'
+      if label is not None:
+        return 'Label %d: %s' % (label, self.logic.getConsistencyString(label))
+    return None
+
+  def sort(self, column, order):
+    # A negative column, when the sort indicator is cleared, shows the subjects in import order
+    self.table.setSort(column if column >= 0 else None, order == qt.Qt.DescendingOrder)
+    self.refresh()
+
+  #
+  # Gather the topology of the cohort again, then filter and sort the subjects
+  #
+  def refresh(self):
+    self.beginResetModel()
+    self.table.update(self.logic.topologyMatrix, self.logic.getLabelsInCohort())
+    self.endResetModel()
+
+  def clear(self):
+    self.table.clear()
+    self.refresh()
+
+  def addCase(self, nodeName):
+    self.table.addCase(nodeName)
+
+  def getNumberOfCases(self):
+    # Number of subjects, including the ones that are filtered out
+    return self.table.getNumberOfCases()
+
+  def setNameFilter(self, text):
+    self.table.setNameFilter(text)
+
+  def setOutlierFilter(self, label):
+    self.table.setOutlierFilter(label)
 
-    consistentTopologyString = self.consistentTopologyDict[segmentNum] \
-      if segmentNum in self.consistentTopologyDict.keys() else 'n/a'
+  def getCaseName(self, row):
+    return self.table.getCaseName(row)
 
-    return topologyString, consistentTopologyString
+  def getRow(self, nodeName):
+    return self.table.getRow(nodeName)
+
+  def getColumn(self, label):
+    return self.table.getColumn(label)
 
 #
 # DataImporterWidget
@@ -256,7 +1209,6 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
 
     #
     #   Global variables
-    # TODO: add the logic
     self.logic = DataImporterLogic()
 
     #
@@ -278,7 +1230,21 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
     self.CSVFileBrowsePushButton.connect('clicked(bool)', self.onCSVFileBrowsePushButton)
     self.ImportButton = self.getWidget('ImportButton')
     self.ImportButton.connect('clicked(bool)', self.onImportButton)
+    self.CancelImportButton = self.getWidget('CancelImportButton')
+    self.CancelImportButton.connect('clicked(bool)', self.onCancelImportButton)
+    self.CancelImportButton.enabled = False
+    self.importCancelled = False
+    self.ImportProgressBar = self.getWidget('ImportProgressBar')
+    self.ImportStatusLabel = self.getWidget('ImportStatusLabel')
+    self.SkipMismatchedCasesCheckBox = self.getWidget('SkipMismatchedCasesCheckBox')
+    self.SkipMismatchedCasesCheckBox.connect('toggled(bool)', self.onSkipMismatchedCasesCheckBoxToggled)
+    self.ValidateCohortCheckBox = self.getWidget('ValidateCohortCheckBox')
     self.CSVFileNameLineEdit = self.getWidget('CSVFileNameLineEdit')
+    self.csvFileName = ''
+    self.ImporterTypeTabWidget = self.getWidget('ImporterTypeTabWidget')
+    self.DirectoryImportTab = self.getWidget('DirectoryImportTab')
+    self.DirectoryButton = self.getWidget('DirectoryButton')
+    self.InputFileNameLineEdit = self.getWidget('InputFileNameLineEdit')
     self.DataInputTypeGroupBox = self.getWidget('DataInputTypeGroupBox')
     self.AutoSegInputType = self.getWidget('AutoSegInputType')
     self.AutoSegInputType.toggled.connect(lambda: self.onInputType_chosen(self.AutoSegInputType))
@@ -288,18 +1254,74 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
     self.FreeSurferInputType.toggled.connect(lambda: self.onInputType_chosen(self.FreeSurferInputType))
     self.GeneralInputType = self.getWidget('GeneralInputType')
     self.GeneralInputType.toggled.connect(lambda: self.onInputType_chosen(self.GeneralInputType))
-    self.SubjectsTableWidget = self.getWidget('SubjectsTableWidget')
+    self.SubjectsTableView = self.getWidget('SubjectsTableView')
+    self.SubjectFilterLineEdit = self.getWidget('SubjectFilterLineEdit')
+    self.OutlierSubjectsCheckBox = self.getWidget('OutlierSubjectsCheckBox')
     self.StructuresSliderWidget = self.getWidget('StructuresSliderWidget')
     self.CurrentStructureTopologyLineEdit = self.getWidget('CurrentStructureTopologyLineEdit')
     self.CohortTopologyLineEdit = self.getWidget('CohortTopologyLineEdit')
     self.SaveCleanDataCheckBox = self.getWidget('checkBoxSaveCleanData')
     self.SaveCleanDataCheckBox.setChecked(True)
     self.SaveCleanDataCheckBox.connect('toggled(bool)', self.onSaveCleanDataCheckBoxToggled)
-
-    self.SubjectsTableWidget.connect('cellClicked(int, int)', self.onSubjectTableWidgetClicked)
+    self.NumberOfWorkersSpinBox = self.getWidget('NumberOfWorkersSpinBox')
+    self.NumberOfWorkersSpinBox.connect('valueChanged(int)', self.onNumberOfWorkersSpinBoxChanged)
+    self.MultiLabelExtractionCheckBox = self.getWidget('MultiLabelExtractionCheckBox')
+    self.MultiLabelExtractionCheckBox.connect('toggled(bool)', self.onMultiLabelExtractionCheckBoxToggled)
+    self.ComponentFilteringCheckBox = self.getWidget('ComponentFilteringCheckBox')
+    self.ComponentFilteringCheckBox.connect('toggled(bool)', self.onComponentFilteringChanged)
+    self.FillHolesCheckBox = self.getWidget('FillHolesCheckBox')
+    self.FillHolesCheckBox.connect('toggled(bool)', self.onComponentFilteringChanged)
+    self.MaximumHoleSizeSpinBox = self.getWidget('MaximumHoleSizeSpinBox')
+    self.MaximumHoleSizeSpinBox.connect('valueChanged(int)', self.onComponentFilteringChanged)
+    self.SurfaceCacheCheckBox = self.getWidget('SurfaceCacheCheckBox')
+    self.SurfaceCacheCheckBox.connect('toggled(bool)', self.onSurfaceCacheChanged)
+    self.SurfaceCacheSizeSpinBox = self.getWidget('SurfaceCacheSizeSpinBox')
+    self.SurfaceCacheSizeSpinBox.connect('valueChanged(int)', self.onSurfaceCacheChanged)
+    self.ImportJournalCheckBox = self.getWidget('ImportJournalCheckBox')
+    self.MeshMemoryBudgetSpinBox = self.getWidget('MeshMemoryBudgetSpinBox')
+    self.MeshMemoryBudgetSpinBox.connect('valueChanged(int)', self.onMeshMemoryBudgetSpinBoxChanged)
+    self.ReleaseVoxelDataCheckBox = self.getWidget('ReleaseVoxelDataCheckBox')
+    self.ReleaseVoxelDataCheckBox.connect('toggled(bool)', self.onReleaseVoxelDataCheckBoxToggled)
+    self.ExportDirectoryButton = self.getWidget('ExportDirectoryButton')
+    self.ExportCompressCheckBox = self.getWidget('ExportCompressCheckBox')
+    self.ExportCohortMeshCheckBox = self.getWidget('ExportCohortMeshCheckBox')
+    self.ExportButton = self.getWidget('ExportButton')
+    self.ExportButton.connect('clicked(bool)', self.onExportButton)
+    self.ExportStatusLabel = self.getWidget('ExportStatusLabel')
+
+    # The full resolution mesh replaces the preview once browsing stops
+    self.displayedSegment = None
+    self.fullResolutionTimer = qt.QTimer()
+    self.fullResolutionTimer.setSingleShot(True)
+    self.fullResolutionTimer.setInterval(300)
+    self.fullResolutionTimer.connect('timeout()', self.onFullResolutionTimer)
+
+    # The topology evaluated in the background is added to the table as it arrives, the table is rebuilt at
+    # most once per refresh interval
+    self.importRunning = False
+    self.subjectTableModel = SubjectTableModel(self.logic, self.SubjectsTableView)
+    self.subjectTableChanged = False
+    self.subjectTableRefreshInterval = 1.0
+    self.subjectTableRefreshTime = 0.0
+    self.selectedCaseName = None
+    self.topologyTimer = qt.QTimer()
+    self.topologyTimer.setInterval(200)
+    self.topologyTimer.connect('timeout()', self.onTopologyTimer)
+
+    self.SubjectsTableView.setModel(self.subjectTableModel)
+    # Sorting starts without a column, the subjects are shown in import order until a header is clicked
+    self.SubjectsTableView.horizontalHeader().setSortIndicator(-1, qt.Qt.AscendingOrder)
+    self.SubjectsTableView.setSortingEnabled(True)
+    self.SubjectsTableView.verticalHeader().setVisible(False)
+    self.SubjectsTableView.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.SubjectsTableView.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.SubjectsTableView.connect('clicked(QModelIndex)', self.onSubjectTableViewClicked)
+    self.SubjectFilterLineEdit.connect('textChanged(QString)', self.onSubjectFilterChanged)
+    self.OutlierSubjectsCheckBox.connect('toggled(bool)', self.onSubjectFilterChanged)
     self.StructuresSliderWidget.connect('valueChanged(double)', self.onStructuresSliderWidgetChanged)
     self.StructuresSliderWidget.minimum = 0
     self.StructuresSliderWidget.maximum = 0
+    self.currentStructureLabel = 0
 
     # Initialize the beginning input type.
     self.onInputType_chosen(self.AutoSegInputType)
@@ -307,15 +1329,26 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
     self.onInputType_chosen(self.FreeSurferInputType)
     self.onInputType_chosen(self.GeneralInputType)
     self.onSaveCleanDataCheckBoxToggled()
+    self.onNumberOfWorkersSpinBoxChanged(self.NumberOfWorkersSpinBox.value)
+    self.onMultiLabelExtractionCheckBoxToggled()
+    self.onComponentFilteringChanged()
+    self.onSurfaceCacheChanged()
+    self.onSkipMismatchedCasesCheckBoxToggled()
+    self.onMeshMemoryBudgetSpinBoxChanged(self.MeshMemoryBudgetSpinBox.value)
+    self.onReleaseVoxelDataCheckBoxToggled()
 
   #
   # Reset all the data for data import
   #
   def cleanup(self):
     print 'Deleting nodes'
-    if self.SubjectsTableWidget is not None:
-      self.SubjectsTableWidget.setRowCount(0)
+    self.fullResolutionTimer.stop()
+    self.topologyTimer.stop()
+    self.displayedSegment = None
+    self.selectedCaseName = None
+    self.subjectTableChanged = False
     self.logic.cleanup()
+    self.subjectTableModel.clear()
 
   #
   # Functions to recover the widget in the .ui file
@@ -334,44 +1367,124 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
     return None
 
   #
-  # Routine to import the segmentation files given file names
-  # This right now only handles the csv mode.
-  # TODO: should also handle cases when surface files are given
+  # Routine to import the segmentation or surface files given file names
+  # Each case is added to the table with its topology as soon as it is imported.
   #
-  def importFiles(self, filePaths):
-
-    numCases = 0
-    self.SubjectsTableWidget.setColumnCount(1)
-    self.SubjectsTableWidget.setHorizontalHeaderLabels(['Subject name'])
-    self.SubjectsTableWidget.verticalHeader().setVisible(False)
-    self.SubjectsTableWidget.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
-    self.SubjectsTableWidget.setSelectionMode(qt.QAbstractItemView.SingleSelection)
-
-    if self.logic.importFiles(filePaths):
-
-      for path in filePaths:
-        # load each file
-        pathPair = os.path.split(path)
-        fileName = pathPair[1]
-
-        # extract just the filename, and populate the tablewidget
-        rowPosition = self.SubjectsTableWidget.rowCount
-        self.SubjectsTableWidget.insertRow(rowPosition)
-        self.SubjectsTableWidget.setItem(rowPosition, 0, qt.QTableWidgetItem(fileName))
-        numCases = numCases + 1
-      self.SubjectsTableWidget.setCurrentCell(0, 0)
-    else:
-      return
-
-    labelRangeInCohort = self.logic.getLabelRangeInCohort()
-    self.StructuresSliderWidget.minimum = int(labelRangeInCohort[0])
-    self.StructuresSliderWidget.maximum = int(labelRangeInCohort[1])
-    self.StructuresSliderWidget.setValue(0)
+  def importFiles(self, filePaths, caseNames=None):
+
+    if self.ValidateCohortCheckBox.isChecked():
+      if caseNames is None:
+        caseNames = [os.path.basename(path) for path in filePaths]
+      self.ImportStatusLabel.text = 'Validating %d files...' % len(filePaths)
+      slicer.app.processEvents()
+      # Counting the labels would read every file twice, the import checks them case by case
+      report = self.logic.validateFiles(filePaths, caseNames, checkLabels=False)
+      if not report['valid']:
+        summary = CohortValidationUtility.formatSummary(report)
+        if not self.SkipMismatchedCasesCheckBox.isChecked():
+          self.ImportStatusLabel.text = summary + '. Import stopped, see the Python console.'
+          return
+        # Only the valid cases are imported
+        validCases = CohortValidationUtility.getValidCases(report)
+        filePaths = [filePaths[index] for index in validCases]
+        caseNames = [caseNames[index] for index in validCases]
+        if len(filePaths) == 0:
+          self.ImportStatusLabel.text = summary + '. Nothing to import.'
+          return
+
+    journalDirectory = ''
+    if self.ImportJournalCheckBox.isChecked():
+      # Each cohort has its own journal, an interrupted import of the same files resumes from it. The journals
+      # of the cohorts that were not imported for the longest time are removed past the maximum size.
+      journalsDirectory = os.path.join(slicer.app.cachePath, 'DataImporterJournals')
+      journalDirectory = ImportJournal.getCohortDirectory(journalsDirectory, filePaths)
+      ImportJournal.evictCohortDirectories(journalsDirectory, keep_dir=journalDirectory)
+    self.logic.SetImportJournal(journalDirectory)
+
+    self.importCancelled = False
+    self.ImportButton.enabled = False
+    self.CancelImportButton.enabled = True
+    self.ImportProgressBar.maximum = len(filePaths)
+    self.ImportProgressBar.value = 0
+    startTime = time.time()
+    numFailedCases = 0
+
+    # Unlike the import of the logic, the whole import is not batched here, only the nodes of each case: the
+    # cases are shown as they are imported, and the end of a batch refreshes everything that observes the scene
+    caseEvents = self.logic.iterImportFiles(filePaths, caseNames)
+    self.importRunning = True
+    self.logic.prioritizeTopology(self.currentStructureLabel)
+    self.topologyTimer.start()
+    try:
+      for caseEvent in caseEvents:
+        if caseEvent['status'] == 'imported':
+          # The topology of the case is evaluated in the background, the shown structure first
+          self.logic.scheduleTopology([caseEvent['name']])
+          self.addSubjectRow(caseEvent['name'])
+        elif caseEvent['status'] == 'mismatch':
+          self.ImportStatusLabel.text = caseEvent['message'] + '. Import stopped.'
+          break
+        else:
+          numFailedCases = numFailedCases + 1
+
+        numDone = caseEvent['index'] + 1
+        self.ImportProgressBar.value = numDone
+        elapsedTime = time.time() - startTime
+        remainingTime = elapsedTime / numDone * (caseEvent['total'] - numDone)
+        self.ImportStatusLabel.text = '%d/%d cases, %d failed or skipped, about %s left' % (
+          numDone, caseEvent['total'], numFailedCases, self.formatDuration(remainingTime))
+        slicer.app.processEvents()
+        if self.importCancelled:
+          self.ImportStatusLabel.text = 'Import cancelled after %d/%d cases' % (numDone, caseEvent['total'])
+          break
+    finally:
+      caseEvents.close()
+      self.importRunning = False
+      self.ImportButton.enabled = True
+      self.CancelImportButton.enabled = False
+
+    self.refreshSubjectTable()
 
-    # Populate the topology table
-    self.logic.populateTopologyDictionary()
+  #
+  # The subject is shown with the next refresh of the table, the table is not rebuilt for each case
+  #
+  def addSubjectRow(self, nodeName):
+    firstCase = self.subjectTableModel.getNumberOfCases() == 0
+    self.subjectTableModel.addCase(nodeName)
+    self.subjectTableChanged = True
+
+    if firstCase:
+      # given labels, and current mode populate the structures slider
+      labelsInCohort = self.logic.getLabelsInCohort()
+      self.StructuresSliderWidget.minimum = 0
+      self.StructuresSliderWidget.maximum = labelsInCohort[-1] if len(labelsInCohort) > 0 else 0
+      self.StructuresSliderWidget.setValue(0)
+      self.currentStructureLabel = 0
+      self.refreshSubjectTable()
+      row = self.subjectTableModel.getRow(nodeName)
+      if row is not None:
+        self.SubjectsTableView.selectRow(row)
+        self.displaySubject(row, '0')
+    elif self.selectedCaseName is not None:
+      # The cohort consistency changes with each new case
+      self.updateTopologyDisplay(self.selectedCaseName, str(int(self.StructuresSliderWidget.value)))
 
-    self.onSubjectTableWidgetClicked(0,0)
+  #
+  # Gather the topology of the cohort in the table again, and keep the selected subject selected
+  #
+  def refreshSubjectTable(self):
+    self.subjectTableChanged = False
+    self.subjectTableRefreshTime = time.time()
+    self.subjectTableModel.refresh()
+    row = self.subjectTableModel.getRow(self.selectedCaseName)
+    if row is not None:
+      self.SubjectsTableView.selectRow(row)
+
+  @staticmethod
+  def formatDuration(seconds):
+    if seconds < 60:
+      return '%d s' % seconds
+    return '%d min %d s' % (seconds // 60, seconds % 60)
 
   '''
   GUI Callback functions
@@ -380,50 +1493,160 @@ class DataImporterWidget(ScriptedLoadableModuleWidget):
   #  Handle request to import data
   #
   def onImportButton(self):
-    filenames = []
     self.cleanup()
-    if self.importFromCSV:
-      with open(self.csvFileName, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        # ignore the header
-        next(reader, None)
-        # assuming that each row is just a file path.
-        for row in reader:
-          if len(row) > 0:
-            filenames.append(row[0])
-        # Import all files
-        self.importFiles(filenames)
-
-        # Depending on the mode fill the structures table.
-        # TODO: add directory parsing based on mode
-    else:
-      print "Importing from directory is not yet supported"
+    if self.ImporterTypeTabWidget.currentWidget() == self.DirectoryImportTab:
+      # The layout of the chosen input type gives the cases of the directory
+      caseNames, filenames = self.logic.discoverFiles(self.DirectoryButton.directory, self.inputType,
+                                                      self.InputFileNameLineEdit.text.strip())
+      if len(filenames) == 0:
+        self.ImportStatusLabel.text = 'No ' + self.inputType + ' labelmap found in ' + self.DirectoryButton.directory
+        return
+      self.importFiles(filenames, caseNames)
+    elif self.csvFileName:
+      filenames = DataImporterLogic.readCSVManifest(self.csvFileName)
+      # Import all files
+      self.importFiles(filenames)
+
+  def onExportButton(self):
+    outputDirectory = self.ExportDirectoryButton.directory
+    statistics = self.logic.exportSurfaces(outputDirectory, self.ExportCompressCheckBox.isChecked())
+    self.ExportStatusLabel.text = ExportUtility.formatStatistics(statistics)
+    if self.ExportCohortMeshCheckBox.isChecked():
+      self.logic.exportCohortMesh(os.path.join(outputDirectory, 'cohort' + CohortMesh.FILE_EXTENSION))
+
+  def onCancelImportButton(self):
+    self.importCancelled = True
 
   def onCSVFileBrowsePushButton(self):
     self.csvFileName = qt.QFileDialog.getOpenFileName(self.widget, "Open CSV File", ".", "CSV Files (*.csv)")
     self.CSVFileNameLineEdit.text = self.csvFileName
-    self.importFromCSV = True
 
   def onInputType_chosen(self, b):
     inputTypeText = b.text
     if b.isChecked():
       self.inputType = inputTypeText
 
-  def onSubjectTableWidgetClicked(self, row, column):
-    nodeName = self.SubjectsTableWidget.item(row, column).text()
-    segmentId = str(int(self.StructuresSliderWidget.value))
-    self.logic.displaySegment(nodeName, segmentId)
-    self.updateTopologyDisplay(nodeName, segmentId)
+  def onSubjectTableViewClicked(self, index):
+    self.displaySubject(index.row(), str(int(self.StructuresSliderWidget.value)))
+
+  #
+  # Show the subjects whose name contains the filter text, and only those whose topology differs from the
+  # cohort for the shown structure (any structure when all of them are shown) if requested
+  #
+  def onSubjectFilterChanged(self):
+    self.subjectTableModel.setNameFilter(self.SubjectFilterLineEdit.text)
+    outlierLabel = self.currentStructureLabel if self.OutlierSubjectsCheckBox.isChecked() else None
+    self.subjectTableModel.setOutlierFilter(outlierLabel)
+    self.refreshSubjectTable()
 
   def onStructuresSliderWidgetChanged(self, value):
-    nodeName = self.SubjectsTableWidget.currentItem().text()
-    segmentId = str(int(value))
-    self.logic.displaySegment(nodeName, segmentId)
+    # The slider only stops on the labels present in the cohort, 0 shows all the structures
+    label = self.getStructureLabel(int(value))
+    if label != int(value):
+      self.StructuresSliderWidget.setValue(label)
+      return
+    self.currentStructureLabel = label
+    self.logic.prioritizeTopology(label)
+    if self.OutlierSubjectsCheckBox.isChecked():
+      self.onSubjectFilterChanged()
+
+    row = self.subjectTableModel.getRow(self.selectedCaseName)
+    if row is None:
+      return
+    column = self.subjectTableModel.getColumn(label)
+    if column is not None:
+      self.SubjectsTableView.scrollTo(self.subjectTableModel.index(row, column))
+    self.displaySubject(row, str(int(value)))
+
+  #
+  # Show the preview of a structure right away, and prepare the previews of the subjects around it
+  #
+  def displaySubject(self, row, segmentId):
+    nodeName = self.subjectTableModel.getCaseName(row)
+    self.selectedCaseName = nodeName
+    if segmentId != '0':
+      # The shown structure does not wait for the background evaluation
+      self.logic.computeLabelTopology(nodeName, int(segmentId))
+      self.subjectTableChanged = True
+    self.logic.displaySegment(nodeName, segmentId, preview=True)
     self.updateTopologyDisplay(nodeName, segmentId)
+    self.displayedSegment = (nodeName, segmentId)
+    self.fullResolutionTimer.start()
+
+    neighbourNames = [nodeName]
+    for neighbourRow in [row + 1, row - 1]:
+      if 0 <= neighbourRow < self.subjectTableModel.rowCount():
+        neighbourNames.append(self.subjectTableModel.getCaseName(neighbourRow))
+    self.logic.requestPreviews(neighbourNames, int(segmentId))
+
+  #
+  # Add the topology evaluated in the background to the table and to the cohort consistency
+  #
+  def onTopologyTimer(self):
+    segmentNum = self.currentStructureLabel
+    keys = self.logic.collectTopologyResults()
+    if len(keys) > 0:
+      self.subjectTableChanged = True
+    topologyComplete = not self.importRunning and self.logic.isTopologyComplete()
+    # Each refresh gathers the whole cohort and resets the view, the results of several ticks are shown at once
+    if self.subjectTableChanged and (
+        topologyComplete or time.time() - self.subjectTableRefreshTime >= self.subjectTableRefreshInterval):
+      self.refreshSubjectTable()
+    if len(keys) > 0 and self.selectedCaseName is not None:
+      self.updateTopologyDisplay(self.selectedCaseName, str(segmentNum))
+    if topologyComplete:
+      self.topologyTimer.stop()
+      self.logic.finishTopologyDictionary()
+
+  def onFullResolutionTimer(self):
+    if self.displayedSegment is not None and self.displayedSegment[1] != '0':
+      self.logic.displaySegment(self.displayedSegment[0], self.displayedSegment[1], resetView=False)
+
+  #
+  # Label the slider moves to from value: value itself if it is in the cohort, otherwise the next
+  # label in the direction the slider moved
+  #
+  def getStructureLabel(self, value):
+    labels = [0] + list(self.logic.getLabelsInCohort())
+    if value in labels:
+      return value
+    index = bisect.bisect_left(labels, value)
+    if value < self.currentStructureLabel:
+      index = index - 1
+    return labels[max(0, min(index, len(labels) - 1))]
 
   def onSaveCleanDataCheckBoxToggled(self):
     self.logic.SetSaveCleanData(self.SaveCleanDataCheckBox.isChecked())
 
+  def onSkipMismatchedCasesCheckBoxToggled(self):
+    self.logic.SetSkipMismatchedCases(self.SkipMismatchedCasesCheckBox.isChecked())
+
+  def onNumberOfWorkersSpinBoxChanged(self, value):
+    self.logic.SetNumberOfWorkers(value)
+
+  def onMultiLabelExtractionCheckBoxToggled(self):
+    mode = 'MultiLabel' if self.MultiLabelExtractionCheckBox.isChecked() else 'Segmentation'
+    self.logic.SetSurfaceExtractionMode(mode)
+
+  def onComponentFilteringChanged(self):
+    enabled = self.ComponentFilteringCheckBox.isChecked()
+    self.FillHolesCheckBox.setEnabled(enabled)
+    self.MaximumHoleSizeSpinBox.setEnabled(enabled and self.FillHolesCheckBox.isChecked())
+    self.logic.SetComponentFiltering(enabled, self.FillHolesCheckBox.isChecked(), self.MaximumHoleSizeSpinBox.value)
+
+  def onSurfaceCacheChanged(self):
+    cacheDirectory = ''
+    if self.SurfaceCacheCheckBox.isChecked():
+      cacheDirectory = os.path.join(slicer.app.cachePath, 'DataImporter')
+    self.SurfaceCacheSizeSpinBox.setEnabled(self.SurfaceCacheCheckBox.isChecked())
+    self.logic.SetSurfaceCache(cacheDirectory, self.SurfaceCacheSizeSpinBox.value * 1024 ** 2)
+
+  def onMeshMemoryBudgetSpinBoxChanged(self, value):
+    self.logic.SetMeshMemoryBudget(value * 1024 ** 2)
+
+  def onReleaseVoxelDataCheckBoxToggled(self):
+    self.logic.SetReleaseVoxelData(self.ReleaseVoxelDataCheckBox.isChecked())
+
   '''
   Supplemental functions to update the visualizations
   '''
@@ -454,4 +1677,328 @@ class DataImporterTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.delayDisplay(' Tests Passed! ')
\ No newline at end of file
+    self.test_SyntheticCohortTopology()
+    self.test_SurfaceCohortTopology()
+    self.test_RepeatedImport()
+    self.test_ParallelImport()
+    self.test_ResumeImport()
+    self.test_CachedImport()
+    self.test_MergeShards()
+    self.delayDisplay(' Tests Passed! ')
+
+  def test_SyntheticCohortTopology(self):
+    """ Import a synthetic cohort whose structures have a known topology, with both surface extraction modes.
+    """
+    self.delayDisplay('Generating a synthetic cohort')
+    numberOfLabels = len(SyntheticCohortUtility.SHAPES)
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      filePaths, _ = SyntheticCohortUtility.generateCohort(dataDirectory, 3, 48, numberOfLabels)
+      for mode in ['Segmentation', 'MultiLabel']:
+        self.delayDisplay('Importing the cohort in ' + mode + ' mode')
+        logic = DataImporterLogic()
+        logic.SetSaveCleanData(True)
+        logic.SetSurfaceExtractionMode(mode)
+        # The small sphere of the 'twoSpheres' label is removed from the voxels in one of the modes
+        logic.SetComponentFiltering(mode == 'MultiLabel')
+        logic.SetReleaseVoxelData(mode == 'Segmentation')
+        report = logic.validateFiles(filePaths)
+        self.assertTrue(report['valid'])
+        self.assertEqual(report['reference']['labels'], list(range(1, numberOfLabels + 1)))
+        self.assertTrue(logic.importFiles(filePaths))
+        self.assertEqual(logic.caseNames, [os.path.basename(filePath) for filePath in filePaths])
+        self.assertEqual(logic.getLabelsInCohort(), tuple(range(1, numberOfLabels + 1)))
+        if mode == 'MultiLabel':
+          twoSpheresLabel = SyntheticCohortUtility.SHAPES.index('twoSpheres') + 1
+          self.assertEqual(logic.getComponentCounts(logic.caseNames[0])[twoSpheresLabel]['components'], 2)
+
+        if mode == 'Segmentation':
+          logic.populateTopologyDictionary()
+        else:
+          # Background evaluation, with one structure computed on demand
+          logic.scheduleTopology(logic.caseNames)
+          logic.prioritizeTopology(numberOfLabels)
+          self.assertIsNotNone(logic.computeLabelTopology(logic.caseNames[-1], 1))
+          while not logic.isTopologyComplete():
+            time.sleep(0.05)
+            logic.collectTopologyResults()
+        self.assertEqual(SyntheticCohortUtility.findTopologyErrors(logic.topologyMatrix, numberOfLabels), [])
+        self.assertTrue(logic.isCohortTopologyConsistent())
+        # No subject differs from the cohort, the outlier filter of the subject table leaves no row
+        subjectTable = SubjectTable()
+        for nodeName in logic.caseNames:
+          subjectTable.addCase(nodeName)
+        subjectTable.update(logic.topologyMatrix, logic.getLabelsInCohort())
+        self.assertEqual(subjectTable.getRowCount(), len(logic.caseNames))
+        subjectTable.setOutlierFilter(0)
+        subjectTable.update(logic.topologyMatrix, logic.getLabelsInCohort())
+        self.assertEqual(subjectTable.getRowCount(), 0)
+        # The packed surfaces read back are the ones of the mesh store
+        cohortMeshPath = os.path.join(dataDirectory, mode + CohortMesh.FILE_EXTENSION)
+        statistics = logic.exportCohortMesh(cohortMeshPath)
+        self.assertEqual(statistics['cases'], len(logic.caseNames))
+        cohortMesh = CohortMesh.read(cohortMeshPath, memory_map=False)
+        self.assertEqual(cohortMesh.getCaseNames(), logic.caseNames)
+        for nodeName in logic.caseNames:
+          self.assertEqual(cohortMesh.getLabels(nodeName), sorted(logic.polyDataDict.getLabels(nodeName)))
+          for label in cohortMesh.getLabels(nodeName):
+            polydata = logic.polyDataDict.getMesh(nodeName, label)
+            self.assertEqual(len(cohortMesh.getPoints(nodeName, label)), polydata.GetNumberOfPoints())
+            self.assertEqual(len(cohortMesh.getTriangles(nodeName, label)), polydata.GetNumberOfPolys())
+        if mode == 'Segmentation':
+          # Only the meshes are left, a released case is read again when its segmentation is needed
+          self.assertEqual(logic.testCaseDict, {})
+          self.assertEqual(logic.segmentationDict, {})
+          for nodeName in logic.caseNames[:2]:
+            self.assertIsNotNone(logic.getSegmentationNode(nodeName))
+            self.assertEqual(list(logic.testCaseDict.keys()), [nodeName])
+        logic.cleanup()
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_SurfaceCohortTopology(self):
+    """ Import spheres from surface files of each supported format, without any labelmap, and an open sheet
+    whose surface has a boundary.
+    """
+    self.delayDisplay('Writing a cohort of surfaces')
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      sphere = vtk.vtkSphereSource()
+      sphere.SetThetaResolution(32)
+      sphere.SetPhiResolution(16)
+      sphere.Update()
+      filePaths = []
+      for extension, writer in [('.vtp', vtk.vtkXMLPolyDataWriter()), ('.vtk', vtk.vtkPolyDataWriter()),
+                                ('.stl', vtk.vtkSTLWriter())]:
+        filePaths.append(os.path.join(dataDirectory, 'sphere' + extension))
+        writer.SetFileName(filePaths[-1])
+        writer.SetInputData(sphere.GetOutput())
+        writer.Write()
+      spherePaths = list(filePaths)
+
+      # A flat sheet is topologically a disk: a single boundary loop and an Euler characteristic of 1
+      sheet = vtk.vtkPlaneSource()
+      sheet.SetResolution(8, 8)
+      sheet.Update()
+      filePaths.append(os.path.join(dataDirectory, 'sheet.vtp'))
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetFileName(filePaths[-1])
+      writer.SetInputData(sheet.GetOutput())
+      writer.Write()
+
+      self.delayDisplay('Importing the surfaces')
+      logic = DataImporterLogic()
+      logic.SetSaveCleanData(True)
+      # Surfaces are validated as readable cases with label 1, as they are imported
+      report = logic.validateFiles(filePaths)
+      self.assertTrue(report['valid'])
+      self.assertEqual(report['reference']['labels'], [1])
+      self.assertTrue(logic.importFiles(filePaths))
+      self.assertEqual(logic.getLabelsInCohort(), (1,))
+      self.assertEqual(logic.testCaseDict, {})
+      logic.populateTopologyDictionary()
+      for filePath in spherePaths:
+        self.assertEqual(logic.topologyMatrix.getEuler(os.path.basename(filePath), 1), 2)
+      self.assertEqual(logic.topologyMatrix.getEuler('sheet.vtp', 1), 1)
+      self.assertEqual(logic.topologyDetailsDict['sheet.vtp'][1]['boundaryLoops'], 1)
+      self.assertEqual(logic.getTopologyString('sheet.vtp', 1), 'Disk')
+      self.assertFalse(logic.isCohortTopologyConsistent())
+      self.assertEqual(logic.topologyMatrix.getOutlierCases(1), ['sheet.vtp'])
+      logic.cleanup()
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_RepeatedImport(self):
+    """ Import a cohort, clean up, then import again with the same logic, as the Import button does.
+    """
+    self.delayDisplay('Importing a synthetic cohort twice')
+    numberOfLabels = len(SyntheticCohortUtility.SHAPES)
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      filePaths, _ = SyntheticCohortUtility.generateCohort(dataDirectory, 3, 48, numberOfLabels)
+      logic = DataImporterLogic()
+      logic.SetSaveCleanData(True)
+      self.assertTrue(logic.importFiles(filePaths))
+      logic.cleanup()
+      self.assertEqual(logic.caseNames, [])
+
+      # The second import must not compare its first case with the cases of the previous one
+      self.assertTrue(logic.importFiles(filePaths[1:]))
+      self.assertEqual(logic.caseNames, [os.path.basename(filePath) for filePath in filePaths[1:]])
+      self.assertEqual(logic.getLabelsInCohort(), tuple(range(1, numberOfLabels + 1)))
+      logic.populateTopologyDictionary()
+      self.assertEqual(logic.topologyMatrix.getCaseNames(), logic.caseNames)
+      self.assertEqual(SyntheticCohortUtility.findTopologyErrors(logic.topologyMatrix, numberOfLabels), [])
+      logic.cleanup()
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_ParallelImport(self):
+    """ Import a cohort with two workers and check that the result is the one of a serial import, and that the
+    workers only load a few cases ahead of the main thread.
+    """
+    self.delayDisplay('Importing a synthetic cohort with one and two workers')
+    numberOfLabels = len(SyntheticCohortUtility.SHAPES)
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      filePaths, _ = SyntheticCohortUtility.generateCohort(dataDirectory, 8, 48, numberOfLabels)
+      results = []
+      for numberOfWorkers in [1, 2]:
+        logic = DataImporterLogic()
+        logic.SetSaveCleanData(True)
+        logic.SetSurfaceExtractionMode('MultiLabel')
+        logic.SetNumberOfWorkers(numberOfWorkers)
+        loadedCases = []
+
+        def countingLoadCase(path, caseName=None, loadCase=logic.loadCase):
+          loadedCases.append(path)
+          return loadCase(path, caseName)
+        logic.loadCase = countingLoadCase
+        caseEvents = logic.iterImportFiles(filePaths)
+        self.assertEqual(next(caseEvents)['status'], 'imported')
+        self.assertLessEqual(len(loadedCases), 2 * numberOfWorkers)
+        self.assertTrue(all(caseEvent['status'] == 'imported' for caseEvent in caseEvents))
+        logic.populateTopologyDictionary()
+        meshSizes = dict(((nodeName, label), (polydata.GetNumberOfPoints(), polydata.GetNumberOfPolys()))
+                         for nodeName in logic.caseNames
+                         for label, polydata in logic.polyDataDict.getMeshes(nodeName).items())
+        results.append((list(logic.caseNames), logic.getLabelsInCohort(), logic.labelCountsDict,
+                        logic.topologyDetailsDict, meshSizes))
+        logic.cleanup()
+      self.assertEqual(results[0][0], [os.path.basename(filePath) for filePath in filePaths])
+      for serial, parallel in zip(results[0], results[1]):
+        self.assertEqual(serial, parallel)
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_ResumeImport(self):
+    """ Stop a journaled import after two cases, change the file of the first one, then import the cohort again:
+    the second case is resumed from the journal and the first one is computed again.
+    """
+    self.delayDisplay('Resuming an interrupted import')
+    numberOfLabels = len(SyntheticCohortUtility.SHAPES)
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      filePaths, _ = SyntheticCohortUtility.generateCohort(dataDirectory, 4, 48, numberOfLabels)
+      caseNames = [os.path.basename(filePath) for filePath in filePaths]
+      logic = DataImporterLogic()
+      logic.SetSaveCleanData(True)
+      logic.SetImportJournal(os.path.join(dataDirectory, 'journal'))
+      caseEvents = logic.iterImportFiles(filePaths)
+      for _ in range(2):
+        caseEvent = next(caseEvents)
+        self.assertEqual(caseEvent['status'], 'imported')
+        logic.processCaseTopology(caseEvent['name'])
+      caseEvents.close()
+      self.assertFalse(logic.importFinished)
+      logic.finishTopologyDictionary()
+      self.assertEqual(logic.importJournal.getRecordedCaseNames(), sorted(caseNames[:2]))
+      logic.cleanup()
+
+      # Another labelmap of the cohort, written later
+      shutil.copyfile(filePaths[2], filePaths[0])
+      modificationTime = os.path.getmtime(filePaths[0]) + 10
+      os.utime(filePaths[0], (modificationTime, modificationTime))
+
+      self.assertTrue(logic.importFiles(filePaths))
+      statistics = logic.importJournal.getStatistics()
+      self.assertEqual(statistics['resumed'], 1)
+      self.assertEqual(statistics['stale'], 1)
+      self.assertEqual(logic.cachedCaseNames, set([caseNames[1]]))
+      logic.populateTopologyDictionary()
+      self.assertEqual(SyntheticCohortUtility.findTopologyErrors(logic.topologyMatrix, numberOfLabels), [])
+      # The import finished, nothing is left to resume
+      self.assertEqual(logic.importJournal.getStatistics()['recorded'], 3)
+      self.assertEqual(logic.importJournal.getRecordedCaseNames(), [])
+      logic.cleanup()
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_CachedImport(self):
+    """ Import a cohort twice with the same surface cache: the second import reads the surfaces and topology of
+    each case from the cache, and its labelmap only when it is shown.
+    """
+    self.delayDisplay('Importing a cohort from the surface cache')
+    numberOfLabels = len(SyntheticCohortUtility.SHAPES)
+    dataDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      filePaths, _ = SyntheticCohortUtility.generateCohort(dataDirectory, 3, 48, numberOfLabels)
+      logic = DataImporterLogic()
+      logic.SetSaveCleanData(True)
+      logic.SetSurfaceCache(os.path.join(dataDirectory, 'cache'))
+      self.assertTrue(logic.importFiles(filePaths))
+      logic.populateTopologyDictionary()
+      self.assertEqual(logic.surfaceCache.getStatistics()['hits'], 0)
+      eulerNumbers = dict(logic.topologyDict)
+      logic.cleanup()
+
+      self.assertTrue(logic.importFiles(filePaths))
+      self.assertEqual(logic.surfaceCache.getStatistics()['hits'], len(filePaths))
+      self.assertEqual(logic.cachedCaseNames, set(logic.caseNames))
+      # No labelmap was read
+      self.assertEqual(logic.testCaseDict, {})
+      self.assertEqual(logic.releasedCaseNames, set(logic.caseNames))
+      logic.populateTopologyDictionary()
+      self.assertEqual(logic.topologyDict, eulerNumbers)
+      self.assertEqual(SyntheticCohortUtility.findTopologyErrors(logic.topologyMatrix, numberOfLabels), [])
+
+      nodeName = logic.caseNames[0]
+      self.assertIsNotNone(logic.getSegmentationNode(nodeName))
+      self.assertEqual(list(logic.testCaseDict.keys()), [nodeName])
+      logic.cleanup()
+    finally:
+      shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  def test_MergeShards(self):
+    """ Merge hand-written shard results: the cases of the shard whose labels differ from most cases are reported
+    as mismatched with the case that failed, and the merge waits for the pending shards unless it is partial.
+    """
+    self.delayDisplay('Merging the results of shards')
+    from CommonUtilities import sharding
+    queueDirectory = tempfile.mkdtemp(prefix='DataImporterTest')
+    try:
+      queue = sharding.ShardQueue(queueDirectory)
+      caseNames = ['case%d' % index for index in range(8)]
+      filePaths = [os.path.join(queueDirectory, caseName + '.nrrd') for caseName in caseNames]
+      shardNames = queue.create(filePaths, caseNames, 2)
+      self.assertEqual(len(shardNames), 4)
+
+      def caseResult(index, eulers):
+        topology = dict((str(label), {'euler': euler, 'genus': (2 - euler) // 2, 'boundaryLoops': 0,
+                                      'nonManifoldEdges': 0}) for label, euler in eulers.items())
+        return {'name': caseNames[index], 'path': filePaths[index], 'topology': topology, 'components': {}}
+
+      failedCase = {'name': caseNames[3], 'path': filePaths[3], 'status': 'failed', 'message': 'Failed to load'}
+      results = [
+        {'labels': [1, 2], 'cases': [caseResult(0, {1: 2, 2: 2}), caseResult(1, {1: 2, 2: 2})], 'failed': []},
+        # The torus of the second label differs from the spheres of the other cases
+        {'labels': [1, 2], 'cases': [caseResult(2, {1: 2, 2: 0})], 'failed': [failedCase]},
+        {'labels': [1, 2, 3], 'cases': [caseResult(4, {1: 2, 2: 2, 3: 2}), caseResult(5, {1: 2, 2: 2, 3: 2})],
+         'failed': []},
+      ]
+      for result in results:
+        shardName, _ = queue.claim()
+        result['shard'] = shardName
+        queue.complete(shardName, result)
+
+      merged = sharding.mergeResults(queue)
+      self.assertEqual(merged['labels'], [1, 2])
+      self.assertEqual(merged['caseNames'], caseNames[:3])
+      self.assertEqual(merged['topologyDict'][caseNames[2]], {1: 2, 2: 0})
+      self.assertEqual([(failed['name'], failed['status']) for failed in merged['failed']],
+                       [(caseNames[3], 'failed'), (caseNames[4], 'mismatch'), (caseNames[5], 'mismatch')])
+      self.assertEqual(merged['matrix'].getOutlierCases(2), [caseNames[2]])
+      self.assertEqual(merged['meshFiles'], [])
+
+      reportPath = os.path.join(queueDirectory, 'report.jsonl')
+      args = argparse.Namespace(queue=queueDirectory, report=reportPath, cohort_mesh='', partial=False)
+      # The last shard is still pending
+      self.assertEqual(sharding.runMerge(args), sharding.EXIT_IMPORT_FAILED)
+      args.partial = True
+      self.assertEqual(sharding.runMerge(args), sharding.EXIT_INCONSISTENT)
+      with open(reportPath, 'r') as reportFile:
+        rows = [json.loads(line) for line in reportFile]
+      self.assertEqual(len([row for row in rows if row['record'] == 'case']), 3 * 2)
+      self.assertEqual(rows[-1], {'record': 'cohort', 'consistency': 'InConsistent'})
+    finally:
+      shutil.rmtree(queueDirectory, ignore_errors=True)